@@ -0,0 +1,104 @@
+"""Authentication and cross-worker fan-out for the admin API.
+
+Admin requests must carry ``Authorization: Bearer <ADMIN_TOKEN>``; without
+an ADMIN_TOKEN the API is disabled.
+
+Every gunicorn worker keeps its own working set of students and its own
+caches, so an admin operation that changes shared data also publishes an
+event to ``AdminBus``: a small table in the state database that each worker
+polls between requests (at most every ADMIN_SYNC_INTERVAL seconds) and
+replays through the registered handlers. The publishing worker applies the
+event straight away.
+"""
+import hmac
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request
+
+import metrics
+from db import LazyConnection
+
+# Events older than this are pruned; workers poll far more often
+EVENT_RETENTION = 24 * 3600
+
+
+def require_admin(view):
+    """Reject requests without the admin bearer token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            return {"error": "admin API disabled (ADMIN_TOKEN not configured)"}, 404
+        header = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(header.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            metrics.increment("admin_unauthorized")
+            return {"error": "unauthorized"}, 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class AdminBus:
+    """Ordered log of admin events replayed by every worker"""
+
+    def __init__(self, path=None, sync_interval=1.0):
+        self.sync_interval = sync_interval
+        self.handlers = {}
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS admin_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                action TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+        """)
+        self._lock = threading.Lock()
+        self._last_id = None
+        self._last_poll = 0.0
+
+    def _start_position(self):
+        # Events published before this worker first looked are already reflected on disk
+        if self._last_id is None:
+            self._last_id = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM admin_events").fetchone()[0]
+
+    def handler(self, action):
+        """Decorator registering ``handler(payload)`` for an event action"""
+        def decorator(func):
+            self.handlers[action] = func
+            return func
+        return decorator
+
+    def publish(self, action, payload=None):
+        """Record an event for every worker and apply it in this one"""
+        with self._lock:
+            self._start_position()
+            now = time.time()
+            self._db.execute("INSERT INTO admin_events (action, payload, created_at) VALUES (?, ?, ?)",
+                             (action, json.dumps(payload, ensure_ascii=False), now))
+            self._db.execute("DELETE FROM admin_events WHERE created_at < ?", (now - EVENT_RETENTION,))
+        self.poll(force=True)
+
+    def poll(self, force=False):
+        """Apply events published since the last poll; returns how many"""
+        now = time.time()
+        if not force and now - self._last_poll < self.sync_interval:
+            return 0
+        with self._lock:
+            self._start_position()
+            self._last_poll = now
+            rows = self._db.execute("SELECT id, action, payload FROM admin_events WHERE id > ? ORDER BY id",
+                                    (self._last_id,)).fetchall()
+            for event_id, action, payload in rows:
+                self._last_id = event_id
+                handler = self.handlers.get(action)
+                if handler is None:
+                    print(f"Error applying admin event: unknown action '{action}'")
+                    continue
+                try:
+                    handler(json.loads(payload))
+                except Exception as e:
+                    print(f"Error applying admin event {action}: {e}")
+        return len(rows)
@@ -0,0 +1,172 @@
+"""Admission control and graceful degradation under overload.
+
+The controller maps load to a degradation tier. Load is measured as:
+
+* model calls in flight in this process (request threads and embedded job
+  workers both make them);
+* how long webhook requests wait before a thread picks them up: the age of
+  the proxy's X-Request-Start header when there is one, otherwise how long
+  every request thread of this process has been busy (requests arriving
+  meanwhile queue in gunicorn);
+* the backlog of the job queue: ready interactive and normal jobs waiting
+  across all processes (speculative prefetch doesn't count).
+
+Tiers are cumulative:
+
+* ``NORMAL``: everything is personalized
+* ``CACHED``: lessons come from the shared (non-personalized) lesson cache
+  and speculative prefetch is paused
+* ``ESSENTIAL``: optional model calls (module transitions, the form
+  completion message) are replaced by static text
+* ``DEFER``: the student gets a short acknowledgement and the message is
+  handled in the background
+
+Thresholds are configured with ADMISSION_* environment variables; the
+defaults follow the gunicorn settings (WEB_CONCURRENCY workers of
+GUNICORN_THREADS threads, plus JOBS_WORKERS job threads per worker).
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+NORMAL = 0
+CACHED = 1
+ESSENTIAL = 2
+DEFER = 3
+
+TIER_NAMES = {NORMAL: "normal", CACHED: "cached", ESSENTIAL: "essential", DEFER: "defer"}
+
+
+class AdmissionController:
+    """Tracks load and decides how much work each message may cause"""
+
+    def __init__(self, cached_at=4, essential_at=6, defer_at=16, defer_wait=5.0, threads=4, backlog=None,
+                 backlog_interval=1.0):
+        self.cached_at = cached_at
+        self.essential_at = essential_at
+        self.defer_at = defer_at
+        self.defer_wait = defer_wait
+        self.threads = threads
+        # Callable returning the job backlog (set once the job queue exists)
+        self.backlog = backlog
+        self.backlog_interval = backlog_interval
+        self.llm_inflight = 0
+        self.requests_inflight = 0
+        self.request_wait = 0.0
+        self._saturated_since = None
+        self._backlog = 0
+        self._backlog_at = 0.0
+        self._lock = threading.Lock()
+        self._last_tier = NORMAL
+
+    @contextmanager
+    def llm_call(self):
+        """Count a model call as in flight for the duration of the block"""
+        with self._lock:
+            self.llm_inflight += 1
+        metrics.set_gauge("llm_inflight", self.llm_inflight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.llm_inflight -= 1
+            metrics.set_gauge("llm_inflight", self.llm_inflight)
+
+    @contextmanager
+    def request(self, queued_at=None):
+        """Count a webhook request as in flight for the duration of the block.
+
+        ``queued_at`` is when the request reached the front proxy, if known;
+        the wait until now is averaged into ``request_wait``.
+        """
+        now = time.time()
+        with self._lock:
+            if queued_at is not None:
+                self.request_wait = 0.8 * self.request_wait + 0.2 * max(now - queued_at, 0.0)
+            self.requests_inflight += 1
+            if self.requests_inflight >= self.threads and self._saturated_since is None:
+                self._saturated_since = now
+        metrics.set_gauge("requests_inflight", self.requests_inflight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.requests_inflight -= 1
+                if self.requests_inflight < self.threads:
+                    self._saturated_since = None
+            metrics.set_gauge("requests_inflight", self.requests_inflight)
+
+    def wait(self):
+        """Estimated seconds a new request waits for a thread"""
+        saturated_since = self._saturated_since
+        saturated = time.time() - saturated_since if saturated_since is not None else 0.0
+        return max(self.request_wait, saturated)
+
+    def queue_depth(self):
+        """Job backlog, refreshed at most every ``backlog_interval`` seconds"""
+        if self.backlog is None:
+            return 0
+        now = time.time()
+        if now - self._backlog_at >= self.backlog_interval:
+            self._backlog_at = now
+            try:
+                self._backlog = self.backlog()
+            except Exception as e:
+                print(f"Error reading the job backlog: {e}")
+            metrics.set_gauge("job_backlog", self._backlog)
+        return self._backlog
+
+    def tier(self):
+        """Current degradation tier"""
+        waiting = self.defer_wait and self.wait() >= self.defer_wait
+        if waiting or (self.defer_at and self.queue_depth() >= self.defer_at):
+            tier = DEFER
+        elif self.essential_at and self.llm_inflight >= self.essential_at:
+            tier = ESSENTIAL
+        elif self.cached_at and self.llm_inflight >= self.cached_at:
+            tier = CACHED
+        else:
+            tier = NORMAL
+        if tier != self._last_tier:
+            self._last_tier = tier
+            metrics.set_gauge("admission_tier", TIER_NAMES[tier])
+        return tier
+
+    def at_least(self, tier):
+        """True when the current tier is ``tier`` or more degraded"""
+        current = self.tier()
+        if current >= tier and tier != NORMAL:
+            metrics.increment(f"admission_{TIER_NAMES[tier]}_applied")
+        return current >= tier
+
+
+def parse_request_start(value):
+    """Epoch seconds from an X-Request-Start header ("t=1700000000.123", in s, ms or us), or None"""
+    try:
+        started = float(value.strip().removeprefix("t="))
+    except (AttributeError, ValueError):
+        return None
+    # Proxies send seconds, milliseconds or microseconds
+    while started > 1e11:
+        started /= 1000
+    return started
+
+
+def admission_from_env(backlog=None):
+    """Build the controller configured by ADMISSION_* environment variables"""
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+    # Every request thread and job worker of a process can be waiting on the model
+    llm_callers = threads + int(os.environ.get("JOBS_WORKERS", 4))
+    return AdmissionController(
+        cached_at=int(os.environ.get("ADMISSION_CACHED_LLM_INFLIGHT", max(1, llm_callers // 2))),
+        essential_at=int(os.environ.get("ADMISSION_ESSENTIAL_LLM_INFLIGHT", max(2, llm_callers * 3 // 4))),
+        # Two rounds of work for every request thread in the deployment
+        defer_at=int(os.environ.get("ADMISSION_DEFER_QUEUE_DEPTH", 2 * workers * threads)),
+        defer_wait=float(os.environ.get("ADMISSION_DEFER_WAIT", 5)),
+        threads=threads,
+        backlog=backlog,
+    )
@@ -0,0 +1,222 @@
+"""Course analytics: an append-only event log and an incremental aggregator.
+
+Handlers emit small events (``form_field_filled``, ``lesson_served``,
+``quiz_answered``, ``mentoria_redeemed``) as JSON lines appended to a local
+log shared by all workers. Each event names a ``module`` and a ``step``
+within it (the submodule of a lesson, the question of a quiz, the field of
+the signup form). ``FunnelAggregator`` tails the log from the last offset it
+consumed and keeps, per tenant, event, module and step:
+
+* the distinct students who reached it (the funnel: how many got how far;
+  repeating a lesson or a quiz doesn't count twice) and the number of events
+* a histogram of the time since the student's previous event (where they stall)
+
+The totals only depend on the log, so every worker computes the same ones.
+They are checkpointed next to the log (atomically, at most every
+ANALYTICS_CHECKPOINT_INTERVAL seconds or ANALYTICS_CHECKPOINT_EVENTS events,
+and only by a worker that got further than the checkpoint on disk), so a
+restart only reads the events written since the last checkpoint and queries
+never scan students.
+
+Students are logged as an HMAC of their id keyed with ANALYTICS_SECRET (or a
+random key kept next to the log when it isn't set), so pseudonyms can't be
+reversed by hashing every phone number.
+"""
+import bisect
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import metrics
+
+EVENTS = ("form_field_filled", "lesson_served", "quiz_answered", "mentoria_redeemed")
+
+# Upper bounds (seconds) of the time-to-next-step histogram buckets
+HISTOGRAM_BOUNDS = (10, 30, 60, 300, 900, 3600, 6 * 3600, 24 * 3600, 7 * 24 * 3600)
+HISTOGRAM_LABELS = tuple(f"<={bound}s" for bound in HISTOGRAM_BOUNDS) + (f">{HISTOGRAM_BOUNDS[-1]}s",)
+
+
+def anonymize(student_id, secret):
+    """Stable pseudonymous id, so the log doesn't carry phone numbers"""
+    return hmac.new(secret, student_id.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def load_secret(path):
+    """Pseudonymization key: ANALYTICS_SECRET, or a random one created once at ``path``"""
+    secret = os.environ.get("ANALYTICS_SECRET")
+    if secret:
+        return secret.encode("utf-8")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    with os.fdopen(fd, "wb") as f:
+        secret = os.urandom(32).hex().encode("ascii")
+        f.write(secret)
+    return secret
+
+
+class EventLog:
+    """Append-only JSON-lines event log"""
+
+    def __init__(self, path, secret):
+        self.path = path
+        self.secret = secret
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def emit(self, event, tenant, student_id, module=None, step=None, elapsed=None, **fields):
+        """Append one event; failures are logged and never reach the student"""
+        record = {"ts": round(time.time(), 3), "event": event, "tenant": tenant,
+                  "student": anonymize(student_id, self.secret), "module": module, "step": step,
+                  "elapsed": elapsed}
+        record.update(fields)
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                # One write per line on an O_APPEND descriptor keeps workers' lines whole
+                os.write(self._fd, line)
+            metrics.increment("analytics_events")
+        except OSError as e:
+            print(f"Error writing analytics event: {e}")
+
+
+class FunnelAggregator:
+    """Funnel counts and time-to-next-step histograms maintained from the log"""
+
+    def __init__(self, path, checkpoint_path=None, checkpoint_interval=60.0, checkpoint_events=10000):
+        self.path = path
+        self.checkpoint_path = checkpoint_path or f"{path}.checkpoint.json"
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_events = checkpoint_events
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self.offset = 0
+        self.counts = {}
+        self.students = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._load_checkpoint()
+
+    def _checkpoint_offset(self):
+        """Offset of the checkpoint on disk (its first line), or -1"""
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.loads(f.readline())["offset"]
+        except (OSError, ValueError, KeyError):
+            return -1
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                data = json.loads(f.readline())
+            size = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return
+        # A log truncated or replaced since the checkpoint is re-read from the start
+        if header.get("offset", 0) > size or "students" not in data:
+            return
+        self.offset = header["offset"]
+        self.counts = {tuple(key): count for key, count in data["counts"]}
+        self.students = {tuple(key): set(students) for key, students in data["students"]}
+        self.histograms = {tuple(key): buckets for key, buckets in data["histograms"]}
+
+    def _save_checkpoint(self):
+        data = {
+            "counts": [[list(key), count] for key, count in self.counts.items()],
+            "students": [[list(key), sorted(students)] for key, students in self.students.items()],
+            "histograms": [[list(key), buckets] for key, buckets in self.histograms.items()],
+        }
+        tmp_path = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        try:
+            with open(f"{self.checkpoint_path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another worker may already have saved a later position
+                if self._checkpoint_offset() >= self.offset:
+                    return
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(json.dumps({"offset": self.offset}) + "\n")
+                    f.write(json.dumps(data, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            print(f"Error saving analytics checkpoint: {e}")
+
+    def _apply(self, record):
+        key = (record.get("tenant"), record.get("event"), record.get("module"), record.get("step"))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.students.setdefault(key, set()).add(record.get("student"))
+        elapsed = record.get("elapsed")
+        if elapsed is not None:
+            buckets = self.histograms.setdefault(key, [0] * len(HISTOGRAM_LABELS))
+            buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, elapsed)] += 1
+
+    def refresh(self):
+        """Consume the events appended since the last refresh; returns how many"""
+        with self._lock:
+            try:
+                with open(self.path, "rb") as f:
+                    f.seek(self.offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                return 0
+            # A line still being written is left for the next refresh
+            end = chunk.rfind(b"\n") + 1
+            consumed = 0
+            for line in chunk[:end].splitlines():
+                try:
+                    self._apply(json.loads(line))
+                    consumed += 1
+                except ValueError:
+                    print(f"Error parsing analytics event: {line[:80]!r}")
+            self.offset += end
+            # Rewriting the checkpoint costs all the totals, so it's done now and then
+            self._unsaved += consumed
+            if self._unsaved and (self._unsaved >= self.checkpoint_events
+                                  or time.monotonic() - self._saved_at >= self.checkpoint_interval):
+                self._save_checkpoint()
+                self._unsaved = 0
+                self._saved_at = time.monotonic()
+            return consumed
+
+    def funnel(self, tenant):
+        """Distinct students and event counts for a tenant as {event: {(module, step): (students, events)}}"""
+        self.refresh()
+        result = {}
+        for (event_tenant, event, module, step), count in self.counts.items():
+            if event_tenant == tenant:
+                students = len(self.students.get((event_tenant, event, module, step), ()))
+                result.setdefault(event, {})[(module, step)] = (students, count)
+        return result
+
+    def histogram(self, tenant, event):
+        """Time-to-this-step histograms for one event as {(module, step): counts per HISTOGRAM_LABELS}"""
+        self.refresh()
+        result = {}
+        for (event_tenant, name, module, step), buckets in self.histograms.items():
+            if event_tenant == tenant and name == event:
+                result[(module, step)] = list(buckets)
+        return result
+
+
+def analytics_from_env():
+    """Build the event log and aggregator configured by ANALYTICS_LOG_PATH.
+
+    An empty path disables analytics and returns (None, None).
+    """
+    path = os.environ.get("ANALYTICS_LOG_PATH", "analytics.ndjson")
+    if not path:
+        return None, None
+    aggregator = FunnelAggregator(
+        path,
+        checkpoint_interval=float(os.environ.get("ANALYTICS_CHECKPOINT_INTERVAL", 60)),
+        checkpoint_events=int(os.environ.get("ANALYTICS_CHECKPOINT_EVENTS", 10000)),
+    )
+    return EventLog(path, load_secret(f"{path}.key")), aggregator
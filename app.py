@@ -1,221 +1,233 @@
 import os
+import re
 import time
-import random
-from flask import Flask, request
+import base64
+from contextlib import ExitStack
+from datetime import datetime
+from flask import Flask, Response, request
 from twilio.twiml.messaging_response import MessagingResponse
 from dotenv import load_dotenv
-import google.generativeai as genai
+from cache import CACHES, VersionedCache
+from catalogue import maybe_reload_catalogues
+import prefetch
+from prefetch import prefetcher_from_env
+from llm import cached_model, get_model, is_ready, model_name
+from metering import REPORT_GROUPS, current_student, meter_from_env, report_csv, response_usage
+from prompt_cache import prompt_cache_from_env
+from profiles import ProfileNormalizer, bucket_id, describe
+from quiz import LEGACY_FIELDS, QuestionBank, QuizSession, upgrade_legacy
+from retrieval import format_passages, get_index
+from state_store import fields_match, state_store_from_env
+from analytics import HISTOGRAM_LABELS, analytics_from_env
+from leaderboard import Leaderboard
+from idempotency import BUSY, DONE, MessageDeduplicator
+from admission import CACHED, DEFER, ESSENTIAL, TIER_NAMES, admission_from_env, parse_request_start
+from classifier import parse_quiz_answer
+from commands import CommandDispatcher
+from outbound import sender_from_env
+from cluster import NODE_HEADER, cluster_from_env
+from jobs import INTERACTIVE, NORMAL, queue_from_env
+from admin import AdminBus, require_admin
+from tenants import (all_tenants, configure_quotas, current_catalogue, current_tenant, resolve_tenant, tenant_model,
+                     use_tenant)
+import metrics
+import transcript
+import variation
 
 # --- Initial Configuration ---
 app = Flask(__name__)
 load_dotenv()
 
-# Validate API key
+# The Gemini client is created lazily on first use (see llm.py), so a worker
+# boots quickly and a missing key degrades replies instead of the startup
 if "GOOGLE_API_KEY" not in os.environ:
-    raise ValueError("Google API key (GOOGLE_API_KEY) not configured in .env file")
+    print("Warning: Google API key (GOOGLE_API_KEY) not configured in .env file")
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+# --- Course Content Structure ---
+# Modules and conversation prompts live in data/catalogue.json (one file per
+# course). Each tenant in data/tenants.json points at its catalogue; files are
+# validated on load and hot-reloaded when they change (see catalogue.py).
+for tenant in all_tenants().values():
+    tenant.catalogue
 
-# Initialize Gemini model
-MODEL_NAME = 'models/gemini-2.0-pro-exp-02-05'  # Can be replaced with other AI models
-try:
-    model = genai.GenerativeModel(MODEL_NAME)
-except Exception as e:
-    print(f"Error initializing model: {e}")
-    raise ValueError(f"Could not initialize model '{MODEL_NAME}'. Check if the name is correct and if you have access.") from e
+# Transition messages don't depend on the student, so they are shared per tenant
+transition_cache = VersionedCache("transition", max_entries=256)
 
-# --- Course Content Structure ---
-MODULES = {
-    "introducao": {
-        "titulo": "Introdução ao Empreendedorismo",
-        "submodulos": [
-            "O que é Empreendedorismo?",
-            "Por que Empreender na Universidade?",
-            "Mitos e Verdades sobre Empreender",
-        ],
-        "objetivos": [
-            "Entender o conceito de empreendedorismo.",
-            "Identificar oportunidades de empreender na universidade.",
-            "Desmistificar o empreendedorismo.",
-        ]
-    },
-    "modulo1": {
-        "titulo": "Identificando Oportunidades",
-        "submodulos": [
-            "O que é uma oportunidade de negócio?",
-            "Como identificar problemas e necessidades.",
-            "Análise de mercado e tendências (para a UVV).",
-            "Ferramentas para identificar oportunidades (ex: Canvas).",
-        ],
-        "objetivos": [
-            "Definir o que constitui uma oportunidade de negócio.",
-            "Aprender a identificar problemas que podem ser transformados em negócios.",
-            "Analisar o mercado e identificar tendências relevantes.",
-            "Utilizar ferramentas como o Canvas para modelar oportunidades.",
-        ]
-    },
-    "modulo2": {
-        "titulo": "Desenvolvimento do Modelo de Negócio",
-        "submodulos":[
-            "O que é um modelo de negócio?",
-            "Canvas: Uma ferramenta poderosa.",
-            "Proposta de valor.",
-            "Segmentos de clientes (na UVV).",
-            "Canais de distribuição e comunicação.",
-            "Relacionamento com clientes.",
-            "Fontes de receita.",
-            "Recursos-chave.",
-            "Atividades-chave.",
-            "Parcerias-chave.",
-            "Estrutura de custos.",
-        ],
-        "objetivos": [
-            "Compreender o conceito de modelo de negócio e sua importância.",
-            "Dominar a ferramenta Canvas.",
-            "Definir a proposta de valor do negócio.",
-            "Identificar e segmentar os clientes.",
-            "Escolher os canais de distribuição e comunicação adequados.",
-            "Estabelecer um bom relacionamento com os clientes.",
-            "Definir as fontes de receita do negócio.",
-            "Identificar os recursos, atividades e parcerias chave.",
-            "Analisar a estrutura de custos do negócio.",
-        ]
-    },
-    "modulo3": {
-        "titulo": "Validação e Testes",
-        "submodulos": [
-            "Por que validar é crucial?",
-            "MVP (Minimum Viable Product): O que é e como criar.",
-            "Testando com potenciais clientes (na UVV).",
-            "Coleta e análise de feedback.",
-            "Iteração e ajustes no modelo de negócio.",
-        ],
-        "objetivos": [
-            "Entender a importância da validação do modelo de negócio.",
-            "Aprender a criar um MVP.",
-            "Realizar testes com potenciais clientes.",
-            "Coletar e analisar feedback de forma eficaz.",
-            "Iterar e ajustar o modelo de negócio com base nos resultados.",
-        ]
-    },
-    "mentoria": {
-        "titulo": "Mentoria",
-        "submodulos": [
-            "Como funciona a mentoria",
-            "Preparando para mentoria",
-        ],
-        "objetivos":[
-            "Preparar o aluno para a mentoria.",
-            "Explicar sobre a mentoria."
-        ]
-    },
-    "fim":{
-        "titulo": "Fim",
-        "submodulos": [
-            "Fim do curso"
-        ],
-        "objetivos":[
-            "Finalizar curso."
-        ]
-    }
-}
-
-# --- Conversation Prompts ---
-PROMPTS = {
-    # Greeting and form prompts
-    "saudacao": [
-        "Olá! Sou o assistente do curso de empreendedorismo da UVV, com mais de 50 anos de experiência em negócios, finanças, contabilidade e, claro, startups! 😉 Estou aqui para te guiar nessa jornada. Para começarmos, que tal me contar um pouco sobre você?",
-        "Oi! Pronto para mergulhar no mundo do empreendedorismo? 😊 Sou um especialista em negócios, contabilidade, startups e finanças, com décadas de experiência. Antes de mais nada, gostaria de te conhecer melhor.",
-        "Olá! Bem-vindo(a) ao curso de empreendedorismo da UVV! Sou o seu assistente, um especialista em ajudar jovens empreendedores como você a terem sucesso. Para personalizarmos o curso, preciso de algumas informações suas. 😉",
-    ],
-    "pergunta": [
-        "Para continuarmos, poderia me dizer {pergunta}?",
-        "Agora, me diga: {pergunta}?",
-        "E sobre {pergunta}, o que você me conta?",
-        "Continuando, {pergunta}?",
-        "{pergunta} (Estou curioso! 😊)",
-    ],
-    "agradecimento": [
-        "Ótimo! Obrigado pela informação.",
-        "Perfeito! Anotado.",
-        "Excelente! 👍",
-        "Muito bom! 😊",
-        "Informação valiosa! Obrigado.",
-    ],
-    
-    # Content presentation prompts
-    "introducao_modulo": [
-        "Vamos começar com uma introdução a {submodulo}. O que você acha?",
-        "Que tal começarmos pelo começo? 😉 Vamos falar sobre {submodulo}.",
-        "Preparado para o primeiro passo? Vamos abordar {submodulo}.",
-    ],
-    "apresentacao_conteudo": [
-        "Aqui está um resumo sobre {submodulo}, adaptado para o seu perfil:\n\n{conteudo}",
-        "Vamos explorar {submodulo}. Aqui está o que você precisa saber, considerando seus interesses:\n\n{conteudo}",
-        "Mergulhando em {submodulo}... Preste atenção, pois isso é importante para você:\n\n{conteudo}",
-    ],
-    "pergunta_reflexao": [
-        "E aí, o que você achou de {submodulo}? Alguma dúvida ou insight?",
-        "Pensando sobre {submodulo}, qual a sua opinião sobre isso?",
-        "Com base no que vimos sobre {submodulo}, você consegue pensar em algum exemplo prático?",
-        "Que insights você teve ao aprender sobre {submodulo}?",
-        "Como você poderia aplicar o que aprendeu sobre {submodulo} no seu contexto na UVV?"
-    ],
-    
-    # Quiz prompts
-    "resposta_correta": [
-        "Correto! 🎉 Você ganhou 10 pontos!",
-        "Excelente! ✅ +10 pontos para você!",
-        "Perfeito! 👍 10 pontos adicionados.",
-    ],
-    "resposta_incorreta": [
-        "Não é bem isso... A resposta correta é: {resposta}",
-        "Quase lá! Na verdade, a resposta correta é: {resposta}",
-        "Vamos revisar isso. A resposta correta é: {resposta}",
-    ],
-    
-    # Error messages
-    "erro": [
-        "Desculpe, ocorreu um erro. Vamos tentar novamente?",
-        "Ops! Algo deu errado. Pode repetir, por favor?",
-        "Tive um pequeno problema. Vamos recomeçar?",
-    ]
-}
+# Non-personalized lessons, served instead of personalized ones under load
+lesson_cache = VersionedCache("lesson", max_entries=512)
+
+# With LESSON_MODE=cards lessons are generated as a few short cards sent one
+# per message; "continuar" moves to the next card before the next lesson
+LESSON_MODE = os.environ.get("LESSON_MODE", "full")
+if LESSON_MODE not in ("full", "cards"):
+    raise ValueError(f"Unknown LESSON_MODE '{LESSON_MODE}' (expected 'full' or 'cards')")
+CARD_MAX_CHARS = int(os.environ.get("LESSON_CARD_CHARS", 450))
+
+# Personalized lessons are written for the student's profile bucket (canonical
+# curso/periodo/conhecimento/interesses, see profiles.py) and shared by every
+# student in it, followed by a short note on the student's own name, goals and
+# experience filled in from their profile (no model call); LESSON_PERSONALIZATION=student
+# writes one per student instead
+LESSON_PERSONALIZATION = os.environ.get("LESSON_PERSONALIZATION", "bucket")
+if LESSON_PERSONALIZATION not in ("bucket", "student"):
+    raise ValueError(f"Unknown LESSON_PERSONALIZATION '{LESSON_PERSONALIZATION}' (expected 'bucket' or 'student')")
+bucket_lesson_cache = VersionedCache("bucket_lesson", max_entries=4096)
+
+# Quizzes draw QUIZ_QUESTIONS questions from the module's shared pool once it
+# holds QUIZ_POOL_SIZE of them; until then each quiz is generated and banked
+QUIZ_QUESTIONS = int(os.environ.get("QUIZ_QUESTIONS", 5))
+QUIZ_POOL_SIZE = int(os.environ.get("QUIZ_POOL_SIZE", 15))
+
+# Stable per-student prompt prefixes (PROMPT_PREFIX_* settings, see prompt_cache.py)
+prompt_cache = prompt_cache_from_env(
+    create_remote=lambda prefix, ttl: cached_model(prefix, ttl, current_tenant().model))
+
+# Load-based degradation tiers (ADMISSION_* settings, see admission.py)
+admission = admission_from_env()
 
 # --- Student State Management ---
-students = {}
+# Persistent store with write-behind flushing (STATE_* settings, see state_store.py)
+state_store = state_store_from_env()
+
+# Tenant quotas count in the state database, across every worker (see tenants.py)
+configure_quotas(state_store.path if state_store.durability != "memory" else None)
+
+# Lesson texts referenced from conversation histories (see transcript.py)
+lesson_texts = transcript.LessonTexts(state_store.path if state_store.durability != "memory" else None)
+
+# Quiz questions shared by every student's quiz session (see quiz.py)
+question_bank = QuestionBank(state_store.path if state_store.durability != "memory" else None)
+
+# Raw profile answers -> canonical values, memoized across workers; answers
+# only the model can classify are sent to a background job
+profile_normalizer = ProfileNormalizer(state_store.path if state_store.durability != "memory" else None,
+                                       classify=lambda *args: classify_profile_term(*args),
+                                       defer=lambda *args: defer_profile_term(*args))
+
+# Points ledger and ranking index, one cohort per tenant
+leaderboard = Leaderboard(state_store.path if state_store.durability != "memory" else ":memory:")
+
+# Seen-set of Twilio MessageSids, shared by workers through the state database
+deduplicator = MessageDeduplicator(
+    state_store.path if state_store.durability != "memory" else None,
+    ttl=float(os.environ.get("DEDUP_TTL", 3600)),
+    wait=float(os.environ.get("DEDUP_WAIT", 10)),
+    # A claim left by a worker that died is taken over after about the request timeout
+    lease=float(os.environ.get("DEDUP_LEASE", os.environ.get("GUNICORN_TIMEOUT", 60))),
+)
+
+# Token/latency metering and rolling LLM budgets (LLM_* settings, see metering.py)
+usage_meter = meter_from_env(state_store.path if state_store.durability != "memory" else None)
+
+# Out-of-band replies through the Twilio REST API (TWILIO_*/OUTBOUND_* settings,
+# see outbound.py); without credentials deferred replies wait for the next turn
+outbound = sender_from_env(on_status=lambda *args: record_delivery_status(*args),
+                           path=state_store.path if state_store.durability != "memory" else None)
+
+# Admin operations are replayed by every worker (ADMIN_* settings, see admin.py)
+admin_bus = AdminBus(state_store.path if state_store.durability != "memory" else None,
+                     sync_interval=float(os.environ.get("ADMIN_SYNC_INTERVAL", 1.0)))
+
+# Sticky per-student routing across nodes (CLUSTER_* settings, see cluster.py);
+# the node owning a student's number handles all of their turns
+cluster = cluster_from_env(state_store.path if state_store.durability != "memory" else None,
+                           on_change=lambda previous, ring: release_moved_students(previous, ring))
+
+# Durable background jobs (JOBS_* settings, see jobs.py); jobs that change a
+# student's state stay on the node that owns the student
+job_queue = queue_from_env(state_store.path if state_store.durability != "memory" else None,
+                           affinity=cluster.node_id if cluster is not None else None)
+
+# Waiting interactive jobs (deferred messages) count as load for admission
+admission.backlog = job_queue.backlog
+
+# Background generation of the next lesson (PREFETCH_* settings cap the spend)
+prefetcher = prefetcher_from_env(job_queue, state_store.path if state_store.durability != "memory" else None)
+
+# Course analytics: append-only event log and funnel aggregator (see analytics.py)
+event_log, funnel_aggregator = analytics_from_env()
+
+def new_student_state(student_id):
+    """Initial state for a student who hasn't written before"""
+    return {
+        "student_id": student_id,
+        "form_completed": False,
+        "profile": {
+            "nome": None,
+            "curso": None,
+            "periodo": None,
+            "experiencia": None,
+            "objetivos": None,
+            "conhecimento": None,
+            "interesses": None,
+        },
+        "conversation_history": [],
+        "current_module": "introducao",
+        "current_submodule": 0,
+        "context": "form",
+        "waiting_response": None,
+        "points": 0,
+        "quiz": None,
+        "variation": {},
+    }
 
 def get_student_state(phone_number):
-    """Initialize or retrieve student state"""
-    if phone_number not in students:
-        students[phone_number] = {
-            "form_completed": False,
-            "profile": {
-                "nome": None,
-                "curso": None,
-                "periodo": None,
-                "experiencia": None,
-                "objetivos": None,
-                "conhecimento": None,
-                "interesses": None,
-            },
-            "conversation_history": [],
-            "current_module": "introducao",
-            "current_submodule": 0,
-            "context": "form",
-            "waiting_response": None,
-            "points": 0,
-            "quiz_active": False,
-            "quiz_answers": [],
-            "current_quiz": None,
-        }
-    return students[phone_number]
+    """Initialize or retrieve student state for the current tenant"""
+    student_id = current_tenant().scoped(phone_number)
+    return state_store.get_or_create(student_id, lambda: new_student_state(student_id))
 
 # --- Helper Functions ---
 
+def track_event(state, event, module=None, step=None, **fields):
+    """Emit an analytics event with the time since the student's previous one"""
+    if event_log is None:
+        return
+    now = time.time()
+    last = state.get("last_event_at")
+    state["last_event_at"] = now
+    elapsed = round(now - last, 1) if last else None
+    event_log.emit(event, current_tenant().id, state["student_id"], module, step, elapsed, **fields)
+
+def generate_text(prompt, model=None, site="other", module=None):
+    """Run a model call for the current tenant and return the response text.
+
+    ``model`` overrides the tenant's client, e.g. one bound to a cached prefix;
+    otherwise students over their token budget get LLM_BUDGET_MODEL when set.
+    Tokens and latency are metered per student, call site and module.
+    """
+    tenant = current_tenant()
+    student_id = current_student.get()
+    with admission.llm_call():
+        client = tenant_model()
+        used_model = tenant.model or model_name()
+        budget_model = os.environ.get("LLM_BUDGET_MODEL")
+        if model is None and budget_model and usage_meter.over_budget(student_id):
+            client, used_model = get_model(budget_model), budget_model
+        started = time.perf_counter()
+        response = (model or client).generate_content(prompt)
+        latency = time.perf_counter() - started
+    text = response.text
+    input_tokens, output_tokens = response_usage(prompt, response, text)
+    try:
+        usage_meter.record(tenant.id, student_id, site, module, used_model, input_tokens, output_tokens, latency)
+    except Exception as e:
+        print(f"Error recording LLM usage: {e}")
+    return text
+
+def reduced(tier):
+    """True when load, or the current student's LLM budget, calls for a cheaper tier"""
+    if admission.at_least(tier):
+        return True
+    if tier in (CACHED, ESSENTIAL) and usage_meter.over_budget(current_student.get()):
+        metrics.increment(f"llm_budget_{TIER_NAMES[tier]}_applied")
+        return True
+    return False
+
 def generate_master_prompt():
     """Generate the master prompt that defines the assistant's persona"""
+    persona = current_tenant().persona
+    if persona:
+        return persona
     return """
     Você é um assistente virtual especialista em empreendedorismo, com mais de 50 anos de experiência em:
     * Finanças: investimentos, gestão financeira, análise de viabilidade.
@@ -272,10 +284,10 @@ def extract_profile_info(conversation_history):
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_text(prompt, site="profile", module="form")
         # Parse the response into a dictionary
         info = {}
-        for line in response.text.splitlines():
+        for line in response.splitlines():
             if ":" in line:
                 key, value = line.split(":", 1)
                 key = key.strip()
@@ -293,12 +305,14 @@ def collect_initial_info(message, state):
     
     # Add message to conversation history
     conversation_history = state["conversation_history"]
-    conversation_history.append(f"Aluno: {message}")
+    conversation_history.append(transcript.student(message))
     
     # Extract profile info from conversation
-    profile_info = extract_profile_info("\n".join(conversation_history))
+    profile_info = extract_profile_info("\n".join(render_history(conversation_history)))
     for key, value in profile_info.items():
         if value is not None:
+            if not state["profile"].get(key):
+                track_event(state, "form_field_filled", "form", key)
             state["profile"][key] = value
     
     # Determine which information is still missing
@@ -321,6 +335,7 @@ def collect_initial_info(message, state):
     # If all information is collected, move to content presentation
     if not missing_info:
         state["form_completed"] = True
+        state["profile_bucket"] = bucket_id(profile_normalizer.normalize_profile(state["profile"]))
         state["context"] = "presenting_content"
         
         # Generate AI response for form completion
@@ -338,8 +353,12 @@ def collect_initial_info(message, state):
         """
         
         try:
-            completion_message = model.generate_content(prompt).text
-            conversation_history.append(f"Assistente: {completion_message}")
+            if reduced(ESSENTIAL):
+                # Under heavy load (or over budget) the personalized welcome is skipped
+                completion_message = "Ótimo! Agora que conheço você melhor, vamos começar o curso!"
+            else:
+                completion_message = generate_text(prompt, site="form_completion", module="form")
+            conversation_history.append(transcript.assistant(completion_message))
             
             # Get first content after form completion
             content_messages = present_content(state)
@@ -350,17 +369,68 @@ def collect_initial_info(message, state):
     
     # If still collecting information, ask the next question
     next_question = missing_info[0]
-    prompt_template = random.choice(PROMPTS["pergunta"])
+    prompt_template = variation.choose(state, "pergunta", current_catalogue().prompts["pergunta"])
     prompt = prompt_template.format(pergunta=next_question)
     
-    conversation_history.append(f"Assistente: {prompt}")
+    conversation_history.append(transcript.assistant(prompt))
     return [prompt]
 
-def generate_module_content(module_name, submodule_index, student_profile):
+def classify_profile_term(field, raw, options):
+    """Ask the model which canonical value(s) a profile answer means"""
+    if reduced(ESSENTIAL):
+        raise RuntimeError("model calls are reduced right now")
+    choice = "até 2 das opções" if field == "interesses" else "uma das opções"
+    prompt = f"""
+    Classifique a resposta de um aluno sobre "{field}" em {choice} a seguir: {", ".join(options)}.
+    
+    Resposta do aluno: {raw}
+    
+    Responda apenas com as opções escolhidas, exatamente como escritas, ou "nenhuma".
+    """
+    return generate_text(prompt, site="profile_bucket", module="form")
+
+def defer_profile_term(field, raw):
+    """Queue the model classification of a profile answer for the current student"""
+    student_id = current_student.get()
+    job_queue.enqueue("profile_term", {"tenant": current_tenant().id, "student_id": student_id,
+                                       "field": field, "raw": raw},
+                      priority=NORMAL, dedupe_key=f"profile_term:{student_id}:{field}")
+
+@job_queue.handler("profile_term", concurrency=int(os.environ.get("PROFILE_TERM_WORKERS", 2)),
+                   timeout=60, max_attempts=3, backoff=10)
+def run_profile_term_job(payload):
+    """Classify a profile answer with the model and re-bucket the student"""
+    tenant = all_tenants().get(payload["tenant"])
+    if tenant is None:
+        return
+    token = current_student.set(payload["student_id"])
+    try:
+        with use_tenant(tenant):
+            profile_normalizer.classify_term(payload["field"], payload["raw"])
+            if payload["student_id"] is None:
+                return
+            with state_store.turn(payload["student_id"]):
+                state = state_store.get(payload["student_id"])
+                if state is not None and state.get("form_completed"):
+                    state["profile_bucket"] = bucket_id(profile_normalizer.normalize_profile(state["profile"]))
+    finally:
+        current_student.reset(token)
+
+def course_notes(query, module=None, submodule=None, prefer_module=None):
+    """Top-k passages of the course notes index for a prompt ("" when unavailable)"""
+    top_k = int(os.environ.get("RETRIEVAL_TOP_K", 3))
+    index = get_index(current_catalogue()) if top_k > 0 else None
+    if index is None:
+        return ""
+    passages = index.search(query, top_k, module=module, submodule=submodule, prefer_module=prefer_module)
+    metrics.increment("retrieval_hits" if passages else "retrieval_misses")
+    return format_passages(passages)
+
+def generate_module_content(module_name, submodule_index, student_profile, fallback=True):
     """Generate content for a specific submodule using Gemini"""
     
     # Get module and submodule info
-    module = MODULES[module_name]
+    module = current_catalogue().modules[module_name]
     module_title = module["titulo"]
     
     # Check if submodule exists
@@ -368,104 +438,297 @@ def generate_module_content(module_name, submodule_index, student_profile):
         return None
     
     submodule = module["submodulos"][submodule_index]
+    notes = course_notes(f"{submodule} {module_title}", module=module_name, submodule=submodule_index)
+    notes_section = f"""
+    Baseie o conteúdo neste material do curso (sem copiá-lo literalmente):
+    {notes}
+    """ if notes else ""
+    
+    if LESSON_MODE == "cards":
+        length = f"""Ser dividido em 3 a 5 cards curtos, com no máximo {CARD_MAX_CHARS} caracteres cada,
+       separados por uma linha contendo apenas "---". Cada card deve fazer sentido sozinho
+       (uma ideia por card), sem título"""
+        reflection = "Terminar o último card com uma pergunta reflexiva"
+    else:
+        length = "Ser conciso (máximo 1000 caracteres)"
+        reflection = "Incluir 1-2 perguntas reflexivas ao final"
     
     prompt = f"""
     {generate_master_prompt()}
     
     Gere conteúdo educativo para o tópico "{submodule}" que faz parte do módulo "{module_title}".
-    
+    {notes_section}
     Perfil do aluno:
     {student_profile}
     
     O conteúdo deve:
-    1. Ser conciso (máximo 1000 caracteres)
+    1. {length}
     2. Ser didático e envolvente
     3. Incluir exemplos práticos relevantes para estudantes da UVV
     4. Ser personalizado para o perfil do aluno
     5. Usar emojis ocasionalmente para tornar o texto mais expressivo
-    6. Incluir 1-2 perguntas reflexivas ao final
+    6. {reflection}
     
     NÃO use listas longas ou muitos tópicos. Foque em explicar de forma fluida e conversacional.
     """
     
     try:
-        content = model.generate_content(prompt).text
+        content = generate_text(prompt, site="lesson", module=module_name)
         return content
     except Exception as e:
+        if not fallback:
+            raise
         print(f"Error generating module content: {e}")
         return f"Desculpe, tive um problema ao gerar o conteúdo sobre {submodule}. Vamos tentar novamente?"
 
-def present_content(state):
+def generate_transition_message(finished_module, next_module):
+    """Generate the motivational message shown when a module is completed"""
+    catalogue = current_catalogue()
+    cache_key = (current_tenant().id, finished_module, next_module)
+    cached = transition_cache.get(cache_key, catalogue.version)
+    if cached is not None:
+        return cached
+    
+    finished_title = catalogue.modules[finished_module]["titulo"]
+    next_title = catalogue.modules[next_module]["titulo"]
+    static_message = f"Parabéns! Você completou o módulo \"{finished_title}\"! Agora vamos para \"{next_title}\"."
+    if reduced(ESSENTIAL):
+        return static_message
+    
+    prompt = f"""
+    {generate_master_prompt()}
+    
+    Gere uma mensagem curta (máximo 2 frases) de transição para informar ao aluno que completou o 
+    módulo "{finished_title}" e agora vai iniciar o módulo "{next_title}".
+    
+    A mensagem deve ser motivadora e entusiasmada.
+    """
+    
+    try:
+        message = generate_text(prompt, site="transition", module=finished_module)
+        transition_cache.set(cache_key, catalogue.version, message)
+        return message
+    except Exception as e:
+        print(f"Error generating transition message: {e}")
+        return static_message
+
+def present_content(state, transitions=()):
     """Present current module content to the student"""
-    module_name = state["current_module"]
-    submodule_index = state["current_submodule"]
+    catalogue = current_catalogue()
+    
+    # Resolve the current position, crossing any finished modules
+    lesson, crossed = catalogue.index.resolve(state["current_module"], state["current_submodule"])
+    messages = [generate_transition_message(finished, following)
+                for finished, following in list(transitions) + crossed]
     
-    # Check if we've reached the end of the module
-    if module_name == "fim":
+    # Check if we've reached the end of the course
+    if lesson is None:
+        state["current_module"] = catalogue.terminal_module
+        state["current_submodule"] = 0
         state["context"] = "course_completed"
-        return ["🎓 Parabéns! Você completou o curso de empreendedorismo! Agora você está preparado para iniciar sua jornada empreendedora. Se tiver dúvidas ou quiser discutir suas ideias, digite 'mentoria' para solicitar uma sessão."]
+        return messages + ["🎓 Parabéns! Você completou o curso de empreendedorismo! Agora você está preparado para iniciar sua jornada empreendedora. Se tiver dúvidas ou quiser discutir suas ideias, digite 'mentoria' para solicitar uma sessão."]
     
-    module = MODULES[module_name]
+    module_name = lesson.module
+    submodule_index = lesson.submodule
+    state["current_module"] = module_name
+    state["current_submodule"] = submodule_index
+    module = catalogue.modules[module_name]
     
-    # Check if we've reached the end of submodules in this module
-    if submodule_index >= len(module["submodulos"]):
-        # Move to the next module
-        module_order = ["introducao", "modulo1", "modulo2", "modulo3", "mentoria", "fim"]
-        current_index = module_order.index(module_name)
-        
-        if current_index + 1 < len(module_order):
-            # Move to next module
-            next_module = module_order[current_index + 1]
-            state["current_module"] = next_module
-            state["current_submodule"] = 0
-            
-            # Generate transition message
-            prompt = f"""
-            {generate_master_prompt()}
-            
-            Gere uma mensagem curta (máximo 2 frases) de transição para informar ao aluno que completou o 
-            módulo "{module["titulo"]}" e agora vai iniciar o módulo "{MODULES[next_module]["titulo"]}".
-            
-            A mensagem deve ser motivadora e entusiasmada.
-            """
-            
-            try:
-                transition_message = model.generate_content(prompt).text
-                return [transition_message] + present_content(state)
-            except Exception as e:
-                print(f"Error generating transition message: {e}")
-                transition_message = f"Parabéns! Você completou o módulo \"{module['titulo']}\"! Agora vamos para \"{MODULES[next_module]['titulo']}\"."
-                return [transition_message] + present_content(state)
+    # Use the prefetched lesson when available, otherwise generate it now
+    submodule = module["submodulos"][submodule_index]
+    content = prefetcher.take(state["student_id"], (catalogue.version, module_name, submodule_index))
+    source = "prefetch"
+    if content is None:
+        if reduced(CACHED):
+            content = shared_lesson_content(module_name, submodule_index)
+            source = "shared"
         else:
-            # End of course
-            state["context"] = "course_completed"
-            return ["🎓 Parabéns! Você completou o curso de empreendedorismo! Se precisar de mais orientações, estou à disposição."]
+            content = personalized_lesson_content(module_name, submodule_index, state["profile"])
+            source = "generated"
     
-    # Generate content for the current submodule
-    submodule = module["submodulos"][submodule_index]
-    content = generate_module_content(module_name, submodule_index, state["profile"])
+    state["waiting_response"] = None
+    track_event(state, "lesson_served", module_name, submodule_index, source=source)
+    
+    # Start generating the next lesson while the student reads this one
+    prefetch_next_lesson(state, lesson, catalogue)
+    
+    if LESSON_MODE == "cards":
+        # Cards are stored once by content, so shared lessons share their cards
+        cards = [lesson_texts.intern(card) for card in split_cards(content)]
+        state["lesson_cards"] = {"lesson": [module_name, submodule_index], "cards": cards, "next": 0}
+        return messages + present_next_card(state)
     
     # Format the message
-    presentation_template = random.choice(PROMPTS["apresentacao_conteudo"])
+    presentation_template = variation.choose(state, "apresentacao_conteudo", catalogue.prompts["apresentacao_conteudo"])
     presentation = presentation_template.format(submodulo=submodule, conteudo=content)
     
     # Add reflection question
-    reflection_template = random.choice(PROMPTS["pergunta_reflexao"])
+    reflection_template = variation.choose(state, "pergunta_reflexao", catalogue.prompts["pergunta_reflexao"])
     reflection = reflection_template.format(submodulo=submodule)
     
     # Format the message with bold title
     message = f"*{module['titulo']} - {submodule}*\n\n{presentation}\n\n{reflection}\n\nDigite 'continuar' quando quiser avançar para o próximo conteúdo. Fique a vontade para realizar qualquer pergunta se ainda não estiver pronto para avançar"
     
-    # Update state
-    state["waiting_response"] = None
-    state["conversation_history"].append(f"Assistente: {message}")
+    # Only a reference to the lesson text goes into the history, not the template around it
+    state["conversation_history"].append(transcript.lesson(module_name, submodule_index, lesson_texts.intern(content)))
     
     # Return formatted message
-    return [message]
+    return messages + [message]
+
+def split_cards(content):
+    """Split a lesson into cards on "---" lines, regrouping paragraphs when the model didn't"""
+    cards = [card.strip() for card in re.split(r"^\s*-{3,}\s*$", content, flags=re.MULTILINE) if card.strip()]
+    if len(cards) > 1 and all(len(card) <= CARD_MAX_CHARS * 1.5 for card in cards):
+        return cards
+    grouped = []
+    for paragraph in (p.strip() for card in cards for p in re.split(r"\n\s*\n", card) if p.strip()):
+        if grouped and len(grouped[-1]) + len(paragraph) + 2 <= CARD_MAX_CHARS:
+            grouped[-1] += "\n\n" + paragraph
+        else:
+            grouped.append(paragraph)
+    return grouped or [content]
+
+def present_next_card(state):
+    """Send the next card of the current lesson"""
+    deck = state["lesson_cards"]
+    module_name, submodule_index = deck["lesson"]
+    position = deck["next"]
+    text_id = deck["cards"][position]
+    deck["next"] = position + 1
+    module = current_catalogue().modules[module_name]
+    
+    card = lesson_texts.get(text_id)
+    if position == 0:
+        card = f"*{module['titulo']} - {module['submodulos'][submodule_index]}*\n\n{card}"
+    if position + 1 < len(deck["cards"]):
+        footer = f"({position + 1}/{len(deck['cards'])}) Digite 'continuar' para seguir."
+    else:
+        footer = "Digite 'continuar' quando quiser avançar para o próximo conteúdo. Fique a vontade para realizar qualquer pergunta se ainda não estiver pronto para avançar"
+    
+    state["conversation_history"].append(transcript.lesson(module_name, submodule_index, text_id))
+    metrics.increment("lesson_cards_served")
+    return [f"{card}\n\n{footer}"]
+
+def shared_lesson_content(module_name, submodule_index):
+    """Return the non-personalized version of a lesson, generating it once per catalogue version"""
+    catalogue = current_catalogue()
+    cache_key = (current_tenant().id, module_name, submodule_index)
+    content = lesson_cache.get(cache_key, catalogue.version)
+    if content is None:
+        try:
+            content = generate_module_content(module_name, submodule_index,
+                                              "Perfil geral de universitário da UVV", fallback=False)
+        except Exception as e:
+            print(f"Error generating shared lesson: {e}")
+            return generate_module_content(module_name, submodule_index, None)
+        lesson_cache.set(cache_key, catalogue.version, content)
+    return content
+
+def personalized_lesson_content(module_name, submodule_index, profile, fallback=True):
+    """Return a lesson personalized for a profile, generated once per profile bucket and catalogue version"""
+    if LESSON_PERSONALIZATION == "student":
+        return generate_module_content(module_name, submodule_index, profile, fallback)
+    content = bucket_lesson_content(module_name, submodule_index, profile, fallback)
+    # The bucket only knows curso/periodo/conhecimento/interesses; the rest stays out of the shared lesson
+    note = student_note(module_name, submodule_index, profile)
+    if note:
+        separator = "\n\n---\n\n" if LESSON_MODE == "cards" else "\n\n"
+        content = f"{content}{separator}{note}"
+    return content
+
+def bucket_lesson_content(module_name, submodule_index, profile, fallback=True):
+    """Return the lesson shared by a profile bucket, generated once per catalogue version"""
+    canonical = profile_normalizer.normalize_profile(profile)
+    catalogue = current_catalogue()
+    cache_key = (current_tenant().id, bucket_id(canonical), module_name, submodule_index)
+    content = bucket_lesson_cache.get(cache_key, catalogue.version)
+    if content is None:
+        try:
+            content = generate_module_content(module_name, submodule_index, describe(canonical), fallback=False)
+        except Exception as e:
+            if not fallback:
+                raise
+            print(f"Error generating bucket lesson: {e}")
+            return generate_module_content(module_name, submodule_index, None)
+        bucket_lesson_cache.set(cache_key, catalogue.version, content)
+    else:
+        metrics.increment("bucket_lesson_shared")
+    return content
+
+def student_note(module_name, submodule_index, profile):
+    """A sentence or two tying a shared lesson to the student's name, goals and experience ("" when skipped)"""
+    # Filled from the profile without a model call, so sharing the lesson stays free per student
+    nome, objetivos, experiencia = (str(profile.get(key) or "").strip().rstrip(".")
+                                    for key in ("nome", "objetivos", "experiencia"))
+    if not (objetivos or experiencia):
+        return ""
+    topic = current_catalogue().modules[module_name]["submodulos"][submodule_index]
+    greeting = f"{nome.split()[0]}, " if nome else ""
+    if objetivos:
+        sentences = [f"{greeting}pense em como \"{topic}\" ajuda no seu objetivo: {objetivos}."]
+    else:
+        sentences = [f"{greeting}pense em como aplicar \"{topic}\" no que você já faz."]
+    if experiencia:
+        sentences.append(f"Sua experiência ({experiencia}) é um bom ponto de partida.")
+    note = " ".join(sentences)
+    return note[0].upper() + note[1:]
+
+def prefetch_next_lesson(state, lesson, catalogue):
+    """Speculatively generate the lesson (and transitions) after the current one"""
+    # Speculative work is the first thing dropped under load or over budget
+    if reduced(CACHED):
+        return
+    following, transitions = catalogue.index.advance(lesson.module, lesson.submodule)
+    if following is None:
+        return
+    prefetcher.schedule(state["student_id"], (catalogue.version, following.module, following.submodule),
+                        {"tenant": current_tenant().id, "profile": dict(state["profile"]),
+                         "transitions": [list(transition) for transition in transitions]})
+
+@job_queue.handler(prefetch.JOB_TYPE, concurrency=int(os.environ.get("PREFETCH_WORKERS", 2)),
+                   timeout=120, max_attempts=2, backoff=10)
+def run_prefetch_job(payload):
+    """Generate a prefetched lesson (and the transition messages before it)"""
+    tenant = all_tenants().get(payload["tenant"])
+    version, module_name, submodule_index = payload["key"]
+    if tenant is None or tenant.catalogue.version != version:
+        metrics.increment("prefetch_stale")
+        return
+    token = current_student.set(payload["student_id"])
+    try:
+        with use_tenant(tenant):
+            # Transition messages land in the shared transition cache
+            for finished, next_module in payload["transitions"]:
+                generate_transition_message(finished, next_module)
+            content = personalized_lesson_content(module_name, submodule_index, payload["profile"], fallback=False)
+    finally:
+        current_student.reset(token)
+    prefetcher.store(payload["student_id"], payload["key"], content)
+
+def advance_content(state, steps=1):
+    """Move the student forward through the course and present the new lesson"""
+    # An unfinished quiz belongs to the lesson being left
+    leave_quiz(state)
+    # Finish the cards of the current lesson first
+    deck = state.get("lesson_cards")
+    if (steps == 1 and deck and deck["next"] < len(deck["cards"])
+            and deck["lesson"] == [state["current_module"], state["current_submodule"]]):
+        state["context"] = "presenting_content"
+        return present_next_card(state)
+    catalogue = current_catalogue()
+    lesson, transitions = catalogue.index.advance(state["current_module"], state["current_submodule"], steps)
+    if lesson is None:
+        state["current_module"] = catalogue.terminal_module
+        state["current_submodule"] = 0
+    else:
+        state["current_module"] = lesson.module
+        state["current_submodule"] = lesson.submodule
+    state["context"] = "presenting_content"
+    return present_content(state, transitions)
 
 def generate_quiz(module_name):
     """Generate a quiz for the specified module"""
-    module = MODULES[module_name]
+    module = current_catalogue().modules[module_name]
     
     prompt = f"""
     Crie um quiz de 5 perguntas de múltipla escolha sobre o módulo "{module['titulo']}" para um curso de empreendedorismo.
@@ -491,7 +754,7 @@ def generate_quiz(module_name):
     """
     
     try:
-        response = model.generate_content(prompt).text
+        response = generate_text(prompt, site="quiz", module=module_name)
         
         # Parse quiz data
         quiz = []
@@ -536,75 +799,133 @@ def generate_quiz(module_name):
         print(f"Error generating quiz: {e}")
         return None
 
+def quiz_pool(module_name):
+    """Question bank pool of a module in the current tenant's catalogue"""
+    return f"{current_tenant().id}:{module_name}:{current_catalogue().version}"
+
+def quiz_session(state):
+    """The student's quiz in progress, or None"""
+    if "current_quiz" in state:
+        # State saved before quiz sessions: bank its questions once
+        state["quiz"] = upgrade_legacy(state, question_bank, quiz_pool(state["current_module"]))
+    return QuizSession.from_state(state.get("quiz"))
+
+def quiz_question(session):
+    """Current question of a session (None if it's missing from the bank)"""
+    return question_bank.get(session.current_id())
+
+def format_question(question):
+    """Question text followed by its options"""
+    return f"{question['question']}\n" + "\n".join(question["options"])
+
+def start_quiz(state):
+    """Draw (or generate) a quiz for the current module and open a session"""
+    module_name = state["current_module"]
+    pool = quiz_pool(module_name)
+    # Under load any pool big enough for one quiz will do
+    banked = question_bank.pool_size(pool)
+    question_ids = []
+    if banked >= QUIZ_POOL_SIZE or (banked >= QUIZ_QUESTIONS and reduced(CACHED)):
+        question_ids = question_bank.draw(pool, QUIZ_QUESTIONS)
+    if question_ids:
+        metrics.increment("quiz_bank_hit")
+    else:
+        quiz = generate_quiz(module_name)
+        if not quiz:
+            return None
+        question_ids = [question_bank.add(pool, question) for question in quiz]
+        metrics.increment("quiz_bank_miss")
+    session = QuizSession(module_name, question_ids)
+    state["quiz"] = session.to_state()
+    state["context"] = "quiz"
+    return session
+
 def handle_quiz_response(message, state):
     """Process a student's response to a quiz question"""
-    quiz = state["current_quiz"]
-    question_index = len(state["quiz_answers"])
-    
-    # Check if response is valid (a, b, c, or d)
-    student_answer = message.lower().strip()
-    if student_answer not in ['a', 'b', 'c', 'd']:
+    session = quiz_session(state)
+    question = quiz_question(session) if session else None
+    if question is None:
+        leave_quiz(state)
+        return ["Não encontrei o seu quiz. Digite 'quiz' para começar um novo."]
+    
+    # Accept "b", "B)", "letra c" or the option text itself
+    student_answer = parse_quiz_answer(message, question["options"])
+    if student_answer is None:
         return ["Por favor, responda com a letra da alternativa (a, b, c ou d)."]
     
-    current_question = quiz[question_index]
-    correct_answer = current_question["correct_answer"]
-    
-    # Add answer to state
-    state["quiz_answers"].append(student_answer)
+    correct_answer = question["correct_answer"]
+    question_index = session.position
+    seconds = session.answer(student_answer, student_answer == correct_answer)
+    state["quiz"] = session.to_state()
+    track_event(state, "quiz_answered", session.module, question_index,
+                correct=student_answer == correct_answer, seconds=seconds)
     
     # Check if correct
     if student_answer == correct_answer:
         state["points"] += 10
-        feedback = random.choice(PROMPTS["resposta_correta"])
+        leaderboard.record(current_tenant().id, state["student_id"], 10, "quiz")
+        feedback = variation.choose(state, "resposta_correta", current_catalogue().prompts["resposta_correta"])
     else:
-        feedback = random.choice(PROMPTS["resposta_incorreta"]).format(resposta=correct_answer)
+        feedback = variation.choose(state, "resposta_incorreta", current_catalogue().prompts["resposta_incorreta"]).format(resposta=correct_answer)
     
     # Check if quiz is complete
-    if len(state["quiz_answers"]) >= len(quiz):
-        # Quiz completed
-        state["quiz_active"] = False
-        state["quiz_answers"] = []
-        state["current_quiz"] = None
-        
-        # Move to next module
-        current_submodule = state["current_submodule"]
-        state["current_submodule"] = current_submodule + 1
-        state["context"] = "presenting_content"
-        
-        completion_message = f"{feedback}\n\n🎯 Quiz concluído! Você tem agora {state['points']} pontos."
-        
-        # Continue to next content
-        return [completion_message] + present_content(state)
+    if session.finished:
+        # The quiz doesn't move the lesson position; the student picks up where they were
+        leave_quiz(state)
+        return [f"{feedback}\n\n🎯 Quiz concluído! Você acertou {session.correct} de {len(session.question_ids)} "
+                f"e tem agora {state['points']} pontos.\n\nDigite 'continuar' para seguir com o conteúdo."]
     
     # Present next question
-    next_question_index = len(state["quiz_answers"])
-    next_question = quiz[next_question_index]
-    
-    question_text = next_question["question"]
-    options_text = "\n".join(next_question["options"])
-    
-    return [f"{feedback}\n\n*Próxima pergunta:*\n\n{question_text}\n{options_text}"]
+    next_question = quiz_question(session)
+    if next_question is None:
+        leave_quiz(state)
+        return [f"{feedback}\n\nNão consegui carregar a próxima pergunta. Digite 'quiz' para começar um novo."]
+    return [f"{feedback}\n\n*Próxima pergunta:*\n\n{format_question(next_question)}"]
 
-def process_free_interaction(message, state):
-    """Handle free interaction with the AI assistant"""
-    conversation_history = "\n".join(state["conversation_history"])
-    
-    prompt = f"""
-    {generate_master_prompt()}
+def render_history(entries):
+    """Render compact history entries as prompt lines"""
+    return transcript.render(entries, lesson_texts, current_catalogue())
+
+def render_prompt_prefix(persona, profile, history):
+    """Render the part of the free-interaction prompt that is stable across turns"""
+    conversation_history = "\n".join(render_history(history))
+    return f"""
+    {persona}
     
-    Responda à mensagem do aluno abaixo com base no contexto da conversa e no perfil do aluno.
+    Responda à mensagem do aluno com base no contexto da conversa e no perfil do aluno.
     
     Perfil do aluno:
-    {state["profile"]}
+    {profile}
     
+    Contexto da conversa:
+    {conversation_history}
+    """
+
+def process_free_interaction(message, state):
+    """Handle free interaction with the AI assistant"""
+    persona = generate_master_prompt()
+    history = list(state["conversation_history"])
+    fingerprint = prompt_cache.fingerprint(persona, state["profile"], state.get("summary"))
+    # Only the most recent turns are kept; course notes ground the answer instead
+    window = int(os.environ.get("PROMPT_HISTORY_TURNS", 20))
+    prefix = prompt_cache.get(state["student_id"], fingerprint, history,
+                              lambda checkpoint: render_prompt_prefix(
+                                  persona, state["profile"], history[max(checkpoint - window, 0):checkpoint]))
+    recent_history = "\n".join(render_history(history[prefix.checkpoint:]))
+    notes = course_notes(message, prefer_module=state["current_module"])
+    notes_section = f"""
+    Material do curso relacionado à mensagem:
+    {notes}
+    """ if notes else ""
+    
+    suffix = f"""
+    {recent_history}
+    {notes_section}
     Módulo atual: {state["current_module"]}
     Submódulo atual: {state["current_submodule"]}
     
     Pontos do aluno: {state["points"]}
     
-    Contexto da conversa:
-    {conversation_history}
-    
     Mensagem do aluno: {message}
     
     Sua resposta deve ser:
@@ -613,103 +934,282 @@ def process_free_interaction(message, state):
     3. Útil e informativa
     4. Alinhada com o módulo atual do curso
     """
+    # A server-side cached prefix is already on the model; otherwise send it
+    # along (students over budget go to the cheaper model with the full prompt)
+    remote = prefix.model if not usage_meter.over_budget(state["student_id"]) else None
+    prompt = suffix if remote is not None else prefix.text + suffix
     
     try:
-        response = model.generate_content(prompt).text
-        state["conversation_history"].append(f"Aluno: {message}")
-        state["conversation_history"].append(f"Assistente: {response}")
+        response = generate_text(prompt, remote, site="free_interaction", module=state["current_module"])
+        state["conversation_history"].append(transcript.student(message))
+        state["conversation_history"].append(transcript.assistant(response))
         return [response]
     except Exception as e:
         print(f"Error in free interaction: {e}")
-        return [random.choice(PROMPTS["erro"])]
+        return [variation.choose(state, "erro", current_catalogue().prompts["erro"])]
+
+def backfill_leaderboard():
+    """Put points earned before the ledger existed into it (once per database)"""
+    try:
+        added = leaderboard.backfill((student_id.split(":", 1)[0], student_id, points)
+                                     for student_id, points in state_store.stored_values("points"))
+        if added:
+            print(f"Backfilled the points of {added} students into the ledger")
+    except Exception as e:
+        print(f"Error backfilling the points ledger: {e}")
+
+def format_ranking(state, top_k=5):
+    """Render the student's rank and the cohort's top scores"""
+    cohort = current_tenant().id
+    rank, size = leaderboard.rank(cohort, state["student_id"])
+    lines = [f"🏆 *Ranking da turma*\n\nVocê está em {rank}º lugar de {size} com {state['points']} pontos.\n"]
+    medals = ["🥇", "🥈", "🥉"]
+    for position, (student_id, score) in enumerate(leaderboard.top(cohort, top_k), start=1):
+        # Read from the store, so other students aren't loaded (and cached) here
+        other = state_store.stored_fields(student_id)
+        name = ((other.get("profile") or {}).get("nome") or "Aluno") if other else "Aluno"
+        marker = medals[position - 1] if position <= len(medals) else f"{position}º"
+        lines.append(f"{marker} {name.split()[0]} - {score} pontos")
+    return "\n".join(lines)
+
+def progress_bar(percent, width=10):
+    """Render a text progress bar for WhatsApp"""
+    filled = round(percent * width / 100)
+    return "▓" * filled + "░" * (width - filled)
+
+def leave_quiz(state):
+    """Drop an unfinished quiz when the student navigates elsewhere"""
+    for field in LEGACY_FIELDS:
+        state.pop(field, None)
+    state["quiz"] = None
+    state["context"] = "presenting_content"
+
+# --- Commands ---
+# Fixed commands are answered from this table before any context routing,
+# without calling the model (see commands.py and classifier.py)
+dispatcher = CommandDispatcher()
+
+@dispatcher.command("continuar", "*continuar* ou *próximo*", "Avançar para o próximo conteúdo")
+def command_continue(state, argument):
+    return advance_content(state)
+
+@dispatcher.command("quiz", "*quiz*", "Testar seus conhecimentos com um quiz")
+def command_quiz(state, argument):
+    session = start_quiz(state)
+    if session is None:
+        return ["Desculpe, não consegui gerar um quiz neste momento. Tente novamente mais tarde."]
+    
+    # Present first question
+    return [f"*Quiz do módulo {current_catalogue().modules[session.module]['titulo']}*\n\n{format_question(quiz_question(session))}"]
+
+@dispatcher.command("pontos", "*pontos*", "Verificar sua pontuação atual")
+def command_points(state, argument):
+    return [f"Você tem {state['points']} pontos. 🏆\n\nContinue respondendo quizzes para ganhar mais pontos!"]
+
+@dispatcher.command("ranking", "*ranking*", "Ver sua posição entre os colegas")
+def command_ranking(state, argument):
+    return [format_ranking(state)]
+
+@dispatcher.command("mentoria", "*mentoria*", "Solicitar uma mentoria (disponível no final do curso)")
+def command_mentoring(state, argument):
+    if state["current_module"] in ["mentoria", "fim"]:
+        if state["points"] >= 50:
+            state["points"] -= 50
+            leaderboard.record(current_tenant().id, state["student_id"], -50, "mentoria")
+            track_event(state, "mentoria_redeemed", state["current_module"])
+            return [f"Parabéns! 🎉 Você resgatou uma mentoria. Entraremos em contato para agendar. Seus pontos restantes: {state['points']}"]
+        else:
+            return [f"Você precisa de 50 pontos para solicitar uma mentoria, mas só tem {state['points']} pontos. Continue respondendo aos quizzes para ganhar mais pontos!"]
+    else:
+        return ["Você só pode solicitar mentoria quando chegar ao módulo de Mentoria. Continue avançando no curso!"]
+
+@dispatcher.command("modulo", "*módulo*", "Ver em qual módulo você está (*módulo 2* leva ao módulo 2)")
+def command_module(state, argument):
+    catalogue = current_catalogue()
+    index = catalogue.index
+    
+    # Without a number, just report the current position
+    if argument is None:
+        lesson, _ = index.resolve(state["current_module"], state["current_submodule"])
+        if lesson is None:
+            return ["🎓 Você já concluiu todos os módulos do curso!"]
+        total = len(index.module_lessons[lesson.module])
+        return [f"📍 Você está no módulo *{lesson.module_title}*, conteúdo {lesson.submodule + 1} de {total}: {lesson.title}"]
+    
+    target = index.module_by_number(argument)
+    if target is None:
+        return [f"Não encontrei o módulo {argument}. Digite 'módulo' para ver onde você está."]
+    if not index.prerequisites_met(target, state["current_module"]):
+        missing = ", ".join(catalogue.modules[name]["titulo"] for name in index.prerequisites[target])
+        return [f"Para abrir o módulo *{catalogue.modules[target]['titulo']}*, conclua antes: {missing}."]
+    
+    leave_quiz(state)
+    state["current_module"] = target
+    state["current_submodule"] = 0
+    return present_content(state)
+
+@dispatcher.command("progresso", "*progresso*", "Ver quanto do curso você já concluiu")
+def command_progress(state, argument):
+    index = current_catalogue().index
+    percent = index.percent_complete(state["current_module"], state["current_submodule"])
+    done = index.completed_lessons(state["current_module"], state["current_submodule"])
+    return [f"📈 *Seu progresso*\n\n{progress_bar(percent)} {percent}%\n{done} de {index.total_lessons} conteúdos concluídos\nPontos: {state['points']}"]
+
+@dispatcher.command("reiniciar", "*reiniciar*", "Reiniciar o módulo atual")
+def command_restart(state, argument):
+    catalogue = current_catalogue()
+    if state["current_module"] == catalogue.terminal_module:
+        return ["Você já concluiu o curso! Digite 'módulo 1' para rever um módulo."]
+    leave_quiz(state)
+    state["current_submodule"] = 0
+    return present_content(state)
+
+@dispatcher.command("ajuda", "*ajuda*", "Ver esta lista de comandos")
+def command_help(state, argument):
+    return [dispatcher.help_text()]
 
 # --- Main Message Processing Logic ---
 
 def process_message(student_message, student_number):
     """Process an incoming message from a student"""
     state = get_student_state(student_number)
-    
-    # Handle special commands
-    if student_message.lower() == "quiz":
-        # Generate quiz for current module
-        quiz = generate_quiz(state["current_module"])
-        if not quiz:
-            return ["Desculpe, não consegui gerar um quiz neste momento. Tente novamente mais tarde."]
-        
-        state["quiz_active"] = True
-        state["current_quiz"] = quiz
-        state["quiz_answers"] = []
-        state["context"] = "quiz"
-        
-        # Present first question
-        first_question = quiz[0]
-        question_text = first_question["question"]
-        options_text = "\n".join(first_question["options"])
-        
-        return [f"*Quiz do módulo {MODULES[state['current_module']]['titulo']}*\n\n{question_text}\n{options_text}"]
-    
-    elif student_message.lower() == "continuar":
-        # Move to next submodule
-        state["current_submodule"] += 1
-        state["context"] = "presenting_content"
-        return present_content(state)
-    
-    elif student_message.lower() == "pontos":
-        return [f"Você tem {state['points']} pontos. 🏆\n\nContinue respondendo quizzes para ganhar mais pontos!"]
-    
-    elif student_message.lower() == "mentoria":
-        if state["current_module"] in ["mentoria", "fim"]:
-            if state["points"] >= 50:
-                state["points"] -= 50
-                return [f"Parabéns! 🎉 Você resgatou uma mentoria. Entraremos em contato para agendar. Seus pontos restantes: {state['points']}"]
-            else:
-                return [f"Você precisa de 50 pontos para solicitar uma mentoria, mas só tem {state['points']} pontos. Continue respondendo aos quizzes para ganhar mais pontos!"]
-        else:
-            return ["Você só pode solicitar mentoria quando chegar ao módulo de Mentoria. Continue avançando no curso!"]
+    current_student.set(state["student_id"])
+    state["last_active_at"] = time.time()
+    
+    # While a quiz is running, answers take precedence over commands
+    session = quiz_session(state) if state["context"] == "quiz" else None
+    if session is not None:
+        question = quiz_question(session)
+        if question is not None and parse_quiz_answer(student_message, question["options"]) is not None:
+            metrics.increment("messages_resolved_locally")
+            return handle_quiz_response(student_message, state)
+    
+    # Fixed commands are answered locally in every context but the form,
+    # where any answer belongs to the form
+    if state["context"] != "form":
+        responses = dispatcher.dispatch(student_message, state)
+        if responses is not None:
+            metrics.increment("messages_resolved_locally")
+            return responses
     
     # Process message based on current context
     if state["context"] == "form":
         return collect_initial_info(student_message, state)
     
     elif state["context"] == "presenting_content":
-        if student_message.lower() in ["próximo", "proximo", "continuar", "avançar", "avancar", "seguir"]:
-                state["current_submodule"] += 1
-                return present_content(state)
-        else:
-            state["context"] = "free_interaction"
-            return process_free_interaction(student_message, state)
+        state["context"] = "free_interaction"
+        return process_free_interaction(student_message, state)
     
     elif state["context"] == "quiz":
         return handle_quiz_response(student_message, state)
     
-    elif student_message.lower() in ["ajuda", "help", "comandos"]:
-        return ["""📚 *Comandos disponíveis*
-                - *continuar* ou *próximo*: Avançar para o próximo conteúdo
-                - *quiz*: Testar seus conhecimentos com um quiz
-                - *pontos*: Verificar sua pontuação atual
-                - *mentoria*: Solicitar uma mentoria (disponível no final do curso)
-                - *módulo*: Ver em qual módulo você está
-                - *reiniciar*: Reiniciar o módulo atual
-                Você também pode fazer qualquer pergunta relacionada ao empreendedorismo a qualquer momento!"""]
-    
     elif state["context"] == "free_interaction" or state["context"] == "course_completed":
         return process_free_interaction(student_message, state)
     
-   # Default fallback
+    # Default fallback
     return ["Desculpe, não entendi. Você pode tentar novamente ou digitar 'continuar' para prosseguir com o curso."]
 
+def defer_message(student_message, student_number, reply_from=None):
+    """Acknowledge a message now and process it in the background"""
+    metrics.increment("messages_deferred")
+    job_queue.enqueue("deferred_message", {"tenant": current_tenant().id, "message": student_message,
+                                           "number": student_number, "reply_from": reply_from},
+                      priority=INTERACTIVE, affinity=job_queue.affinity)
+    if outbound is not None and reply_from:
+        return ["Recebi sua mensagem! 📬 Estamos com muitos acessos agora, já te respondo em instantes."]
+    return ["Recebi sua mensagem! 📬 Estamos com muitos acessos agora, já te respondo na sua próxima mensagem."]
+
+def run_deferred_message(student_message, student_number, reply_from=None):
+    """Process a deferred message and send its replies (or keep them for the next turn)"""
+    try:
+        # Any worker of the node may run this job; the turn reloads the state another worker changed
+        with state_store.turn(current_tenant().scoped(student_number)):
+            responses = process_message(student_message, student_number)
+            state = get_student_state(student_number)
+            if outbound is not None and reply_from:
+                for response in responses:
+                    outbound.send(state["student_id"], reply_from, student_number, response)
+            else:
+                state["pending_replies"] = list(state.get("pending_replies") or []) + responses
+    except Exception as e:
+        print(f"Error processing deferred message: {e}")
+
+# A deferred turn isn't retried: it may already have changed the student's state
+@job_queue.handler("deferred_message", concurrency=int(os.environ.get("ADMISSION_DEFER_WORKERS", 2)),
+                   timeout=300, max_attempts=1, in_process=True)
+def run_deferred_job(payload):
+    """Handle a message deferred under overload"""
+    with use_tenant(all_tenants()[payload["tenant"]]):
+        run_deferred_message(payload["message"], payload["number"], payload["reply_from"])
+
+# Delivery statuses only move forward; callbacks can arrive out of order
+DELIVERY_STATUS_RANK = {"queued": 0, "sending": 1, "sent": 2, "delivered": 3, "read": 4,
+                        "undelivered": 5, "failed": 5}
+
+def record_delivery_status(student_id, message_sid, status):
+    """Remember the latest delivery status of a student's outbound messages"""
+    with state_store.turn(student_id):
+        state = state_store.get(student_id)
+        if state is not None:
+            update_deliveries(state, message_sid, status)
+
+def update_deliveries(state, message_sid, status):
+    """Record one delivery status on a loaded student"""
+    deliveries = dict(state.get("deliveries") or {})
+    key = message_sid or f"unsent-{int(time.time() * 1000)}"
+    previous = deliveries.pop(key, None)
+    if previous is not None and DELIVERY_STATUS_RANK.get(previous, 0) > DELIVERY_STATUS_RANK.get(status, 0):
+        status = previous
+    deliveries[key] = status
+    # Keep only the most recent messages
+    state["deliveries"] = dict(list(deliveries.items())[-20:])
+    state["last_delivery_status"] = status
+
+def take_pending_replies(student_number):
+    """Return (and clear) replies produced by deferred processing"""
+    state = get_student_state(student_number)
+    if not state.get("pending_replies"):
+        return []
+    return list(state.pop("pending_replies"))
+
 # --- Twilio webhook and Flask routes ---
-@app.route("/whatsapp", methods=["POST"])
-def whatsapp_webhook():
-    """Handle incoming WhatsApp messages via Twilio webhook"""
-    # Get message content and sender info
-    incoming_msg = request.values.get('Body', '').strip()
-    sender_number = request.values.get('From', '')
-    
-    # Process the message and get responses
-    responses = process_message(incoming_msg, sender_number)
-    
-    # Create Twilio response
+@app.before_request
+def refresh_catalogue():
+    """Pick up catalogue changes between requests"""
+    maybe_reload_catalogues()
+
+@app.before_request
+def sync_admin_events():
+    """Apply admin operations published by other workers"""
+    admin_bus.poll()
+
+@app.after_request
+def tag_cluster_node(response):
+    """Tell which node handled a request"""
+    if cluster is not None:
+        response.headers.setdefault(NODE_HEADER, cluster.node_id)
+    return response
+
+def release_moved_students(previous, ring):
+    """Flush and drop loaded students whose owner changed in a rebalance.
+
+    The new owner then reads them fresh from the shared store; a student
+    coming back to this node is reloaded as well, since another node may
+    have changed them meanwhile.
+    """
+    moved = 0
+    for student_id in list(state_store.loaded_ids()):
+        number = student_id.split(":", 1)[1]
+        if cluster.owns(number, previous) and cluster.owns(number, ring):
+            continue
+        state_store.flush(student_id)
+        state_store.evict(student_id)
+        prompt_cache.invalidate(student_id)
+        moved += 1
+    metrics.increment("cluster_students_released", moved)
+
+def render_twiml(responses):
+    """Build the TwiML reply for a list of messages"""
     resp = MessagingResponse()
     
     # Add each message to the response
@@ -724,16 +1224,349 @@ def whatsapp_webhook():
     
     return str(resp)
 
+@app.route("/whatsapp", methods=["POST"])
+def whatsapp_webhook():
+    """Handle incoming WhatsApp messages via Twilio webhook"""
+    # Turns are handled by the node owning the student; forwarded requests
+    # are always handled here, so a rebalance can't bounce them around
+    if cluster is not None:
+        cluster.start()
+        if not cluster.is_forwarded(request.headers):
+            forwarded = cluster.forward(request.values.get('From', ''), request.path, request.values)
+            if forwarded is not None:
+                status, body, content_type, owner = forwarded
+                return Response(body, status=status, content_type=content_type, headers={NODE_HEADER: owner})
+    
+    # Get message content and sender info
+    incoming_msg = request.values.get('Body', '').strip()
+    sender_number = request.values.get('From', '')
+    message_sid = request.values.get('MessageSid', '')
+    
+    # Twilio retries slow deliveries with the same MessageSid: replay the
+    # stored reply (or wait for it) instead of handling the message twice
+    if message_sid:
+        status, reply = deduplicator.claim(message_sid)
+        if status == BUSY:
+            status, reply = deduplicator.wait_for(message_sid)
+        if status == DONE:
+            return reply
+        if status == BUSY:
+            return str(MessagingResponse())
+    
+    # The number the student wrote to selects the course (tenant)
+    tenant = resolve_tenant(request.values.get('To', ''))
+    
+    # Process the message and get responses
+    try:
+        with admission.request(parse_request_start(request.headers.get('X-Request-Start'))):
+            if not tenant.message_quota.allow():
+                responses = ["Estamos com muitas mensagens no momento. Por favor, tente novamente em alguns minutos."]
+            else:
+                with use_tenant(tenant):
+                    if admission.at_least(DEFER):
+                        responses = defer_message(incoming_msg, sender_number, request.values.get('To', ''))
+                    else:
+                        with state_store.turn(tenant.scoped(sender_number)):
+                            responses = take_pending_replies(sender_number) + process_message(incoming_msg, sender_number)
+        reply = render_twiml(responses)
+    except Exception:
+        if message_sid:
+            deduplicator.release(message_sid)
+        raise
+    
+    if message_sid:
+        deduplicator.complete(message_sid, reply)
+    return reply
+
+@app.route("/twilio/status", methods=["POST"])
+def twilio_status_callback():
+    """Delivery status updates for messages sent through the REST API"""
+    message_sid = request.values.get('MessageSid', '')
+    status = request.values.get('MessageStatus', '')
+    if not message_sid or not status:
+        return {"error": "MessageSid and MessageStatus are required"}, 400
+    # Our number is the sender of an outbound message, the student its recipient
+    tenant = resolve_tenant(request.values.get('From', ''))
+    record_delivery_status(tenant.scoped(request.values.get('To', '')), message_sid, status)
+    metrics.increment(f"outbound_status_{status}")
+    return "", 204
+
 @app.route("/health", methods=["GET"])
 def health_check():
-    """Simple health check endpoint"""
+    """Liveness check endpoint (doesn't touch the model)"""
     return {"status": "ok", "timestamp": time.time()}
 
-@app.route("/reset", methods=["GET"])
-def reset_students():
-    """Reset all student data (for development/testing)"""
-    global students
-    students = {}
+@app.route("/ready", methods=["GET"])
+def readiness_check():
+    """Readiness probe: the catalogue is loaded and the model client is usable"""
+    ready, reason = is_ready()
+    if not ready:
+        return {"status": "unavailable", "reason": reason}, 503
+    return {"status": "ready",
+            "catalogues": {tenant.id: tenant.catalogue.version for tenant in all_tenants().values()}}
+
+@app.route("/metrics", methods=["GET"])
+@require_admin
+def metrics_endpoint():
+    """Expose process-local counters, prefetch and cache statistics"""
+    data = metrics.snapshot()
+    data["prefetch"] = prefetcher.stats()
+    data["jobs"] = job_queue.stats()
+    data["caches"] = {name: cache.stats() for name, cache in CACHES.items()}
+    data["prompt_prefix"] = prompt_cache.stats()
+    return data
+
+@app.route("/analytics", methods=["GET"])
+@require_admin
+def analytics_endpoint():
+    """Funnel (distinct students per step) and time-to-step histograms for a tenant (?tenant=<id>)"""
+    if funnel_aggregator is None:
+        return {"status": "disabled"}, 404
+    tenants = all_tenants()
+    tenant = tenants.get(request.args.get("tenant")) or current_tenant()
+    position = tenant.catalogue.index.module_position
+    form_fields = list(new_student_state("")["profile"])
+    
+    def order(row):
+        step = row["step"]
+        if isinstance(step, str):
+            step = form_fields.index(step) if step in form_fields else len(form_fields)
+        return (position.get(row["module"], -1), -1 if step is None else step)
+    
+    funnel = {}
+    for event, counts in funnel_aggregator.funnel(tenant.id).items():
+        histograms = funnel_aggregator.histogram(tenant.id, event)
+        rows = [{"module": module, "step": step, "students": students, "events": events,
+                 "time_to_step": histograms.get((module, step))}
+                for (module, step), (students, events) in counts.items()]
+        funnel[event] = sorted(rows, key=order)
+    return {"tenant": tenant.id, "histogram_buckets": list(HISTOGRAM_LABELS), "funnel": funnel}
+
+# --- Admin API ---
+# Authenticated with ADMIN_TOKEN. Operations that change shared data publish
+# an event so every worker drops or updates its in-memory copies.
+
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 500
+
+@admin_bus.handler("reset_student")
+def apply_student_reset(student_id):
+    state_store.evict(student_id)
+    prompt_cache.invalidate(student_id)
+    leaderboard.resync(student_id.split(":", 1)[0], student_id)
+
+@admin_bus.handler("reset_all")
+def apply_reset_all(payload):
+    state_store.evict()
+    prompt_cache.invalidate()
+    leaderboard.reload()
+
+@admin_bus.handler("update_students")
+def apply_student_updates(payload):
+    state_store.apply_stored(payload["student_ids"], payload["fields"])
+
+@admin_bus.handler("flush_cache")
+def apply_cache_flush(layer):
+    if layer in ("prompt_prefix", "all"):
+        prompt_cache.invalidate()
+    for name, cache in CACHES.items():
+        if layer in (name, "all"):
+            cache.invalidate()
+
+def admin_timestamp(value):
+    """Parse an ISO date (or epoch seconds) from an admin request"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(value).timestamp()
+
+def admin_int(name, default, maximum):
+    """Positive integer query parameter (capped at ``maximum``); ValueError when invalid"""
+    value = request.args.get(name, default)
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{name}' must be an integer, got '{value}'")
+    if number < 0:
+        raise ValueError(f"'{name}' can't be negative")
+    return min(number, maximum)
+
+def encode_cursor(student_id):
+    """Opaque, URL-safe pagination cursor (student ids contain '+' and ':')"""
+    return base64.urlsafe_b64encode(student_id.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def student_summary(student_id, fields):
+    """Compact view of a student for admin listings"""
+    profile = fields.get("profile") or {}
+    return {
+        "student_id": student_id,
+        "name": profile.get("nome"),
+        "module": fields.get("current_module"),
+        "submodule": fields.get("current_submodule"),
+        "context": fields.get("context"),
+        "points": fields.get("points"),
+        "last_active_at": fields.get("last_active_at"),
+    }
+
+def iter_admin_matches(filters, chunk_size=ADMIN_MAX_PAGE_SIZE, after=""):
+    """Yield (student_id, fields) of stored students matching an admin filter"""
+    prefix = f"{filters['tenant']}:" if filters.get("tenant") else ""
+    for student_id, fields in state_store.iter_stored(chunk_size, after=after, prefix=prefix):
+        if fields_match(fields, filters.get("module"), admin_timestamp(filters.get("active_since")),
+                        admin_timestamp(filters.get("active_before"))):
+            yield student_id, fields
+
+@app.route("/admin/students", methods=["GET"])
+@require_admin
+def admin_list_students():
+    """One page of students, filtered by tenant/module/activity, with a cursor for the next"""
+    try:
+        limit = max(admin_int("limit", ADMIN_PAGE_SIZE, ADMIN_MAX_PAGE_SIZE), 1)
+        filters = {key: request.args.get(key) for key in ("tenant", "module", "active_since", "active_before")}
+        students = []
+        for student_id, fields in iter_admin_matches(filters, limit + 1, decode_cursor(request.args.get("cursor", ""))):
+            students.append(student_summary(student_id, fields))
+            if len(students) > limit:
+                break
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    next_cursor = encode_cursor(students[limit - 1]["student_id"]) if len(students) > limit else None
+    return {"students": students[:limit], "next_cursor": next_cursor}
+
+@app.route("/admin/students/<path:student_id>", methods=["GET"])
+@require_admin
+def admin_inspect_student(student_id):
+    """Full state of one student, with the last ``history`` conversation turns"""
+    try:
+        turns = admin_int("history", 20, 1000)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    # Read the stored copy, so inspecting doesn't load the student into this worker
+    fields = state_store.stored_fields(student_id)
+    if fields is None:
+        return {"error": "student not found"}, 404
+    history = state_store.stored_history(student_id)
+    return {"student_id": student_id, "fields": fields, "history_length": len(history),
+            "history": render_history(history[-turns:]) if turns > 0 else []}
+
+@app.route("/admin/students/<path:student_id>", methods=["DELETE"])
+@require_admin
+def admin_reset_student(student_id):
+    """Delete one student's state; they start over at their next message"""
+    if state_store.stored_fields(student_id) is None:
+        return {"error": "student not found"}, 404
+    cohort = student_id.split(":", 1)[0]
+    score = leaderboard.score(cohort, student_id)
+    if score:
+        leaderboard.record(cohort, student_id, -score, "admin_reset")
+    # Not in the middle of one of the student's turns
+    with state_store.turn(student_id):
+        state_store.discard(student_id)
+    prefetcher.discard(student_id)
+    admin_bus.publish("reset_student", student_id)
+    return {"status": "ok", "student_id": student_id}
+
+@app.route("/admin/students/progress", methods=["POST"])
+@require_admin
+def admin_set_progress():
+    """Move matching students (or an explicit list) to a lesson.
+
+    Body: {"tenant": ..., "module": ..., "active_since": ..., "active_before": ...,
+    "student_ids": [...], "set": {"module": ..., "submodule": 0}}
+    """
+    body = request.get_json(silent=True) or {}
+    tenant = all_tenants().get(body.get("tenant"))
+    target = body.get("set") or {}
+    if tenant is None:
+        return {"error": "unknown or missing tenant"}, 400
+    module = tenant.catalogue.modules.get(target.get("module"))
+    submodule = target.get("submodule", 0)
+    if module is None or not isinstance(submodule, int) or not 0 <= submodule < len(module["submodulos"]):
+        return {"error": "set.module/set.submodule don't name a lesson of this course"}, 400
+    fields = {
+        "current_module": target["module"],
+        "current_submodule": submodule,
+        "context": "presenting_content",
+        "waiting_response": None,
+        "quiz": None,
+    }
+    
+    def apply(student_ids):
+        # Students mid-turn elsewhere finish first and aren't written back over the update
+        with ExitStack() as turns:
+            for student_id in student_ids:
+                turns.enter_context(state_store.turn(student_id))
+            updated = state_store.update_stored(student_ids, fields)
+        if updated:
+            admin_bus.publish("update_students", {"student_ids": updated, "fields": fields})
+        return len(updated)
+    
+    if body.get("student_ids"):
+        prefix = f"{tenant.id}:"
+        count = apply([student_id for student_id in body["student_ids"] if student_id.startswith(prefix)])
+        return {"status": "ok", "updated": count}
+    
+    count = 0
+    chunk = []
+    try:
+        # Students still filling in the form keep their place
+        for student_id, stored in iter_admin_matches(dict(body, tenant=tenant.id)):
+            if stored.get("form_completed"):
+                chunk.append(student_id)
+            if len(chunk) >= ADMIN_MAX_PAGE_SIZE:
+                count += apply(chunk)
+                chunk = []
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if chunk:
+        count += apply(chunk)
+    return {"status": "ok", "updated": count}
+
+@app.route("/admin/caches/<layer>/flush", methods=["POST"])
+@require_admin
+def admin_flush_cache(layer):
+    """Flush one cache layer (or "all") in every worker"""
+    layers = sorted(CACHES) + ["prompt_prefix", "all"]
+    if layer not in layers:
+        return {"error": f"unknown cache layer '{layer}'", "layers": layers}, 404
+    admin_bus.publish("flush_cache", layer)
+    return {"status": "ok", "layer": layer}
+
+@app.route("/admin/usage", methods=["GET"])
+@require_admin
+def admin_usage_report():
+    """LLM usage report grouped by student/site/module/model/tenant/day (?format=csv to export)"""
+    try:
+        rows = usage_meter.report(
+            group_by=request.args.get("group_by", "student"),
+            since=admin_timestamp(request.args.get("since")),
+            until=admin_timestamp(request.args.get("until")),
+            tenant=request.args.get("tenant"),
+            limit=admin_int("limit", 100, 10000),
+        )
+    except ValueError as e:
+        return {"error": str(e), "group_by": list(REPORT_GROUPS)}, 400
+    if request.args.get("format") == "csv":
+        return Response(report_csv(rows), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=llm_usage.csv"})
+    return {"rows": rows}
+
+@app.route("/admin/reset", methods=["POST"])
+@require_admin
+def admin_reset_all():
+    """Delete every student's state and the points ledger (for development/testing)"""
+    state_store.clear()
+    prefetcher.discard()
+    leaderboard.clear()
+    admin_bus.publish("reset_all")
     return {"status": "ok", "message": "All student data reset"}
 
 @app.route("/", methods=["GET"])
@@ -777,5 +1610,10 @@ if __name__ == "__main__":
     # Get port from environment variable or use default
     port = int(os.environ.get("PORT", 5000))
     
+    if cluster is not None:
+        cluster.start()
+    job_queue.start()
+    backfill_leaderboard()
+    
     # Run the Flask application
     app.run(host="0.0.0.0", port=port, debug=os.environ.get("DEBUG", "False").lower() == "true")
\ No newline at end of file
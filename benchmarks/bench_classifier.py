@@ -0,0 +1,78 @@
+"""Measure how many student messages are resolved without a model call.
+
+Usage: python benchmarks/bench_classifier.py
+
+Runs a corpus of typical WhatsApp replies (commands with accents, typos and
+punctuation, quiz answers in several shapes, and free-text questions)
+through the local classifier and reports the share handled locally and the
+time per message.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import classify_command, parse_quiz_answer  # noqa: E402
+
+OPTIONS = [
+    "a) Um problema sem solução no mercado",
+    "b) Uma necessidade não atendida que pode gerar valor",
+    "c) Qualquer ideia nova",
+    "d) Um produto já existente",
+]
+
+COMMANDS = [
+    "continuar", "Continuar", "CONTINUAR!", "continuar.", "contiunar", "Próximo", "proximo",
+    "avançar", "seguir", "pode continuar", "quiz", "Quiz!", "quero fazer o quiz",
+    "pontos", "Pontuação", "meus pontos?", "ranking", "rankimg", "mentoria", "Mentoria 🙏", "ajuda",
+    "help", "comandos",
+]
+
+ANSWERS = [
+    "a", "B", "c)", "(d)", "B)", "letra c", "Letra B", "alternativa d", "é a b", "resposta: a",
+    "b) Uma necessidade não atendida", "uma necessidade não atendida que pode gerar valor",
+    "qualquer ideia nova", "acho que é a c", "b, porque é mais barato", "D; tenho certeza",
+]
+
+FREE_TEXT = [
+    "Como faço para validar minha ideia de app para a UVV?",
+    "Não entendi a parte do canvas, pode explicar de novo?",
+    "Quanto custa abrir um MEI?",
+    "Qual a diferença entre proposta de valor e segmento de clientes?",
+    "Tenho uma ideia de marmita fit no campus, o que acha?",
+    "obrigado!",
+    # Ordinary replies that look like commands
+    "Pronto", "Mentora", "bora", "Vamos?", "status", "teste", "menu",
+]
+
+
+def main():
+    rounds = 200
+    resolved = 0
+    total = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in COMMANDS:
+            total += 1
+            resolved += classify_command(message) is not None
+        for message in ANSWERS:
+            total += 1
+            resolved += parse_quiz_answer(message, OPTIONS) is not None
+        for message in FREE_TEXT:
+            total += 1
+            resolved += classify_command(message) is not None
+    elapsed = time.perf_counter() - start
+
+    unresolved = [m for m in COMMANDS if classify_command(m) is None]
+    unresolved += [m for m in ANSWERS if parse_quiz_answer(m, OPTIONS) is None]
+    false_hits = [m for m in FREE_TEXT if classify_command(m) is not None]
+    print(f"resolved locally: {resolved / total:.1%} of {total // rounds} messages "
+          f"({len(FREE_TEXT)} free-text questions need the model)")
+    print(f"time per message: {elapsed / total * 1e6:.1f} us")
+    print(f"missed commands/answers: {unresolved}")
+    print(f"free text misread as commands: {false_hits}")
+
+
+if __name__ == "__main__":
+    main()
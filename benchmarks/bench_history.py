@@ -0,0 +1,68 @@
+"""Compare the size of plain-string and compact conversation histories.
+
+Usage: python benchmarks/bench_history.py [lessons] [questions per lesson]
+
+Builds a typical student history from the course notes (lessons wrapped in
+the catalogue's presentation template, and question/answer turns), then
+reports its size as the old "Aluno: ..." strings and with transcript.py's
+encoding: lesson references plus hot and compressed cold turns. Lesson
+texts are reported separately, since students who got the same (shared or
+prefetched) lesson reference one stored copy.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcript  # noqa: E402
+from catalogue import default_catalogue_path, load_catalogue  # noqa: E402
+from retrieval import _chunks, _sections, notes_paths  # noqa: E402
+
+
+def main():
+    lessons = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    questions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    random.seed(1)
+    catalogue = load_catalogue(default_catalogue_path())
+    notes_dir, _ = notes_paths(catalogue.path)
+    passages = []
+    for module in catalogue.modules:
+        path = os.path.join(notes_dir, f"{module}.md")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                passages.extend(chunk for section in _sections(f.read()) for chunk in _chunks(section))
+
+    legacy, compact = [], []
+    texts = transcript.LessonTexts()
+    positions = [(name, i) for name, module in catalogue.modules.items() for i in range(len(module["submodulos"]))]
+    for module_name, submodule_index in positions[:lessons]:
+        module = catalogue.modules[module_name]
+        submodule = module["submodulos"][submodule_index]
+        content = " ".join(random.sample(passages, 3))[:1000]
+        presentation = random.choice(catalogue.prompts["apresentacao_conteudo"]).format(submodulo=submodule, conteudo=content)
+        reflection = random.choice(catalogue.prompts["pergunta_reflexao"]).format(submodulo=submodule)
+        message = (f"*{module['titulo']} - {submodule}*\n\n{presentation}\n\n{reflection}\n\nDigite 'continuar' quando "
+                   "quiser avançar para o próximo conteúdo. Fique a vontade para realizar qualquer pergunta se ainda "
+                   "não estiver pronto para avançar")
+        legacy.append(f"Assistente: {message}")
+        compact.append(transcript.lesson(module_name, submodule_index, texts.intern(content)))
+        for _ in range(questions):
+            question = random.choice(passages)[:120] + "?"
+            answer = " ".join(random.sample(passages, 2))[:700]
+            legacy += [f"Aluno: {question}", f"Assistente: {answer}"]
+            compact += [transcript.student(question), transcript.assistant(answer)]
+
+    hot = len(compact) - transcript.HOT_TURNS
+    stored = [transcript.compress(entry) if i < hot else entry for i, entry in enumerate(compact)]
+    legacy_bytes = sum(len(entry.encode("utf-8")) for entry in legacy)
+    compact_bytes = sum(len(entry) for entry in stored)
+    lesson_bytes = sum(len(text.encode("utf-8")) for text in texts._cache.values())
+    print(f"{len(legacy)} entries: plain strings {legacy_bytes} bytes")
+    print(f"compact history {compact_bytes} bytes ({legacy_bytes / compact_bytes:.1f}x smaller), "
+          f"plus {lesson_bytes} bytes of lesson texts stored once per distinct lesson")
+    assert transcript.render(stored, texts, catalogue) == transcript.render(compact, texts, catalogue)
+
+
+if __name__ == "__main__":
+    main()
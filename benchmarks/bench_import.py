@@ -0,0 +1,45 @@
+"""Measure how long a fresh interpreter takes to import the app.
+
+Usage: python benchmarks/bench_import.py [runs]
+
+Each run imports ``app`` in a new process (like a freshly forked gunicorn
+worker without --preload) and reports the wall time, plus whether the
+Gemini SDK was imported as a side effect.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(elapsed, "google.generativeai" in sys.modules)
+"""
+
+
+def run_once():
+    output = subprocess.run([sys.executable, "-c", SNIPPET], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout.split()
+    return float(output[-2]), output[-1] == "True"
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    timings = []
+    sdk_loaded = False
+    for _ in range(runs):
+        elapsed, loaded = run_once()
+        timings.append(elapsed)
+        sdk_loaded = sdk_loaded or loaded
+    print(f"import app: median {statistics.median(timings) * 1000:.1f} ms, "
+          f"min {min(timings) * 1000:.1f} ms, max {max(timings) * 1000:.1f} ms over {runs} runs")
+    print(f"google.generativeai imported at startup: {sdk_loaded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Measure outbound send throughput against the fake Twilio server.
+
+Usage: python benchmarks/bench_outbound.py [students] [messages per student]
+
+Sends every student a numbered sequence through OutboundSender with some
+injected throttling and server errors, then reports throughput, how many
+TCP connections were opened, and whether each student received their
+messages complete and in order.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_twilio import FakeTwilio  # noqa: E402
+from outbound import OutboundSender  # noqa: E402
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_student = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    fake = FakeTwilio(error_rate=0.02, throttle_rate=0.02).start()
+    statuses = {}
+    sender = OutboundSender("ACtest", "token", api_base=fake.url, rate_per_number=0, backoff=0.01, workers=8,
+                            on_status=lambda key, sid, status: statuses.__setitem__(status, statuses.get(status, 0) + 1))
+
+    start = time.perf_counter()
+    for i in range(per_student):
+        for student in range(students):
+            sender.send(student, "whatsapp:+10000000000", f"whatsapp:+55{student:08d}", f"{i}")
+    sender.wait_idle()
+    elapsed = time.perf_counter() - start
+
+    total = students * per_student
+    expected = [str(i) for i in range(per_student)]
+    in_order = sum(fake.messages_to(f"whatsapp:+55{student:08d}") == expected for student in range(students))
+    print(f"{total} messages in {elapsed:.2f}s ({total / elapsed:.0f}/s), "
+          f"{fake.requests} requests over {fake.connections} connections")
+    print(f"statuses: {statuses}; students with complete, ordered delivery: {in_order}/{students}")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
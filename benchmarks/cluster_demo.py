@@ -0,0 +1,99 @@
+"""Run several app nodes locally and check sticky routing and rebalancing.
+
+Usage: python benchmarks/cluster_demo.py [nodes] [students]
+
+Starts ``nodes`` app processes on consecutive ports sharing one state
+database, sends each student's messages to random nodes and checks that
+every turn was handled by the student's owner (the X-Cluster-Node header).
+Then one node leaves and a new one joins, and the script reports how many
+students changed owner each time.
+"""
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASE_PORT = 5301
+HEARTBEAT = 0.5
+
+
+def start_node(port, db_path):
+    env = dict(os.environ, PORT=str(port), STATE_DB_PATH=db_path, ANALYTICS_LOG_PATH="",
+               CLUSTER_NODE_URL=f"http://127.0.0.1:{port}", CLUSTER_SECRET="demo",
+               CLUSTER_HEARTBEAT=str(HEARTBEAT))
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Node on port {port} didn't start")
+
+
+def send_round(ports, students):
+    """Message every student through a random node; returns {student: handling node}"""
+    owners, mismatches = {}, 0
+    for student in students:
+        handled = set()
+        for _ in range(3):
+            port = random.choice(ports)
+            response = requests.post(f"http://127.0.0.1:{port}/whatsapp", timeout=30,
+                                     data={"From": student, "To": "whatsapp:+14155238886", "Body": "ajuda"})
+            handled.add(response.headers.get("X-Cluster-Node"))
+        mismatches += len(handled) > 1
+        owners[student] = handled.pop()
+    return owners, mismatches
+
+
+def moved(before, after):
+    return sum(before[student] != after[student] for student in before)
+
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    students = [f"whatsapp:+55119{i:08d}" for i in range(count)]
+    db_path = os.path.join(tempfile.mkdtemp(), "cluster.db")
+    processes = {}
+    try:
+        for i in range(nodes):
+            processes[BASE_PORT + i] = start_node(BASE_PORT + i, db_path)
+        time.sleep(HEARTBEAT * 3)
+
+        owners, mismatches = send_round(list(processes), students)
+        spread = {node: list(owners.values()).count(node) for node in sorted(set(owners.values()))}
+        print(f"{nodes} nodes: students per node {spread}; students handled by more than one node: {mismatches}")
+
+        # A node leaves (SIGINT lets it deregister)
+        leaving = max(processes)
+        processes.pop(leaving).send_signal(signal.SIGINT)
+        time.sleep(HEARTBEAT * 4)
+        after_leave, mismatches = send_round(list(processes), students)
+        lost = sum(owner.endswith(f":{leaving}") for owner in owners.values())
+        print(f"node {leaving} left: {moved(owners, after_leave)} students moved "
+              f"({lost} were on it); split turns: {mismatches}")
+
+        # A new node joins
+        joining = BASE_PORT + nodes
+        processes[joining] = start_node(joining, db_path)
+        time.sleep(HEARTBEAT * 4)
+        after_join, mismatches = send_round(list(processes), students)
+        print(f"node {joining} joined: {moved(after_leave, after_join)} students moved "
+              f"(ideal {count // len(processes)}); split turns: {mismatches}")
+    finally:
+        for process in processes.values():
+            process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
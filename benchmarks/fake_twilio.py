@@ -0,0 +1,117 @@
+"""Local stand-in for Twilio's Messages API.
+
+Usage: python benchmarks/fake_twilio.py [port]
+
+Accepts ``POST /2010-04-01/Accounts/<sid>/Messages.json`` like Twilio does,
+records every message, and can inject throttling (429) and server errors
+(503). When a message has a StatusCallback, "sent" and "delivered" callbacks
+are posted to it. Run the app with TWILIO_API_BASE=http://127.0.0.1:<port>
+to send against it, or start it in-process with ``FakeTwilio().start()``.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTwilio:
+    """In-process fake of the Messages endpoint"""
+
+    def __init__(self, port=0, error_rate=0.0, throttle_rate=0.0, latency=0.0, callbacks=True):
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.latency = latency
+        self.callbacks = callbacks
+        self.messages = []
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-twilio", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def messages_to(self, number):
+        """Bodies received for one recipient, in arrival order"""
+        with self._lock:
+            return [m["Body"] for m in self.messages if m["To"] == number]
+
+    def _callback(self, url, message):
+        for status in ("sent", "delivered"):
+            data = urllib.parse.urlencode({"MessageSid": message["sid"], "MessageStatus": status,
+                                           "From": message["From"], "To": message["To"]}).encode()
+            try:
+                urllib.request.urlopen(url, data=data, timeout=5).read()
+            except Exception as e:
+                print(f"Error posting status callback: {e}")
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so clients can reuse connections
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload, headers=()):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+                with fake._lock:
+                    fake.requests += 1
+                if not self.path.endswith("/Messages.json"):
+                    return self._reply(404, {"message": "not found"})
+                if fake.latency:
+                    time.sleep(fake.latency)
+                roll = random.random()
+                if roll < fake.throttle_rate:
+                    return self._reply(429, {"code": 20429, "message": "Too Many Requests"}, [("Retry-After", "0")])
+                if roll < fake.throttle_rate + fake.error_rate:
+                    return self._reply(503, {"message": "Service Unavailable"})
+                message = dict(form, sid="SM" + uuid.uuid4().hex, status="queued", received_at=time.time())
+                with fake._lock:
+                    fake.messages.append(message)
+                if fake.callbacks and form.get("StatusCallback"):
+                    threading.Thread(target=fake._callback, args=(form["StatusCallback"], message),
+                                     daemon=True).start()
+                self._reply(201, {"sid": message["sid"], "status": "queued", "to": form.get("To"),
+                                  "from": form.get("From"), "body": form.get("Body")})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    fake = FakeTwilio(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8099)
+    print(f"Fake Twilio listening on {fake.url}")
+    fake.server.serve_forever()
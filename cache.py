@@ -0,0 +1,70 @@
+"""Small in-process caches shared by the content generation paths"""
+import threading
+import time
+from collections import OrderedDict
+
+# Every named cache registers itself here so it can be flushed as a layer
+CACHES = {}
+
+
+class VersionedCache:
+    """Bounded LRU cache whose entries are tagged with a catalogue version.
+
+    Lookups only hit entries stored under the requested version, and
+    ``invalidate`` drops the entries of a retired version.
+    """
+
+    def __init__(self, name, max_entries=1024, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        CACHES[name] = self
+
+    def get(self, key, version):
+        """Return the cached value for ``key`` under ``version``, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_version, expires_at, value = entry
+            if entry_version != version or (expires_at is not None and expires_at < time.time()):
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, version, value):
+        """Store ``value`` for ``key`` under ``version``"""
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (version, expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, version=None):
+        """Drop entries stored under ``version`` (or everything)"""
+        with self._lock:
+            if version is None:
+                self._entries.clear()
+                return
+            stale = [key for key, entry in self._entries.items() if entry[0] == version]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self):
+        """Return size and hit/miss counters"""
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def invalidate_all(version=None):
+    """Invalidate every registered cache"""
+    for cache in CACHES.values():
+        cache.invalidate(version)
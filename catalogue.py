@@ -0,0 +1,200 @@
+"""Course catalogue loaded from versioned data files.
+
+The catalogue (course modules and conversation prompt templates) lives in
+``data/catalogue.json``. It is validated when loaded and swapped atomically
+when the file changes on disk, so workers pick up new content without a
+restart.
+"""
+import hashlib
+import json
+import os
+import string
+import threading
+import time
+
+from cache import invalidate_all
+from course import CourseIndex
+
+DEFAULT_CATALOGUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "catalogue.json")
+
+# Placeholders each prompt template family must be formatted with
+PROMPT_FIELDS = {
+    "saudacao": set(),
+    "pergunta": {"pergunta"},
+    "agradecimento": set(),
+    "introducao_modulo": {"submodulo"},
+    "apresentacao_conteudo": {"submodulo", "conteudo"},
+    "pergunta_reflexao": {"submodulo"},
+    "resposta_correta": set(),
+    "resposta_incorreta": {"resposta"},
+    "erro": set(),
+}
+
+
+class Catalogue:
+    """Immutable snapshot of the course content"""
+
+    def __init__(self, version, modules, prompts, terminal_module, path=None):
+        self.version = version
+        self.modules = modules
+        self.prompts = prompts
+        self.terminal_module = terminal_module
+        self.path = path
+        self.index = CourseIndex(modules, terminal_module=terminal_module)
+
+
+def _template_fields(template):
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field}
+
+
+def validate_catalogue(data):
+    """Check the structure of raw catalogue data, raising ValueError on problems"""
+    errors = []
+    if not isinstance(data.get("version"), str) or not data["version"]:
+        errors.append("'version' must be a non-empty string")
+
+    modules = data.get("modules")
+    if not isinstance(modules, dict) or not modules:
+        errors.append("'modules' must be a non-empty object")
+        modules = {}
+    terminal = data.get("terminal_module", "fim")
+    if modules and terminal not in modules:
+        errors.append(f"terminal module '{terminal}' is not defined")
+
+    for name, module in modules.items():
+        if not isinstance(module, dict):
+            errors.append(f"module '{name}' must be an object")
+            continue
+        if not isinstance(module.get("titulo"), str) or not module["titulo"]:
+            errors.append(f"module '{name}' needs a 'titulo'")
+        for key in ("submodulos", "objetivos"):
+            values = module.get(key)
+            if not isinstance(values, list) or not all(isinstance(v, str) and v for v in values):
+                errors.append(f"module '{name}' field '{key}' must be a list of strings")
+        for req in module.get("prerequisitos", []):
+            if req not in modules:
+                errors.append(f"module '{name}' requires unknown module '{req}'")
+
+    prompts = data.get("prompts")
+    if not isinstance(prompts, dict):
+        errors.append("'prompts' must be an object")
+        prompts = {}
+    for key, fields in PROMPT_FIELDS.items():
+        templates = prompts.get(key)
+        if not isinstance(templates, list) or not templates:
+            errors.append(f"prompt family '{key}' must be a non-empty list")
+            continue
+        for template in templates:
+            if not isinstance(template, str) or not template:
+                errors.append(f"prompt family '{key}' contains an empty template")
+                continue
+            try:
+                used = _template_fields(template)
+            except ValueError as e:
+                errors.append(f"prompt family '{key}' has a malformed template: {e}")
+                continue
+            if not used <= fields:
+                errors.append(f"prompt family '{key}' uses unknown placeholders {sorted(used - fields)}")
+
+    if errors:
+        raise ValueError("Invalid course catalogue: " + "; ".join(errors))
+
+
+def load_catalogue(path=DEFAULT_CATALOGUE_PATH):
+    """Load and validate a catalogue file"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    data = json.loads(raw.decode("utf-8"))
+    validate_catalogue(data)
+
+    # The content digest makes edits visible even without a version bump
+    digest = hashlib.sha1(raw).hexdigest()[:8]
+    version = f"{data['version']}+{digest}"
+    return Catalogue(version, data["modules"], data["prompts"],
+                     data.get("terminal_module", "fim"), path=path)
+
+
+# --- Active catalogues ---
+# One slot per catalogue file: tenants that teach the same course share it
+
+class _Slot:
+    def __init__(self, path):
+        self.path = path
+        self.catalogue = None
+        self.mtime = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def default_catalogue_path():
+    """Catalogue file used when no tenant overrides it (CATALOGUE_PATH)"""
+    return os.environ.get("CATALOGUE_PATH", DEFAULT_CATALOGUE_PATH)
+
+
+def _slot(path):
+    path = os.path.abspath(path or default_catalogue_path())
+    slot = _slots.get(path)
+    if slot is None:
+        with _slots_lock:
+            slot = _slots.setdefault(path, _Slot(path))
+    return slot
+
+
+def get_catalogue(path=None):
+    """Return the active catalogue for a file, loading it on first use"""
+    slot = _slot(path)
+    if slot.catalogue is None:
+        reload_catalogue(path, force=True)
+    return slot.catalogue
+
+
+def reload_catalogue(path=None, force=False):
+    """Swap in the catalogue file if it changed on disk.
+
+    A file that fails validation is reported and the previous catalogue stays
+    active. Returns True when a new catalogue was installed.
+    """
+    slot = _slot(path)
+    with slot.lock:
+        slot.last_check = time.time()
+        current = slot.catalogue
+        try:
+            mtime = os.stat(slot.path).st_mtime
+        except OSError as e:
+            if current is None:
+                raise
+            print(f"Error checking catalogue file: {e}")
+            return False
+        if not force and mtime == slot.mtime:
+            return False
+        try:
+            catalogue = load_catalogue(slot.path)
+        except (OSError, ValueError) as e:
+            if current is None:
+                raise
+            print(f"Error reloading catalogue, keeping version {current.version}: {e}")
+            return False
+        slot.mtime = mtime
+        if current is not None and catalogue.version == current.version:
+            return False
+        # Rebinding a single reference keeps the swap atomic for readers
+        slot.catalogue = catalogue
+    if current is not None:
+        invalidate_all(current.version)
+    print(f"Loaded course catalogue version {catalogue.version} from {slot.path}")
+    return True
+
+
+def maybe_reload_catalogues():
+    """Check loaded catalogue files for changes at most once per reload interval"""
+    interval = float(os.environ.get("CATALOGUE_RELOAD_INTERVAL", 5))
+    if interval <= 0:
+        return
+    now = time.time()
+    for slot in list(_slots.values()):
+        if now - slot.last_check >= interval:
+            reload_catalogue(slot.path)
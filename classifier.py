@@ -0,0 +1,138 @@
+"""Local classification of fixed commands and quiz answers.
+
+Students type commands and quiz answers in many shapes ("Continuar!",
+"próximo", "B)", "letra c", the text of an option...). Normalizing and
+matching them here resolves those messages without any model call.
+"""
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# Canonical command -> accepted spellings (already normalized). Words that
+# are also ordinary replies ("bora", "vamos", "teste", "status", "menu"...)
+# are left out: a whole message equal to an alias is taken as the command.
+COMMAND_ALIASES = {
+    "quiz": ["quiz", "quizz", "quis", "questionario", "fazer quiz", "quero fazer o quiz"],
+    "continuar": ["continuar", "continua", "continue", "proximo", "prox", "avancar", "avanca",
+                  "seguir", "next", "pode continuar", "quero continuar"],
+    "pontos": ["pontos", "pontuacao", "meus pontos", "quantos pontos", "score"],
+    "ranking": ["ranking", "rank", "classificacao", "placar", "minha posicao"],
+    "mentoria": ["mentoria", "quero mentoria", "solicitar mentoria", "resgatar mentoria"],
+    "ajuda": ["ajuda", "help", "comandos", "opcoes"],
+    "modulo": ["modulo", "modulo atual", "qual modulo", "em qual modulo estou", "onde estou"],
+    "reiniciar": ["reiniciar", "reinicia", "recomecar", "reiniciar modulo", "restart"],
+    "progresso": ["progresso", "meu progresso", "andamento"],
+}
+
+# Commands that take an argument, e.g. "módulo 2" or "ir para o módulo 3"
+ARGUMENT_PATTERNS = [
+    (re.compile(r"^(?:ir para o|ir pro|ir para|ver o|abrir o|abrir)?\s*modulo (\d+)$"), "modulo"),
+]
+
+ALIAS_TO_COMMAND = {alias: command for command, aliases in COMMAND_ALIASES.items() for alias in aliases}
+
+# Typo tolerance only covers one-word messages close to a command name
+# itself: one wrong or two swapped letters in a name of FUZZY_MIN_LENGTH
+# letters or more ("contiunar", "rankimg"). Real words one letter away
+# ("pronto", "mentora") don't qualify.
+FUZZY_MIN_LENGTH = 6
+
+OPTION_LETTERS = ("a", "b", "c", "d")
+
+_ANSWER_PATTERNS = [
+    re.compile(r"^\(?([a-d])\)?[.!]*$"),
+    re.compile(r"^(?:letra|alternativa|opcao|resposta|item|e a|e|acho que e a|acho que e|minha resposta e)\s*:?\s*\(?([a-d])\)?$"),
+    re.compile(r"^\(?([a-d])\)?\s*[).:-]\s*.+$"),
+]
+
+# "b, porque é mais barato": a leading letter, punctuation and a justification
+# (checked before normalizing, which drops commas)
+_LEADING_LETTER = re.compile(r"^\s*\(?([a-d])\)?\s*[,;.:)\-–]\s*\S", re.IGNORECASE)
+
+
+def normalize(text):
+    """Lowercase, strip accents, punctuation and emoji, collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s().:-]", " ", text)
+    text = re.sub(r"[_]", " ", text)
+    return " ".join(text.split())
+
+
+def _bare(text):
+    """Normalized text without any punctuation"""
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def classify(message):
+    """Return (canonical command, argument) for a message, or (None, None)"""
+    text = _bare(normalize(message))
+    if not text:
+        return None, None
+    command = ALIAS_TO_COMMAND.get(text)
+    if command is not None:
+        return command, None
+    for pattern, command in ARGUMENT_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            return command, match.group(1)
+    if len(text) >= FUZZY_MIN_LENGTH and " " not in text:
+        for command in COMMAND_ALIASES:
+            if _one_typo(text, command):
+                return command, None
+    return None, None
+
+
+def _one_typo(text, word):
+    """True when ``text`` is ``word`` with one letter replaced or two adjacent letters swapped"""
+    if len(text) != len(word) or text == word:
+        return False
+    diffs = [i for i, (a, b) in enumerate(zip(text, word)) if a != b]
+    if len(diffs) == 1:
+        return True
+    return (len(diffs) == 2 and diffs[1] == diffs[0] + 1
+            and text[diffs[0]] == word[diffs[1]] and text[diffs[1]] == word[diffs[0]])
+
+
+def classify_command(message):
+    """Return the canonical command for a message, or None"""
+    return classify(message)[0]
+
+
+def option_text(option):
+    """Strip the "a) " prefix from a quiz option"""
+    return re.sub(r"^\s*\(?[a-dA-D]\)\s*", "", option)
+
+
+def parse_quiz_answer(message, options=()):
+    """Return the option letter a student chose, or None if it can't be told locally"""
+    text = normalize(message)
+    if not text:
+        return None
+    leading = _LEADING_LETTER.match(message)
+    if leading:
+        return leading.group(1).lower()
+    for pattern in _ANSWER_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            return match.group(1)
+
+    # The student may have typed (part of) the option text instead of the letter
+    bare = _bare(text)
+    if not options or len(bare) < 3:
+        return None
+    best_letter, best_score = None, 0.0
+    for letter, option in zip(OPTION_LETTERS, options):
+        candidate = _bare(normalize(option_text(option)))
+        if not candidate:
+            continue
+        if bare == candidate:
+            return letter
+        score = SequenceMatcher(None, bare, candidate).ratio()
+        if len(bare) >= 6 and bare in candidate:
+            score = max(score, 0.9)
+        if score > best_score:
+            best_letter, best_score = letter, score
+    if best_score >= 0.75:
+        return best_letter
+    return None
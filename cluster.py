@@ -0,0 +1,179 @@
+"""Sticky per-student routing across several nodes.
+
+Each node registers its internal URL in a shared ``cluster_nodes`` table and
+refreshes a heartbeat every CLUSTER_HEARTBEAT seconds. Live nodes are placed
+on a consistent-hash ring (CLUSTER_VNODES virtual nodes each) and the node
+owning a student's ``From`` number handles all of their turns: other nodes
+forward the webhook to it over HTTP and relay its reply. Students therefore
+have a single writer, and their prompt prefix and prefetched lessons stay
+hot on one node.
+
+When a node joins or leaves (stops heartbeating for CLUSTER_NODE_TTL
+seconds), the ring is rebuilt and ``on_change(previous_ring, ring)`` lets
+the app flush and drop students whose owner changed. Only the students on
+the moved ring segments change owner.
+
+A node is one process (run gunicorn with WEB_CONCURRENCY=1 and more threads
+per node), identified by CLUSTER_NODE_URL; forwarded requests carry
+CLUSTER_SECRET so they are handled where they land. ``start()`` is called
+after the fork, so the heartbeat thread runs in the worker.
+"""
+import atexit
+import bisect
+import hashlib
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from db import LazyConnection
+
+FORWARD_HEADER = "X-Cluster-Secret"
+NODE_HEADER = "X-Cluster-Node"
+
+def _hash(value):
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring of node ids"""
+
+    def __init__(self, nodes=(), vnodes=64):
+        self.nodes = sorted(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        """Node owning ``key``, or None on an empty ring"""
+        if not self._owners:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class Cluster:
+    """Membership, ownership and forwarding for one node"""
+
+    def __init__(self, node_url, path, secret="", heartbeat=2.0, ttl=None, vnodes=64, timeout=30.0,
+                 on_change=None):
+        self.node_id = node_url.rstrip("/")
+        self.secret = secret
+        self.heartbeat = heartbeat
+        self.ttl = ttl or heartbeat * 3
+        self.vnodes = vnodes
+        self.timeout = timeout
+        self.on_change = on_change
+        self.ring = HashRing([self.node_id], vnodes)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=32))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=32))
+        self.path = path
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS cluster_nodes (
+                node_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            );
+        """)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Register this node and keep the membership fresh in the background (once per process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return self
+            self._pid = os.getpid()
+        self.refresh()
+        self._thread = threading.Thread(target=self._loop, name="cluster-heartbeat", daemon=True)
+        self._thread.start()
+        atexit.register(self.leave)
+        return self
+
+    def _loop(self):
+        while True:
+            time.sleep(self.heartbeat)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing cluster membership: {e}")
+
+    def refresh(self):
+        """Heartbeat, then rebuild the ring if the set of live nodes changed"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cluster_nodes (node_id, heartbeat_at) VALUES (?, ?)",
+                             (self.node_id, now))
+            live = [row[0] for row in self._db.execute(
+                "SELECT node_id FROM cluster_nodes WHERE heartbeat_at >= ?", (now - self.ttl,))]
+            if sorted(live) == self.ring.nodes:
+                return
+            previous, self.ring = self.ring, HashRing(live, self.vnodes)
+        metrics.set_gauge("cluster_nodes", len(live))
+        metrics.increment("cluster_rebalances")
+        print(f"Cluster membership changed: {', '.join(sorted(live))}")
+        if self.on_change is not None:
+            self.on_change(previous, self.ring)
+
+    def leave(self):
+        """Deregister so the other nodes take over right away"""
+        with self._lock:
+            if self._pid is None:
+                return
+            self._db.execute("DELETE FROM cluster_nodes WHERE node_id = ?", (self.node_id,))
+
+    def owns(self, key, ring=None):
+        return (ring or self.ring).owner(key) == self.node_id
+
+    def is_forwarded(self, headers):
+        """True for a request another node forwarded here"""
+        return bool(self.secret) and headers.get(FORWARD_HEADER) == self.secret
+
+    def forward(self, key, path, values):
+        """Send a request to the node owning ``key``.
+
+        Returns (status, body, content type, owner), or None when this node
+        owns the key or the owner can't be reached or fails to handle it (the
+        caller then handles it).
+        """
+        owner = self.ring.owner(key)
+        if owner is None or owner == self.node_id:
+            return None
+        try:
+            response = self.session.post(f"{owner}{path}", data=values, timeout=self.timeout,
+                                         headers={FORWARD_HEADER: self.secret})
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Error forwarding to {owner}, handling locally: {e}")
+            metrics.increment("cluster_forward_failed")
+            return None
+        metrics.increment("cluster_forwarded")
+        return response.status_code, response.content, response.headers.get("Content-Type"), owner
+
+
+def cluster_from_env(path, on_change=None):
+    """Build the cluster configured by CLUSTER_* variables, or None when not clustered"""
+    node_url = os.environ.get("CLUSTER_NODE_URL")
+    if not node_url:
+        return None
+    secret = os.environ.get("CLUSTER_SECRET")
+    if not secret:
+        raise ValueError("CLUSTER_SECRET must be set when CLUSTER_NODE_URL is configured")
+    if path is None:
+        raise ValueError("Clustering needs a shared state database (STATE_DURABILITY can't be 'memory')")
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        print("Warning: clustered nodes should run one worker (WEB_CONCURRENCY=1) so each student has one writer")
+    return Cluster(
+        node_url,
+        path,
+        secret=secret,
+        heartbeat=float(os.environ.get("CLUSTER_HEARTBEAT", 2.0)),
+        ttl=float(os.environ.get("CLUSTER_NODE_TTL", 0)) or None,
+        vnodes=int(os.environ.get("CLUSTER_VNODES", 64)),
+        timeout=float(os.environ.get("CLUSTER_FORWARD_TIMEOUT", 30)),
+        on_change=on_change,
+    )
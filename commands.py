@@ -0,0 +1,39 @@
+"""Table-driven dispatch of the fixed student commands.
+
+Handlers register under a canonical command name; messages are mapped to
+those names by the alias table in classifier.py, so dispatch is a normalize
+step plus dictionary lookups and runs before any context routing.
+"""
+from classifier import classify
+
+
+class CommandDispatcher:
+    """Registry of command handlers keyed by canonical command name"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.help_entries = []
+
+    def command(self, name, usage=None, description=None):
+        """Decorator registering ``handler(state, argument)`` for a command"""
+        def decorator(handler):
+            self.handlers[name] = handler
+            if description:
+                self.help_entries.append((usage or f"*{name}*", description))
+            return handler
+        return decorator
+
+    def dispatch(self, message, state):
+        """Run the handler for a command message; returns None for other messages"""
+        command, argument = classify(message)
+        handler = self.handlers.get(command)
+        if handler is None:
+            return None
+        return handler(state, argument)
+
+    def help_text(self):
+        """Render the list of registered commands"""
+        lines = ["📚 *Comandos disponíveis*"]
+        lines += [f"- {usage}: {description}" for usage, description in self.help_entries]
+        lines.append("Você também pode fazer qualquer pergunta relacionada ao empreendedorismo a qualquer momento!")
+        return "\n".join(lines)
@@ -0,0 +1,185 @@
+"""Compiled navigation index for the course structure.
+
+The index is built once from the ``MODULES`` mapping and answers every
+navigation question (next/previous lesson, module boundaries, progress,
+prerequisites) with dictionary or list lookups instead of scanning the
+module order on each transition.
+"""
+
+
+class Lesson:
+    """A single submodule of the course, flattened into the global lesson order"""
+
+    __slots__ = ("ordinal", "module", "submodule", "title", "module_title",
+                 "previous", "next")
+
+    def __init__(self, ordinal, module, submodule, title, module_title):
+        self.ordinal = ordinal
+        self.module = module
+        self.submodule = submodule
+        self.title = title
+        self.module_title = module_title
+        self.previous = None
+        self.next = None
+
+    def __repr__(self):
+        return f"Lesson({self.ordinal}, {self.module!r}, {self.submodule})"
+
+
+class CourseIndex:
+    """Precomputed course graph with O(1) navigation"""
+
+    def __init__(self, modules, terminal_module="fim"):
+        self.modules = modules
+        self.terminal_module = terminal_module
+        self.module_order = [name for name in modules if name != terminal_module]
+        self.module_position = {name: i for i, name in enumerate(self.module_order)}
+        self.lessons = []
+        self.module_lessons = {}
+        self.prerequisites = {}
+
+        previous = None
+        for name in self.module_order:
+            module = modules[name]
+            lessons = []
+            for i, title in enumerate(module["submodulos"]):
+                lesson = Lesson(len(self.lessons), name, i, title, module["titulo"])
+                if previous is not None:
+                    previous.next = lesson
+                    lesson.previous = previous
+                previous = lesson
+                self.lessons.append(lesson)
+                lessons.append(lesson)
+            self.module_lessons[name] = lessons
+
+            # Modules may declare explicit prerequisites, otherwise the
+            # previous module in the course order is required
+            position = self.module_position[name]
+            default = [self.module_order[position - 1]] if position else []
+            self.prerequisites[name] = list(module.get("prerequisitos", default))
+
+        self.total_lessons = len(self.lessons)
+
+    # --- Lookups ---
+
+    def lesson(self, module_name, submodule_index):
+        """Return the lesson at an exact position, or None if it doesn't exist"""
+        lessons = self.module_lessons.get(module_name)
+        if lessons is None or not 0 <= submodule_index < len(lessons):
+            return None
+        return lessons[submodule_index]
+
+    def lesson_at(self, ordinal):
+        """Return the lesson with the given global ordinal, or None"""
+        if 0 <= ordinal < self.total_lessons:
+            return self.lessons[ordinal]
+        return None
+
+    def first_lesson(self, module_name):
+        """Return the first lesson of a module (or the next non-empty module)"""
+        lessons = self.module_lessons.get(module_name)
+        if lessons is None:
+            return None
+        if lessons:
+            return lessons[0]
+        return self._first_lesson_after(module_name)
+
+    def module_by_number(self, number):
+        """Resolve a human module number ("módulo 2") to its key, or None"""
+        name = f"modulo{number}"
+        if name in self.module_position:
+            return name
+        return None
+
+    def _first_lesson_after(self, module_name):
+        for name in self.module_order[self.module_position[module_name] + 1:]:
+            if self.module_lessons[name]:
+                return self.module_lessons[name][0]
+        return None
+
+    # --- Navigation ---
+
+    def resolve(self, module_name, submodule_index):
+        """Resolve a (possibly out-of-range) position to a lesson.
+
+        Returns ``(lesson, transitions)`` where ``transitions`` is the list of
+        ``(finished_module, next_module)`` boundaries crossed on the way.
+        ``lesson`` is None once the course is finished.
+        """
+        if module_name == self.terminal_module:
+            return None, []
+        if module_name not in self.module_position:
+            # The module was removed from the catalogue: restart from the beginning
+            return (self.lessons[0] if self.lessons else None), []
+
+        lesson = self.lesson(module_name, submodule_index)
+        if lesson is not None:
+            return lesson, []
+
+        # Past the end of the module: walk forward over module boundaries
+        transitions = []
+        position = self.module_position[module_name]
+        while True:
+            finished = self.module_order[position]
+            position += 1
+            if position >= len(self.module_order):
+                if self.terminal_module in self.modules:
+                    transitions.append((finished, self.terminal_module))
+                return None, transitions
+            following = self.module_order[position]
+            transitions.append((finished, following))
+            if self.module_lessons[following]:
+                return self.module_lessons[following][0], transitions
+
+    def advance(self, module_name, submodule_index, steps=1):
+        """Move ``steps`` lessons forward from a position.
+
+        Returns ``(lesson, transitions)`` like :meth:`resolve`.
+        """
+        lesson, transitions = self.resolve(module_name, submodule_index)
+        for _ in range(steps):
+            if lesson is None:
+                break
+            following = lesson.next
+            if following is None:
+                if self.terminal_module in self.modules:
+                    transitions.append((lesson.module, self.terminal_module))
+                return None, transitions
+            if following.module != lesson.module:
+                transitions.extend(self._boundaries(lesson.module, following.module))
+            lesson = following
+        return lesson, transitions
+
+    def _boundaries(self, from_module, to_module):
+        """List the module boundaries between two modules, including empty ones"""
+        start = self.module_position[from_module]
+        end = self.module_position[to_module]
+        return [(self.module_order[i], self.module_order[i + 1]) for i in range(start, end)]
+
+    # --- Progress ---
+
+    def completed_lessons(self, module_name, submodule_index):
+        """Number of lessons completed before the given position"""
+        if module_name == self.terminal_module:
+            return self.total_lessons
+        lesson, _ = self.resolve(module_name, submodule_index)
+        if lesson is None:
+            return self.total_lessons
+        return lesson.ordinal
+
+    def percent_complete(self, module_name, submodule_index):
+        """Course completion percentage (0-100) for a position"""
+        if not self.total_lessons:
+            return 100
+        done = self.completed_lessons(module_name, submodule_index)
+        return round(100 * done / self.total_lessons)
+
+    def prerequisites_met(self, module_name, reached_module):
+        """Check whether a student positioned at ``reached_module`` may open ``module_name``"""
+        if reached_module == self.terminal_module:
+            return True
+        reached = self.module_position.get(reached_module, -1)
+        if self.module_position.get(module_name, len(self.module_order)) <= reached:
+            return True
+        return all(self.module_position[req] < reached
+                   for req in self.prerequisites.get(module_name, []))
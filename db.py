@@ -0,0 +1,42 @@
+"""Fork-safe SQLite connections for the stores sharing the state database.
+
+gunicorn imports the app once in the master (``preload_app``) and forks the
+workers from it, and a SQLite connection must never be used on both sides of
+a fork. Stores therefore hold a ``LazyConnection``: the real connection is
+opened on first use in each process, and the schema is created then.
+"""
+import os
+import sqlite3
+import threading
+
+
+class LazyConnection:
+    """A SQLite connection opened on first use, once per process"""
+
+    def __init__(self, path, schema=None):
+        self.path = path or ":memory:"
+        self.schema = schema
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # A connection inherited from the parent is abandoned, never used or closed
+                    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                    if self.schema:
+                        conn.executescript(self.schema)
+                    self._conn = conn
+                    self._pid = os.getpid()
+        return self._conn
+
+    def execute(self, *args):
+        return self.connection().execute(*args)
+
+    def executemany(self, *args):
+        return self.connection().executemany(*args)
+
+    def executescript(self, script):
+        return self.connection().executescript(script)
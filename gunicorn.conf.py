@@ -0,0 +1,25 @@
+# Gunicorn settings for the WhatsApp webhook
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+
+# Import the app once in the master; the model client and the SQLite
+# connections (see db.py) are opened lazily in each worker, so nothing
+# fork-unsafe is shared with the children
+preload_app = True
+
+
+def post_fork(server, worker):
+    import llm
+    llm.reset()
+    # Join the cluster from the worker, where the heartbeat thread keeps running
+    import app
+    if app.cluster is not None:
+        app.cluster.start()
+    # Embedded job workers pick up jobs left over from before a restart
+    app.job_queue.start()
+    # Points earned before the ledger existed (a no-op once done)
+    app.backfill_leaderboard()
@@ -0,0 +1,129 @@
+"""Deduplication of Twilio webhook retries by MessageSid.
+
+When a reply takes too long, Twilio retries the same message. The first
+delivery claims its MessageSid; a retry either gets the stored reply back or,
+while the first delivery is still being processed, waits for it instead of
+running the handlers (and the model) a second time.
+
+Claims live in a bounded in-memory LRU with a TTL and, when a database path is
+given, in a shared SQLite table so retries landing on another worker are
+recognised too. A claim without a reply is only held for ``lease`` seconds
+(about the request timeout): if the worker handling it died, a later retry
+takes the message over instead of being answered with nothing until the TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from db import LazyConnection
+
+NEW = "new"
+DONE = "done"
+BUSY = "busy"
+
+
+class MessageDeduplicator:
+    """TTL-expiring seen-set of MessageSids and their rendered replies"""
+
+    def __init__(self, path=None, ttl=3600, max_entries=10000, wait=10.0, lease=60.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait = wait
+        self.lease = lease
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._last_prune = 0.0
+        if path:
+            self._db = LazyConnection(path, schema="""
+                CREATE TABLE IF NOT EXISTS processed_messages (
+                    message_sid TEXT PRIMARY KEY,
+                    reply TEXT,
+                    created_at REAL NOT NULL
+                );
+            """)
+
+    def _remember(self, message_sid, reply):
+        self._seen[message_sid] = (time.time(), reply)
+        self._seen.move_to_end(message_sid)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _prune(self, now):
+        while self._seen:
+            sid, (created_at, _) = next(iter(self._seen.items()))
+            if now - created_at < self.ttl:
+                break
+            del self._seen[sid]
+        if self._db is not None and now - self._last_prune >= 60:
+            self._last_prune = now
+            self._db.execute("DELETE FROM processed_messages WHERE created_at < ?", (now - self.ttl,))
+
+    def claim(self, message_sid):
+        """Claim a MessageSid: returns (NEW, None), (DONE, reply) or (BUSY, None)"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            entry = self._seen.get(message_sid)
+            if entry is not None and entry[1] is None and now - entry[0] >= self.lease:
+                # Claimed here, but never completed within the lease
+                entry = None
+            if entry is None and self._db is not None:
+                inserted = self._db.execute(
+                    "INSERT OR IGNORE INTO processed_messages (message_sid, reply, created_at) VALUES (?, NULL, ?)",
+                    (message_sid, now)).rowcount
+                if inserted:
+                    self._remember(message_sid, None)
+                    return NEW, None
+                # Take over a claim whose lease ran out (created_at is when it was claimed)
+                taken = self._db.execute(
+                    "UPDATE processed_messages SET created_at = ? WHERE message_sid = ? AND reply IS NULL"
+                    " AND created_at < ?", (now, message_sid, now - self.lease)).rowcount
+                if taken:
+                    metrics.increment("webhook_claims_taken_over")
+                    self._remember(message_sid, None)
+                    return NEW, None
+                row = self._db.execute("SELECT created_at, reply FROM processed_messages WHERE message_sid = ?",
+                                       (message_sid,)).fetchone()
+                entry = tuple(row) if row else None
+            if entry is None:
+                self._remember(message_sid, None)
+                return NEW, None
+        reply = entry[1]
+        if reply is None:
+            return BUSY, None
+        metrics.increment("webhook_duplicates_replayed")
+        return DONE, reply
+
+    def complete(self, message_sid, reply):
+        """Store the rendered reply for a claimed MessageSid"""
+        with self._lock:
+            self._remember(message_sid, reply)
+            if self._db is not None:
+                self._db.execute("UPDATE processed_messages SET reply = ? WHERE message_sid = ?",
+                                 (reply, message_sid))
+
+    def release(self, message_sid):
+        """Forget a claim whose processing failed, so a retry is handled normally"""
+        with self._lock:
+            self._seen.pop(message_sid, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM processed_messages WHERE message_sid = ?", (message_sid,))
+
+    def wait_for(self, message_sid):
+        """Wait (up to ``wait`` seconds) for the first delivery to finish.
+
+        Returns the result of the last claim attempt: DONE with the reply, NEW
+        if the first delivery failed and this caller now owns the message, or
+        BUSY if it is still being processed.
+        """
+        deadline = time.time() + self.wait
+        while True:
+            status, reply = self.claim(message_sid)
+            if status != BUSY:
+                return status, reply
+            if time.time() >= deadline:
+                metrics.increment("webhook_duplicates_suppressed")
+                return status, None
+            time.sleep(0.2)
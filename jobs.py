@@ -0,0 +1,388 @@
+"""Durable background job queue for slow model work.
+
+Jobs are rows of a ``jobs`` table in the state database, so they survive
+restarts and every process sharing the database can work on them:
+
+* Lower ``priority`` runs first (INTERACTIVE before NORMAL before
+  SPECULATIVE), then oldest first.
+* Each job type is registered with a handler, a concurrency limit (running
+  jobs of that type across all processes; JOBS_CONCURRENCY overrides it as
+  ``type=limit,...``), a visibility timeout and a number of attempts.
+* A claimed job is leased for its timeout. A job whose worker died becomes
+  claimable again once the lease runs out; failures are retried with
+  exponential backoff, and jobs out of attempts are dead-lettered
+  (status ``dead``) for inspection and requeueing.
+* ``affinity`` pins a job to the workers of one node (e.g. work that
+  changes a student's state runs on the node that owns the student), and
+  ``in_process`` job types are only run by the web processes' own workers.
+  Any gunicorn worker of the node may claim them, so their handlers reload
+  whatever state they touch instead of trusting a per-process cache.
+
+Each web process runs a few embedded worker threads (JOBS_WORKERS, limited
+to JOBS_EMBEDDED_TYPES when set), started by ``start`` after the fork. Slow speculative work can be moved to a
+separate process next to gunicorn:
+
+    python jobs.py work [--types T1,T2] [--threads N]
+    python jobs.py stats
+    python jobs.py dead [--type T]
+    python jobs.py requeue [--type T]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import metrics
+from db import LazyConnection
+
+INTERACTIVE = 0
+NORMAL = 5
+SPECULATIVE = 9
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"
+
+# Finished jobs are kept this long for ``wait`` and stats
+DONE_RETENTION = 3600
+
+
+class JobType:
+    __slots__ = ("name", "handler", "concurrency", "timeout", "max_attempts", "backoff", "in_process")
+
+    def __init__(self, name, handler, concurrency, timeout, max_attempts, backoff, in_process):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.in_process = in_process
+
+
+class JobQueue:
+    """SQLite-backed priority queue with leases, retries and a dead-letter status"""
+
+    def __init__(self, path=None, workers=2, poll_interval=0.5, concurrency=None, affinity=None,
+                 embedded_types=None):
+        self.types = {}
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.concurrency = concurrency or {}
+        self.affinity = affinity
+        self.embedded_types = embedded_types
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                dedupe_key TEXT,
+                affinity TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, priority, run_at);
+            CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key)
+                WHERE dedupe_key IS NOT NULL AND status IN ('queued', 'running');
+        """)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._last_prune = 0.0
+
+    @property
+    def worker_id(self):
+        # Read per call: the queue is created in the master before gunicorn forks
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def register(self, name, handler, concurrency=2, timeout=120.0, max_attempts=3, backoff=5.0, in_process=False):
+        """Register ``handler(payload)`` for a job type"""
+        self.types[name] = JobType(name, handler, self.concurrency.get(name, concurrency), timeout,
+                                   max_attempts, backoff, in_process)
+
+    def handler(self, name, **options):
+        """Decorator form of ``register``"""
+        def decorator(function):
+            self.register(name, function, **options)
+            return function
+        return decorator
+
+    # --- Producing ---
+
+    def enqueue(self, name, payload, priority=NORMAL, delay=0.0, dedupe_key=None, affinity=None):
+        """Add a job; returns its id (the existing job's id for a queued duplicate ``dedupe_key``)"""
+        now = time.time()
+        with self._lock:
+            # One write transaction: a duplicate found by the insert can't finish before it's looked up
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # The partial unique index on dedupe_key makes the insert a no-op for a live duplicate
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO jobs (type, payload, priority, status, dedupe_key, affinity, run_at,"
+                    " created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name, json.dumps(payload, ensure_ascii=False), priority, QUEUED, dedupe_key, affinity,
+                     now + delay, now))
+                inserted = cursor.rowcount
+                if inserted:
+                    job_id = cursor.lastrowid
+                else:
+                    row = self._db.execute("SELECT id FROM jobs WHERE dedupe_key = ? AND status IN (?, ?)",
+                                           (dedupe_key, QUEUED, RUNNING)).fetchone()
+                    if row is None:
+                        raise RuntimeError(f"{name} job was neither queued nor found for '{dedupe_key}'")
+                    job_id = row[0]
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if inserted:
+            metrics.increment(f"jobs_enqueued_{name}")
+            self._wakeup.set()
+        return job_id
+
+    def status(self, job_id):
+        """Current status of a job (None once pruned)"""
+        with self._lock:
+            row = self._db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def backlog(self, below=SPECULATIVE):
+        """Number of runnable jobs waiting, counting only priorities under ``below``"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND run_at <= ? AND priority < ?",
+                                    (QUEUED, time.time(), below)).fetchone()[0]
+
+    def wait(self, job_id, timeout):
+        """Wait up to ``timeout`` seconds for a job to finish; returns its last status"""
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.status(job_id)
+            if status not in (QUEUED, RUNNING) or time.monotonic() >= deadline:
+                return status
+            time.sleep(0.05)
+
+    # --- Consuming ---
+
+    def claim(self, types=None):
+        """Lease the next runnable job, or return None"""
+        types = [name for name in (types or self.types) if name in self.types]
+        if not types:
+            return None
+        now = time.time()
+        marks = ",".join("?" * len(types))
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                running = dict(self._db.execute(
+                    f"SELECT type, COUNT(*) FROM jobs WHERE status = ? AND lease_until >= ? AND type IN ({marks})"
+                    " GROUP BY type", [RUNNING, now] + types).fetchall())
+                open_types = [name for name in types if running.get(name, 0) < self.types[name].concurrency]
+                job = None
+                if open_types:
+                    marks = ",".join("?" * len(open_types))
+                    candidates = self._db.execute(
+                        f"SELECT id, type, payload, attempts FROM jobs WHERE type IN ({marks})"
+                        " AND (affinity IS NULL OR affinity = ?)"
+                        " AND ((status = ? AND run_at <= ?) OR (status = ? AND lease_until < ?))"
+                        " ORDER BY priority, run_at, id LIMIT 20",
+                        open_types + [self.affinity, QUEUED, now, RUNNING, now]).fetchall()
+                    for job_id, name, payload, attempts in candidates:
+                        job_type = self.types[name]
+                        if attempts >= job_type.max_attempts:
+                            # Its last worker never came back
+                            self._finish(job_id, DEAD, "visibility timeout expired", now)
+                            metrics.increment(f"jobs_dead_{name}")
+                            continue
+                        self._db.execute(
+                            "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, worker = ?"
+                            " WHERE id = ?", (RUNNING, now + job_type.timeout, self.worker_id, job_id))
+                        job = (job_id, job_type, json.loads(payload), attempts + 1)
+                        break
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return job
+
+    def _finish(self, job_id, status, error, now):
+        self._db.execute("UPDATE jobs SET status = ?, last_error = ?, finished_at = ?, lease_until = NULL"
+                         " WHERE id = ?", (status, error, now, job_id))
+
+    def complete(self, job_id):
+        with self._lock:
+            self._finish(job_id, DONE, None, time.time())
+
+    def fail(self, job_id, job_type, attempts, error):
+        """Retry a failed job later, or dead-letter it when out of attempts"""
+        now = time.time()
+        with self._lock:
+            if attempts >= job_type.max_attempts:
+                self._finish(job_id, DEAD, error, now)
+                metrics.increment(f"jobs_dead_{job_type.name}")
+                return
+            self._db.execute("UPDATE jobs SET status = ?, run_at = ?, lease_until = NULL, last_error = ?"
+                             " WHERE id = ?", (QUEUED, now + job_type.backoff * 2 ** (attempts - 1), error, job_id))
+        metrics.increment(f"jobs_retried_{job_type.name}")
+
+    def run_one(self, types=None):
+        """Claim and run one job; returns False when nothing was runnable"""
+        job = self.claim(types)
+        if job is None:
+            return False
+        job_id, job_type, payload, attempts = job
+        try:
+            job_type.handler(payload)
+        except Exception as e:
+            print(f"Error running {job_type.name} job {job_id}: {e}")
+            metrics.increment(f"jobs_failed_{job_type.name}")
+            self.fail(job_id, job_type, attempts, str(e)[:500])
+        else:
+            self.complete(job_id)
+            metrics.increment(f"jobs_completed_{job_type.name}")
+        return True
+
+    def work(self, types=None, stop=None):
+        """Run jobs until ``stop`` is set"""
+        while stop is None or not stop.is_set():
+            try:
+                if self.run_one(types):
+                    continue
+                self._prune()
+            except Exception as e:
+                print(f"Error in job worker: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """Start the embedded worker threads (once per process, after a fork)"""
+        if self._pid == os.getpid() or self.workers <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self.work, args=(self.embedded_types,), name=f"jobs-{i}", daemon=True).start()
+
+    # --- Maintenance ---
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE status = ? AND finished_at < ?", (DONE, now - DONE_RETENTION))
+
+    def dead(self, name=None, limit=50):
+        """Dead-lettered jobs, newest first"""
+        query = "SELECT id, type, payload, attempts, last_error, finished_at FROM jobs WHERE status = ?"
+        params = [DEAD]
+        if name:
+            query += " AND type = ?"
+            params.append(name)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY finished_at DESC LIMIT ?", params + [limit]).fetchall()
+        return [{"id": row[0], "type": row[1], "payload": json.loads(row[2]), "attempts": row[3],
+                 "error": row[4], "failed_at": row[5]} for row in rows]
+
+    def requeue(self, name=None):
+        """Give dead-lettered jobs a fresh set of attempts; returns how many"""
+        query = "UPDATE jobs SET status = ?, attempts = 0, run_at = ?, finished_at = NULL WHERE status = ?"
+        params = [QUEUED, time.time(), DEAD]
+        if name:
+            query += " AND type = ?"
+            params.append(name)
+        with self._lock:
+            count = self._db.execute(query, params).rowcount
+        self._wakeup.set()
+        return count
+
+    def stats(self):
+        """Job counts by type and status"""
+        with self._lock:
+            rows = self._db.execute("SELECT type, status, COUNT(*) FROM jobs GROUP BY type, status").fetchall()
+        counts = {}
+        for name, status, count in rows:
+            counts.setdefault(name, {})[status] = count
+        return counts
+
+
+def _parse_limits(value):
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        if not limit.isdigit():
+            raise ValueError(f"Invalid JOBS_CONCURRENCY entry '{item}' (expected type=limit)")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def queue_from_env(path, affinity=None):
+    """Build the job queue configured by JOBS_* environment variables"""
+    embedded = os.environ.get("JOBS_EMBEDDED_TYPES")
+    return JobQueue(
+        path,
+        workers=int(os.environ.get("JOBS_WORKERS", 4)),
+        poll_interval=float(os.environ.get("JOBS_POLL_INTERVAL", 0.5)),
+        concurrency=_parse_limits(os.environ.get("JOBS_CONCURRENCY", "")),
+        affinity=affinity,
+        embedded_types=[name.strip() for name in embedded.split(",") if name.strip()] if embedded else None,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run or inspect background jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    work_parser = commands.add_parser("work", help="run jobs in this process")
+    work_parser.add_argument("--types", help="comma-separated job types (default: all)")
+    work_parser.add_argument("--threads", type=int, default=2)
+    commands.add_parser("stats", help="job counts by type and status")
+    for name in ("dead", "requeue"):
+        command = commands.add_parser(name, help=f"{'list' if name == 'dead' else 'requeue'} dead-lettered jobs")
+        command.add_argument("--type", help="only this job type")
+    args = parser.parse_args(argv)
+
+    # The app registers the handlers; its own embedded workers stay off here
+    os.environ["JOBS_WORKERS"] = "0"
+    import app
+    queue = app.job_queue
+
+    if args.command == "work":
+        external = sorted(name for name, job_type in queue.types.items() if not job_type.in_process)
+        types = [name.strip() for name in args.types.split(",")] if args.types else external
+        for name in types:
+            if name not in external:
+                parser.error(f"'{name}' jobs can't run outside the web process (available: {', '.join(external)})")
+        threads = [threading.Thread(target=queue.work, args=(types,), name=f"jobs-{i}", daemon=True)
+                   for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        print(f"Working on {', '.join(types)} with {args.threads} threads")
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "stats":
+        print(json.dumps(queue.stats(), indent=2))
+    elif args.command == "dead":
+        for job in queue.dead(args.type):
+            print(json.dumps(job, ensure_ascii=False))
+    else:
+        print(f"Requeued {queue.requeue(args.type)} jobs", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Points ledger and ranking index.
+
+Every points change (quiz awards, mentoria redemptions) is appended to a
+ledger table. Totals per cohort are kept in an order-statistics index (a
+Fenwick tree over point values), so rank lookups and top-k queries don't
+scan every student. Each process keeps its own index and, before every
+query, applies the ledger rows other processes appended since the last one
+it saw.
+"""
+import threading
+import time
+
+from db import LazyConnection
+
+LEDGER_TABLE = """
+    CREATE TABLE IF NOT EXISTS points_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cohort TEXT NOT NULL,
+        student_id TEXT NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+"""
+
+
+class _FenwickTree:
+    """Counts of students per score, growing as scores get larger"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.total = 0
+
+    def _grow(self, score):
+        counts = [self.count_at(i) for i in range(self.size)]
+        while self.size <= score:
+            self.size *= 2
+        self.tree = [0] * (self.size + 1)
+        self.total = 0
+        for i, count in enumerate(counts):
+            if count:
+                self.add(i, count)
+
+    def add(self, score, delta):
+        if score >= self.size:
+            self._grow(score)
+        self.total += delta
+        i = score + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_up_to(self, score):
+        """Number of students with a score <= ``score``"""
+        i = min(score + 1, self.size)
+        result = 0
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+
+    def count_at(self, score):
+        return self.count_up_to(score) - (self.count_up_to(score - 1) if score > 0 else 0)
+
+    def kth_smallest(self, k):
+        """Score of the k-th lowest student (1-based)"""
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            following = position + step
+            if following <= self.size and self.tree[following] < k:
+                position = following
+                k -= self.tree[following]
+            step >>= 1
+        return position
+
+
+class _CohortIndex:
+    def __init__(self):
+        self.scores = {}
+        self.members = {}
+        self.tree = _FenwickTree()
+
+    def set_score(self, student_id, score):
+        score = max(score, 0)
+        previous = self.scores.get(student_id)
+        if previous == score:
+            return
+        if previous is not None:
+            self.tree.add(previous, -1)
+            self.members[previous].discard(student_id)
+            if not self.members[previous]:
+                del self.members[previous]
+        self.scores[student_id] = score
+        self.tree.add(score, 1)
+        self.members.setdefault(score, set()).add(student_id)
+
+
+class Leaderboard:
+    """Append-only points ledger with O(log n) rank and top-k queries"""
+
+    def __init__(self, path=":memory:"):
+        self._db = LazyConnection(path, schema=LEDGER_TABLE + """;
+            CREATE TABLE IF NOT EXISTS ledger_backfills (
+                name TEXT PRIMARY KEY,
+                done_at REAL NOT NULL
+            );
+        """)
+        self._lock = threading.Lock()
+        self._cohorts = {}
+        # Id of the last ledger row applied to the index (None: not built yet)
+        self._last_id = None
+
+    def _rebuild(self):
+        """Replay the ledger into the in-memory index"""
+        self._db.execute("BEGIN")
+        try:
+            last_id = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM points_ledger").fetchone()[0]
+            rows = self._db.execute(
+                "SELECT cohort, student_id, SUM(delta) FROM points_ledger WHERE id <= ? GROUP BY cohort, student_id",
+                (last_id,)).fetchall()
+        finally:
+            self._db.execute("COMMIT")
+        for cohort, student_id, total in rows:
+            self._cohort(cohort).set_score(student_id, total)
+        self._last_id = last_id
+
+    def _catch_up(self):
+        """Apply ledger rows appended since the last query (by any process)"""
+        if self._last_id is None:
+            self._rebuild()
+            return
+        rows = self._db.execute("SELECT id, cohort, student_id, delta FROM points_ledger WHERE id > ? ORDER BY id",
+                                (self._last_id,)).fetchall()
+        for row_id, cohort, student_id, delta in rows:
+            index = self._cohort(cohort)
+            index.set_score(student_id, index.scores.get(student_id, 0) + delta)
+            self._last_id = row_id
+
+    def _cohort(self, cohort):
+        index = self._cohorts.get(cohort)
+        if index is None:
+            index = self._cohorts[cohort] = _CohortIndex()
+        return index
+
+    def record(self, cohort, student_id, delta, reason):
+        """Append a points change and update the student's total"""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO points_ledger (cohort, student_id, delta, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+                (cohort, student_id, delta, reason, time.time()))
+            self._catch_up()
+
+    def backfill(self, totals):
+        """Bring the ledger in line with points earned before it existed.
+
+        ``totals`` yields (cohort, student_id, points) from the stored
+        student states. Runs once per database; returns how many students
+        were adjusted.
+        """
+        totals = list(totals)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._db.execute("SELECT 1 FROM ledger_backfills WHERE name = 'state_points'").fetchone():
+                    self._db.execute("COMMIT")
+                    return 0
+                recorded = {(cohort, student_id): total for cohort, student_id, total in self._db.execute(
+                    "SELECT cohort, student_id, SUM(delta) FROM points_ledger GROUP BY cohort, student_id")}
+                now = time.time()
+                rows = [(cohort, student_id, (points or 0) - recorded.get((cohort, student_id), 0), "backfill", now)
+                        for cohort, student_id, points in totals
+                        if (points or 0) != recorded.get((cohort, student_id), 0)]
+                self._db.executemany(
+                    "INSERT INTO points_ledger (cohort, student_id, delta, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+                    rows)
+                self._db.execute("INSERT INTO ledger_backfills (name, done_at) VALUES ('state_points', ?)", (now,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._catch_up()
+        return len(rows)
+
+    @staticmethod
+    def sync_totals(db, totals, reason):
+        """Append the ledger rows that bring each (cohort, student_id, points) total in line.
+
+        ``db`` is a connection to the ledger's database that is already in a
+        write transaction, so the rows commit or roll back with the caller's
+        own changes; indexes pick them up on their next query. Returns how
+        many students were adjusted.
+        """
+        db.execute(LEDGER_TABLE)
+        now = time.time()
+        rows = []
+        for cohort, student_id, points in totals:
+            recorded = db.execute(
+                "SELECT COALESCE(SUM(delta), 0) FROM points_ledger WHERE cohort = ? AND student_id = ?",
+                (cohort, student_id)).fetchone()[0]
+            if (points or 0) != recorded:
+                rows.append((cohort, student_id, (points or 0) - recorded, reason, now))
+        db.executemany(
+            "INSERT INTO points_ledger (cohort, student_id, delta, reason, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def clear(self):
+        """Delete the whole ledger"""
+        with self._lock:
+            self._db.execute("DELETE FROM points_ledger")
+            self._cohorts = {}
+            self._last_id = None
+
+    def reload(self):
+        """Rebuild every cohort from the ledger after another process changed it"""
+        with self._lock:
+            self._cohorts = {}
+            self._last_id = None
+
+    def resync(self, cohort, student_id):
+        """Reload a student's total from the ledger after another process changed it"""
+        with self._lock:
+            self._catch_up()
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(delta), 0) FROM points_ledger WHERE cohort = ? AND student_id = ?",
+                (cohort, student_id)).fetchone()[0]
+            self._cohort(cohort).set_score(student_id, total)
+
+    def score(self, cohort, student_id):
+        """Total points recorded for a student"""
+        with self._lock:
+            self._catch_up()
+            index = self._cohorts.get(cohort)
+            return index.scores.get(student_id, 0) if index else 0
+
+    def rank(self, cohort, student_id):
+        """Return (rank, cohort size) for a student; rank 1 is the top score"""
+        with self._lock:
+            self._catch_up()
+            index = self._cohort(cohort)
+            score = index.scores.get(student_id)
+            size = index.tree.total
+            if score is None:
+                score = 0
+                size += 1
+            above = index.tree.total - index.tree.count_up_to(score)
+            return above + 1, size
+
+    def top(self, cohort, k=10):
+        """Return the ``k`` best (student_id, score) pairs, highest first"""
+        with self._lock:
+            self._catch_up()
+            index = self._cohorts.get(cohort)
+            if index is None:
+                return []
+            result = []
+            remaining = index.tree.total
+            while remaining > 0 and len(result) < k:
+                score = index.tree.kth_smallest(remaining)
+                members = sorted(index.members.get(score, ()))
+                for student_id in members[:k - len(result)]:
+                    result.append((student_id, score))
+                remaining -= len(members)
+            return result
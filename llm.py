@@ -0,0 +1,108 @@
+"""Lazy, fork-friendly access to the Gemini model.
+
+``google.generativeai`` is only imported and the model only constructed the
+first time a worker actually needs it, so importing the app stays cheap and
+a missing key or unreachable backend degrades replies instead of preventing
+the process from booting.
+"""
+import os
+import threading
+
+DEFAULT_MODEL_NAME = 'models/gemini-2.0-pro-exp-02-05'  # Can be replaced with other AI models
+
+
+class ModelUnavailableError(RuntimeError):
+    """Raised when the model client cannot be initialized"""
+
+
+_models = {}
+_init_error = None
+_init_pid = None
+_lock = threading.Lock()
+
+
+def model_name():
+    """Name of the default model, overridable with GEMINI_MODEL"""
+    return os.environ.get("GEMINI_MODEL", DEFAULT_MODEL_NAME)
+
+
+def get_model(name=None):
+    """Return a model client, initializing the SDK on first use"""
+    global _init_error, _init_pid
+    name = name or model_name()
+
+    # Clients created before a fork must not be shared with the child
+    if _init_pid is not None and _init_pid != os.getpid():
+        reset()
+
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        model = _models.get(name)
+        if model is not None:
+            return model
+        api_key = os.environ.get("GOOGLE_API_KEY")
+        if not api_key:
+            _init_error = "Google API key (GOOGLE_API_KEY) not configured in .env file"
+            raise ModelUnavailableError(_init_error)
+        try:
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(name)
+        except Exception as e:
+            _init_error = f"Could not initialize model '{name}': {e}"
+            print(f"Error initializing model: {e}")
+            raise ModelUnavailableError(_init_error) from e
+        _models[name] = model
+        _init_error = None
+        _init_pid = os.getpid()
+        return model
+
+
+def supports_context_cache():
+    """True when the installed SDK can create server-side cached contents"""
+    try:
+        from google.generativeai import caching
+    except Exception:
+        return False
+    return hasattr(caching, "CachedContent")
+
+
+def cached_model(prefix, ttl, name=None):
+    """Create a server-side cache of ``prefix`` and return a model bound to it.
+
+    Returns None when the SDK has no context caching, so callers fall back to
+    sending the prefix with every request.
+    """
+    if not supports_context_cache():
+        return None
+    get_model(name)  # configures the SDK
+    import datetime
+
+    import google.generativeai as genai
+    from google.generativeai import caching
+    content = caching.CachedContent.create(
+        model=name or model_name(),
+        contents=[prefix],
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return genai.GenerativeModel.from_cached_content(cached_content=content)
+
+
+def is_ready():
+    """Return (ready, reason) for the readiness probe"""
+    try:
+        get_model()
+    except ModelUnavailableError as e:
+        return False, str(e)
+    return True, None
+
+
+def reset():
+    """Forget initialized clients (used after fork and by tests)"""
+    global _init_error, _init_pid
+    _models.clear()
+    _init_error = None
+    _init_pid = None
@@ -0,0 +1,199 @@
+"""Token and latency metering of model calls, with rolling budgets.
+
+Every model call is recorded with its input/output tokens and latency,
+attributed to the student, the call site (lesson, quiz, free_interaction...)
+and the course module. Records go to an ``llm_usage`` table for reports;
+hourly token totals per student and for the whole deployment go to
+``llm_usage_totals``, which is what budgets are checked against, so every
+worker sees the same spend.
+
+A student over LLM_STUDENT_TOKEN_BUDGET, or everyone once the deployment is
+over LLM_GLOBAL_TOKEN_BUDGET, within the last LLM_BUDGET_WINDOW_HOURS hours
+is switched to cheaper tiers by the app (shared lessons, static messages,
+LLM_BUDGET_MODEL for free interaction).
+"""
+import contextvars
+import csv
+import io
+import os
+import threading
+import time
+
+import metrics
+from db import LazyConnection
+
+GLOBAL_SCOPE = "*"
+
+# Student the current message belongs to; copied into prefetch/deferred work
+current_student = contextvars.ContextVar("current_student", default=None)
+
+REPORT_GROUPS = {
+    "student": "student_id",
+    "site": "site",
+    "module": "module",
+    "model": "model",
+    "tenant": "tenant",
+    "day": "date(ts, 'unixepoch')",
+}
+
+
+def estimate_tokens(text):
+    """Rough token count when the API doesn't report usage (~4 characters per token)"""
+    return max(len(text or "") // 4, 1)
+
+
+def response_usage(prompt, response, text):
+    """Return (input_tokens, output_tokens) reported by the API, or estimated"""
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+    output_tokens = getattr(usage, "candidates_token_count", None) or estimate_tokens(text)
+    return input_tokens, output_tokens
+
+
+class UsageMeter:
+    """Records model usage and answers budget checks"""
+
+    def __init__(self, path=None, student_budget=0, global_budget=0, window_hours=24, check_ttl=5.0,
+                 input_price=0.0, output_price=0.0):
+        self.student_budget = student_budget
+        self.global_budget = global_budget
+        self.window_hours = window_hours
+        self.check_ttl = check_ttl
+        self.input_price = input_price
+        self.output_price = output_price
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                tenant TEXT,
+                student_id TEXT,
+                site TEXT NOT NULL,
+                module TEXT,
+                model TEXT,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                latency_ms INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_usage_ts ON llm_usage (ts);
+            CREATE TABLE IF NOT EXISTS llm_usage_totals (
+                scope TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (scope, hour)
+            );
+        """)
+        self._lock = threading.Lock()
+        self._spent = {}
+
+    def record(self, tenant, student_id, site, module, model, input_tokens, output_tokens, latency):
+        """Store one model call"""
+        now = time.time()
+        tokens = input_tokens + output_tokens
+        hour = int(now // 3600)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(
+                    "INSERT INTO llm_usage (ts, tenant, student_id, site, module, model, input_tokens, "
+                    "output_tokens, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (now, tenant, student_id, site, module, model, input_tokens, output_tokens,
+                     int(latency * 1000)))
+                for scope in (GLOBAL_SCOPE, student_id):
+                    if scope is None:
+                        continue
+                    self._db.execute(
+                        "INSERT INTO llm_usage_totals (scope, hour, tokens) VALUES (?, ?, ?) "
+                        "ON CONFLICT (scope, hour) DO UPDATE SET tokens = tokens + excluded.tokens",
+                        (scope, hour, tokens))
+                    cached = self._spent.get(scope)
+                    if cached is not None:
+                        self._spent[scope] = (cached[0], cached[1] + tokens)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        metrics.increment("llm_input_tokens", input_tokens)
+        metrics.increment("llm_output_tokens", output_tokens)
+        metrics.increment(f"llm_calls_{site}")
+
+    def spent(self, scope):
+        """Tokens spent by a student (or GLOBAL_SCOPE) within the budget window"""
+        now = time.time()
+        cached = self._spent.get(scope)
+        if cached is not None and now - cached[0] < self.check_ttl:
+            return cached[1]
+        since = int(now // 3600) - self.window_hours + 1
+        with self._lock:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM llm_usage_totals WHERE scope = ? AND hour >= ?",
+                (scope, since)).fetchone()[0]
+            self._spent[scope] = (now, total)
+            if len(self._spent) > 10000:
+                self._spent = {scope: self._spent[scope]}
+        return total
+
+    def over_budget(self, student_id=None):
+        """True when the student (or the whole deployment) exhausted its budget"""
+        if self.global_budget and self.spent(GLOBAL_SCOPE) >= self.global_budget:
+            return True
+        if student_id is not None and self.student_budget and self.spent(student_id) >= self.student_budget:
+            return True
+        return False
+
+    def prune(self, keep_days=90):
+        """Delete usage records (and hourly totals) older than ``keep_days``"""
+        cutoff = time.time() - keep_days * 86400
+        with self._lock:
+            self._db.execute("DELETE FROM llm_usage WHERE ts < ?", (cutoff,))
+            self._db.execute("DELETE FROM llm_usage_totals WHERE hour < ?", (int(cutoff // 3600),))
+
+    def report(self, group_by="student", since=None, until=None, tenant=None, limit=100):
+        """Usage totals grouped by student, site, module, model, tenant or day, largest first"""
+        column = REPORT_GROUPS.get(group_by)
+        if column is None:
+            raise ValueError(f"Unknown report grouping '{group_by}' (use one of {', '.join(REPORT_GROUPS)})")
+        where, params = ["ts >= ?", "ts < ?"], [since or 0, until or time.time() + 1]
+        if tenant:
+            where.append("tenant = ?")
+            params.append(tenant)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {column}, COUNT(*), SUM(input_tokens), SUM(output_tokens), AVG(latency_ms), "
+                f"MAX(latency_ms) FROM llm_usage WHERE {' AND '.join(where)} GROUP BY {column} "
+                f"ORDER BY SUM(input_tokens) + SUM(output_tokens) DESC LIMIT ?",
+                params + [limit]).fetchall()
+        report = []
+        for key, calls, input_tokens, output_tokens, avg_latency, max_latency in rows:
+            report.append({
+                group_by: key,
+                "calls": calls,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "avg_latency_ms": round(avg_latency),
+                "max_latency_ms": max_latency,
+                "estimated_cost": round((input_tokens * self.input_price + output_tokens * self.output_price)
+                                        / 1_000_000, 6),
+            })
+        return report
+
+
+def report_csv(rows):
+    """Render a usage report as CSV"""
+    out = io.StringIO()
+    if rows:
+        writer = csv.DictWriter(out, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return out.getvalue()
+
+
+def meter_from_env(path=None):
+    """Build the meter configured by LLM_* budget and price environment variables"""
+    return UsageMeter(
+        path,
+        student_budget=int(os.environ.get("LLM_STUDENT_TOKEN_BUDGET", 0)),
+        global_budget=int(os.environ.get("LLM_GLOBAL_TOKEN_BUDGET", 0)),
+        window_hours=int(os.environ.get("LLM_BUDGET_WINDOW_HOURS", 24)),
+        input_price=float(os.environ.get("LLM_INPUT_PRICE_PER_MTOK", 0)),
+        output_price=float(os.environ.get("LLM_OUTPUT_PRICE_PER_MTOK", 0)),
+    )
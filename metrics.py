@@ -0,0 +1,39 @@
+"""Process-local counters and gauges exposed on the /metrics endpoint"""
+import threading
+from collections import defaultdict
+
+_counters = defaultdict(int)
+_gauges = {}
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    """Add ``amount`` to a counter"""
+    with _lock:
+        _counters[name] += amount
+
+
+def set_gauge(name, value):
+    """Record the current value of a gauge"""
+    with _lock:
+        _gauges[name] = value
+
+
+def get(name):
+    """Return the current value of a counter"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def ratio(numerator, denominator):
+    """Return counter ``numerator`` / (``numerator`` + ``denominator``), or None"""
+    with _lock:
+        hits = _counters.get(numerator, 0)
+        total = hits + _counters.get(denominator, 0)
+    return round(hits / total, 4) if total else None
+
+
+def snapshot():
+    """Return a copy of all counters and gauges"""
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
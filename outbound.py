@@ -0,0 +1,226 @@
+"""Outbound messages through Twilio's Messages REST API.
+
+Replies that can't go back in the webhook response (deferred replies, nudges,
+messages split over time) are queued here and sent by a small pool of
+threads that share one keep-alive HTTP session, so messages reuse pooled TLS
+connections instead of opening one per send.
+
+* Messages to the same student are sent one at a time, in order.
+* Each sending number is paced to OUTBOUND_RATE_PER_NUMBER messages/second.
+  Send slots are booked in SQLite, so the limit holds across every gunicorn
+  worker sharing the state database.
+* Throttling (429), server errors and connection failures are retried with
+  exponential backoff and jitter; the student's later messages wait.
+* ``on_status(student_key, message_sid, status)`` is called when a message
+  is accepted ("queued") or finally fails ("failed"); later delivery updates
+  arrive on the status callback route.
+
+Configured with TWILIO_ACCOUNT_SID / TWILIO_AUTH_TOKEN; TWILIO_API_BASE
+points the sender at another server (see benchmarks/fake_twilio.py).
+"""
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from db import LazyConnection
+
+TWILIO_API_BASE = "https://api.twilio.com"
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class _Pacer:
+    """Spaces sends from each number at least 1/rate seconds apart, across processes"""
+
+    def __init__(self, rate, path=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS outbound_slots (
+                from_number TEXT PRIMARY KEY,
+                next_slot REAL NOT NULL
+            );
+        """)
+
+    def wait(self, number):
+        if not self.interval:
+            return
+        # Slots are wall-clock times, the only clock the workers share
+        with self.lock:
+            now = time.time()
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._db.execute("SELECT next_slot FROM outbound_slots WHERE from_number = ?",
+                                           (number,)).fetchone()
+                    slot = max(now, row[0]) if row else now
+                    self._db.execute("INSERT OR REPLACE INTO outbound_slots (from_number, next_slot) VALUES (?, ?)",
+                                     (number, slot + self.interval))
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                # Sending unpaced beats holding the student's messages back
+                print(f"Error pacing outbound message: {e}")
+                return
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class _Outgoing:
+    __slots__ = ("student_key", "from_number", "to_number", "body", "attempts")
+
+    def __init__(self, student_key, from_number, to_number, body):
+        self.student_key = student_key
+        self.from_number = from_number
+        self.to_number = to_number
+        self.body = body
+        self.attempts = 0
+
+
+class OutboundSender:
+    """Queued, paced and ordered sender for the Twilio Messages API"""
+
+    def __init__(self, account_sid, auth_token, api_base=TWILIO_API_BASE, status_callback=None,
+                 rate_per_number=10.0, max_retries=4, backoff=0.5, workers=4, timeout=10.0, on_status=None,
+                 path=None):
+        self.url = f"{api_base.rstrip('/')}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        self.status_callback = status_callback
+        self.rate_per_number = rate_per_number
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.on_status = on_status
+        self.session = requests.Session()
+        self.session.auth = (account_sid, auth_token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._pacer = _Pacer(rate_per_number, path)
+        self._queues = {}
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self.workers = workers
+        self._workers = []
+        self._workers_pid = None
+
+    def send(self, student_key, from_number, to_number, body):
+        """Queue a message; messages for one student are delivered in call order"""
+        message = _Outgoing(student_key, from_number, to_number, body)
+        self._ensure_workers()
+        with self._lock:
+            self._pending += 1
+            pending = self._queues.get(student_key)
+            if pending is not None:
+                # A worker owns this student; it will pick the message up in order
+                pending.append(message)
+                return
+            self._queues[student_key] = deque([message])
+        self._ready.put(student_key)
+
+    def wait_idle(self, timeout=None):
+        """Block until every queued message was sent or failed"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def _ensure_workers(self):
+        # Threads don't survive a fork: each worker process starts its own senders
+        if self._workers_pid != os.getpid():
+            with self._lock:
+                if self._workers_pid != os.getpid():
+                    self._workers = [threading.Thread(target=self._work, name=f"outbound-{i}", daemon=True)
+                                     for i in range(self.workers)]
+                    for worker in self._workers:
+                        worker.start()
+                    self._workers_pid = os.getpid()
+
+    def _work(self):
+        while True:
+            student_key = self._ready.get()
+            with self._lock:
+                message = self._queues[student_key][0]
+            self._deliver(message)
+            with self._lock:
+                pending = self._queues[student_key]
+                pending.popleft()
+                self._pending -= 1
+                if pending:
+                    requeue = True
+                else:
+                    del self._queues[student_key]
+                    requeue = False
+                if self._pending == 0:
+                    self._idle.notify_all()
+            # Going to the back of the line keeps one chatty student from starving others
+            if requeue:
+                self._ready.put(student_key)
+
+    def _deliver(self, message):
+        data = {"From": message.from_number, "To": message.to_number, "Body": message.body}
+        if self.status_callback:
+            data["StatusCallback"] = self.status_callback
+        while True:
+            message.attempts += 1
+            self._pacer.wait(message.from_number)
+            error = None
+            try:
+                response = self.session.post(self.url, data=data, timeout=self.timeout)
+                if response.status_code < 300:
+                    metrics.increment("outbound_sent")
+                    self._report(message, response.json().get("sid"), "queued")
+                    return
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                retryable = response.status_code in RETRYABLE_STATUS
+                retry_after = response.headers.get("Retry-After")
+            except requests.RequestException as e:
+                error, retryable, retry_after = str(e), True, None
+            if not retryable or message.attempts > self.max_retries:
+                print(f"Error sending outbound message to {message.to_number}: {error}")
+                metrics.increment("outbound_failed")
+                self._report(message, None, "failed")
+                return
+            metrics.increment("outbound_retries")
+            delay = self.backoff * 2 ** (message.attempts - 1) * (0.5 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay)
+
+    def _report(self, message, message_sid, status):
+        if self.on_status is None:
+            return
+        try:
+            self.on_status(message.student_key, message_sid, status)
+        except Exception as e:
+            print(f"Error recording outbound status: {e}")
+
+
+def sender_from_env(on_status=None, path=None):
+    """Build the sender configured by TWILIO_* / OUTBOUND_* variables, or None without credentials"""
+    account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
+    auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
+    if not account_sid or not auth_token:
+        return None
+    return OutboundSender(
+        account_sid,
+        auth_token,
+        api_base=os.environ.get("TWILIO_API_BASE", TWILIO_API_BASE),
+        status_callback=os.environ.get("TWILIO_STATUS_CALLBACK_URL"),
+        # WhatsApp senders are throttled per number; stay under the account's limit
+        rate_per_number=float(os.environ.get("OUTBOUND_RATE_PER_NUMBER", 10)),
+        max_retries=int(os.environ.get("OUTBOUND_MAX_RETRIES", 4)),
+        backoff=float(os.environ.get("OUTBOUND_BACKOFF", 0.5)),
+        workers=int(os.environ.get("OUTBOUND_WORKERS", 4)),
+        on_status=on_status,
+        path=path,
+    )
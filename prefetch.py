@@ -0,0 +1,152 @@
+"""Speculative prefetch of the next lesson.
+
+When a lesson is sent, generating the following one is queued as a
+low-priority ``prefetch_lesson`` job (see jobs.py). The result is stored
+with an expiry in the ``lesson_prefetch`` table, so any worker process can
+produce it and the usual "continuar" reply can be served without waiting on
+the model.
+"""
+import json
+import os
+import threading
+import time
+
+import metrics
+from db import LazyConnection
+from jobs import DONE, QUEUED, RUNNING, SPECULATIVE
+
+JOB_TYPE = "prefetch_lesson"
+
+
+class Prefetcher:
+    """Queue-backed lesson generator with a cap on speculative spend"""
+
+    def __init__(self, queue, path=None, max_inflight=8, hourly_budget=300, ttl=1800, wait=20.0):
+        self.queue = queue
+        self.max_inflight = max_inflight
+        self.hourly_budget = hourly_budget
+        self.ttl = ttl
+        self.wait = wait
+        self._inflight = {}
+        self._window_start = time.time()
+        self._window_spent = 0
+        self._lock = threading.Lock()
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS lesson_prefetch (
+                student_id TEXT PRIMARY KEY,
+                lesson_key TEXT NOT NULL,
+                content TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+        self._db_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_inflight > 0 and self.hourly_budget > 0
+
+    def _reserve(self):
+        """Take one unit of speculative budget, or return False"""
+        now = time.time()
+        if now - self._window_start >= 3600:
+            self._window_start = now
+            self._window_spent = 0
+        # Forget jobs that already finished
+        for student_id, (_, job_id) in list(self._inflight.items()):
+            if self.queue.status(job_id) not in (QUEUED, RUNNING):
+                del self._inflight[student_id]
+        if len(self._inflight) >= self.max_inflight or self._window_spent >= self.hourly_budget:
+            return False
+        self._window_spent += 1
+        return True
+
+    def _stored(self, student_id):
+        with self._db_lock:
+            return self._db.execute("SELECT lesson_key, content, expires_at FROM lesson_prefetch WHERE student_id = ?",
+                                    (student_id,)).fetchone()
+
+    def schedule(self, student_id, key, payload):
+        """Queue generation of the lesson ``key`` for a student.
+
+        ``payload`` goes to the job handler, which calls ``store``. Returns
+        False when prefetch is disabled, already done or over budget.
+        """
+        if not self.enabled:
+            return False
+        encoded_key = json.dumps(list(key))
+        stored = self._stored(student_id)
+        if stored and stored[0] == encoded_key and stored[2] > time.time():
+            return False
+        with self._lock:
+            running = self._inflight.get(student_id)
+            if running and running[0] == encoded_key and self.queue.status(running[1]) in (QUEUED, RUNNING):
+                return False
+            if not self._reserve():
+                metrics.increment("prefetch_skipped_budget")
+                return False
+            job_id = self.queue.enqueue(JOB_TYPE, dict(payload, student_id=student_id, key=list(key)),
+                                        priority=SPECULATIVE, dedupe_key=f"{JOB_TYPE}:{student_id}:{encoded_key}")
+            self._inflight[student_id] = (encoded_key, job_id)
+        metrics.increment("prefetch_scheduled")
+        return True
+
+    def store(self, student_id, key, content):
+        """Keep a generated lesson until the student asks for it (or it expires)"""
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO lesson_prefetch (student_id, lesson_key, content, expires_at)"
+                             " VALUES (?, ?, ?, ?)", (student_id, json.dumps(list(key)), content, time.time() + self.ttl))
+        metrics.increment("prefetch_completed")
+
+    def take(self, student_id, key):
+        """Return prefetched content for ``key`` and clear it, or None on a miss"""
+        encoded_key = json.dumps(list(key))
+        with self._lock:
+            running = self._inflight.pop(student_id, None)
+        if running and running[0] == encoded_key:
+            # Generation already queued or started: waiting is cheaper than a second call
+            if self.queue.wait(running[1], self.wait) != DONE:
+                metrics.increment("prefetch_wait_timeout")
+
+        with self._db_lock:
+            entry = self._db.execute("SELECT lesson_key, content, expires_at FROM lesson_prefetch WHERE student_id = ?",
+                                     (student_id,)).fetchone()
+            if entry:
+                self._db.execute("DELETE FROM lesson_prefetch WHERE student_id = ?", (student_id,))
+        if entry and entry[0] == encoded_key:
+            if entry[2] > time.time():
+                metrics.increment("prefetch_hit")
+                return entry[1]
+            metrics.increment("prefetch_expired")
+        elif entry:
+            metrics.increment("prefetch_wasted")
+        metrics.increment("prefetch_miss")
+        return None
+
+    def discard(self, student_id=None):
+        """Drop stored lessons of one student (or everyone)"""
+        with self._db_lock:
+            if student_id is None:
+                self._db.execute("DELETE FROM lesson_prefetch")
+            else:
+                self._db.execute("DELETE FROM lesson_prefetch WHERE student_id = ?", (student_id,))
+
+    def stats(self):
+        """Return budget usage and the current hit rate"""
+        return {
+            "inflight": len(self._inflight),
+            "hourly_budget": self.hourly_budget,
+            "spent_this_hour": self._window_spent,
+            "hit_rate": metrics.ratio("prefetch_hit", "prefetch_miss"),
+        }
+
+
+def prefetcher_from_env(queue, path=None):
+    """Build a Prefetcher configured from PREFETCH_* environment variables"""
+    return Prefetcher(
+        queue,
+        path,
+        max_inflight=int(os.environ.get("PREFETCH_MAX_INFLIGHT", 8)),
+        hourly_budget=int(os.environ.get("PREFETCH_HOURLY_BUDGET", 300)),
+        ttl=float(os.environ.get("PREFETCH_TTL", 1800)),
+        wait=float(os.environ.get("PREFETCH_WAIT", 20)),
+    )
@@ -0,0 +1,241 @@
+"""Normalization of student profiles into canonical buckets.
+
+The form stores whatever the model extracted ("Administração, 3º período",
+"gosto de tech e marketing"), so no two profiles are alike. Here curso,
+periodo, conhecimento and interesses are mapped onto small canonical
+enumerations:
+
+1. a local dictionary of aliases (normalized like classifier.py does);
+2. fuzzy matching of the words against those aliases;
+3. when both fail, an optional model call that picks one of the values.
+   With a ``defer`` callback the call is handed to a background job and the
+   field counts as unknown until ``classify_term`` has stored the answer.
+
+Every raw value -> canonical value mapping is memoized in-process and in
+the ``profile_terms`` table, so each distinct spelling is classified once
+across workers. ``bucket_id`` turns a canonical profile into a short stable
+id ("adm.meio.ini.fin+mkt") that caches can share across similar students.
+"""
+import re
+import threading
+from difflib import get_close_matches
+
+import metrics
+from db import LazyConnection
+from classifier import normalize
+
+# Canonical value -> aliases (already normalized)
+CURSOS = {
+    "administracao": ["administracao", "adm", "gestao", "gestao empresarial", "recursos humanos", "rh",
+                      "logistica", "comercio exterior", "secretariado"],
+    "contabeis_economia": ["ciencias contabeis", "contabeis", "contabilidade", "economia", "ciencias economicas",
+                           "financas", "gestao financeira"],
+    "direito": ["direito", "ciencias juridicas"],
+    "computacao": ["ciencia da computacao", "computacao", "sistemas de informacao", "si", "engenharia de software",
+                   "analise e desenvolvimento de sistemas", "ads", "ti", "tecnologia da informacao", "informatica",
+                   "jogos digitais", "engenharia da computacao"],
+    "engenharia": ["engenharia", "engenharia civil", "engenharia mecanica", "engenharia eletrica",
+                   "engenharia de producao", "engenharia quimica", "engenharia ambiental"],
+    "comunicacao": ["comunicacao", "publicidade", "publicidade e propaganda", "jornalismo", "marketing",
+                    "relacoes publicas", "cinema", "audiovisual", "comunicacao social"],
+    "design_arquitetura": ["design", "design grafico", "design de moda", "moda", "arquitetura",
+                           "arquitetura e urbanismo", "design de interiores"],
+    "saude": ["medicina", "enfermagem", "odontologia", "psicologia", "fisioterapia", "nutricao", "farmacia",
+              "biomedicina", "educacao fisica", "medicina veterinaria", "veterinaria"],
+    "educacao_humanas": ["pedagogia", "letras", "historia", "geografia", "filosofia", "licenciatura",
+                         "ciencias sociais", "servico social"],
+    "outro": [],
+}
+
+PERIODOS = {
+    "inicio": ["1", "2", "primeiro", "segundo", "inicio", "comecando", "calouro", "caloura", "ingressante"],
+    "meio": ["3", "4", "5", "6", "terceiro", "quarto", "quinto", "sexto", "meio", "metade"],
+    "fim": ["7", "8", "9", "10", "11", "12", "setimo", "oitavo", "nono", "decimo", "ultimo", "final",
+            "formando", "formanda", "tcc"],
+    "formado": ["formado", "formada", "graduado", "graduada", "concluido", "conclui", "egresso", "egressa"],
+    "desconhecido": [],
+}
+
+CONHECIMENTOS = {
+    "iniciante": ["1", "2", "nenhum", "nada", "zero", "pouco", "pouquissimo", "basico", "iniciante", "leigo",
+                  "baixo", "fraco"],
+    "intermediario": ["3", "medio", "intermediario", "razoavel", "regular", "mais ou menos"],
+    "avancado": ["4", "5", "bom", "muito bom", "alto", "avancado", "experiente", "otimo", "excelente"],
+    "desconhecido": [],
+}
+
+INTERESSES = {
+    "tecnologia": ["tecnologia", "tech", "startup", "startups", "software", "app", "aplicativo", "ti", "digital",
+                   "inteligencia artificial", "programacao", "internet", "saas", "games", "jogos"],
+    "marketing": ["marketing", "mkt", "publicidade", "marca", "branding", "redes sociais", "midias sociais",
+                  "comunicacao", "conteudo", "influencer"],
+    "financas": ["financas", "financeiro", "investimento", "investimentos", "dinheiro", "contabilidade",
+                 "fintech", "mercado financeiro", "custos", "captacao"],
+    "vendas": ["vendas", "venda", "comercial", "varejo", "ecommerce", "e commerce", "loja", "negociacao",
+               "clientes"],
+    "gestao": ["gestao", "lideranca", "estrategia", "processos", "operacoes", "pessoas", "rh", "administracao",
+               "planejamento"],
+    "inovacao": ["inovacao", "criatividade", "ideias", "design thinking", "prototipo", "mvp", "pesquisa"],
+    "impacto_social": ["social", "impacto social", "sustentabilidade", "meio ambiente", "ong", "comunidade",
+                       "educacao", "negocio social", "sustentavel"],
+    "saude": ["saude", "bem estar", "clinica", "medicina", "fitness", "healthtech"],
+    "alimentacao": ["alimentacao", "comida", "gastronomia", "restaurante", "food", "cafe", "bebidas"],
+    "moda_beleza": ["moda", "roupa", "roupas", "beleza", "estetica", "cosmeticos"],
+}
+
+FIELDS = {"curso": CURSOS, "periodo": PERIODOS, "conhecimento": CONHECIMENTOS, "interesses": INTERESSES}
+
+# Values used when nothing matches
+UNKNOWN = {"curso": "outro", "periodo": "desconhecido", "conhecimento": "desconhecido"}
+
+# At most this many interests go into a bucket, so buckets stay few
+MAX_INTERESTS = 2
+
+# Short codes for bucket ids
+CODES = {
+    "administracao": "adm", "contabeis_economia": "cont", "direito": "dir", "computacao": "comp",
+    "engenharia": "eng", "comunicacao": "com", "design_arquitetura": "des", "saude": "sau",
+    "educacao_humanas": "hum", "outro": "out",
+    "inicio": "ini", "meio": "meio", "fim": "fim", "formado": "form", "desconhecido": "na",
+    "iniciante": "ini", "intermediario": "int", "avancado": "av",
+    "tecnologia": "tec", "marketing": "mkt", "financas": "fin", "vendas": "ven", "gestao": "ges",
+    "inovacao": "inov", "impacto_social": "soc", "alimentacao": "ali", "moda_beleza": "moda",
+}
+
+FUZZY_CUTOFF = 0.84
+
+_ALIASES = {field: {alias: value for value, aliases in table.items() for alias in aliases}
+            for field, table in FIELDS.items()}
+
+
+def _phrases(text):
+    """Words of a normalized text plus its two- and three-word phrases"""
+    words = re.findall(r"\w+", text)
+    return [" ".join(words[i:i + n]) for n in (3, 2, 1) for i in range(len(words) - n + 1)]
+
+
+def match_local(field, raw):
+    """Canonical values found in ``raw`` by the dictionary or fuzzy matching (longest phrases first)"""
+    aliases = _ALIASES[field]
+    text = normalize(raw)
+    if field in ("periodo", "conhecimento"):
+        # "3º período", "5o semestre", "nota 2 de 5": the first number decides
+        number = re.search(r"\d+", text)
+        if number and number.group() in aliases:
+            return [aliases[number.group()]]
+    if text in aliases:
+        return [aliases[text]]
+    found = []
+    for phrase in _phrases(text):
+        value = aliases.get(phrase)
+        if value is None and len(phrase) > 3:
+            close = get_close_matches(phrase, aliases, n=1, cutoff=FUZZY_CUTOFF)
+            value = aliases[close[0]] if close else None
+        if value is not None and value not in found:
+            found.append(value)
+    return found
+
+
+class ProfileNormalizer:
+    """Maps raw profile fields onto canonical values, memoizing every mapping"""
+
+    def __init__(self, path=None, classify=None, defer=None):
+        self.classify = classify
+        self.defer = defer
+        self._memo = {}
+        self._lock = threading.Lock()
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS profile_terms (
+                field TEXT NOT NULL,
+                term TEXT NOT NULL,
+                value TEXT NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (field, term)
+            );
+        """)
+
+    def _lookup(self, field, term):
+        with self._lock:
+            if (field, term) in self._memo:
+                return self._memo[(field, term)]
+            row = self._db.execute("SELECT value FROM profile_terms WHERE field = ? AND term = ?",
+                                   (field, term)).fetchone()
+            if row is not None:
+                self._memo[(field, term)] = row[0]
+            return row[0] if row else None
+
+    def _remember(self, field, term, value, source):
+        with self._lock:
+            self._memo[(field, term)] = value
+            self._db.execute("INSERT OR REPLACE INTO profile_terms (field, term, value, source) VALUES (?, ?, ?, ?)",
+                             (field, term, value, source))
+        metrics.increment(f"profile_terms_{source}")
+
+    def canonical(self, field, raw):
+        """Canonical value of one field ("+"-joined sorted values for interesses)"""
+        if not raw or normalize(str(raw)) in ("", "none", "null"):
+            return UNKNOWN.get(field, "")
+        term = normalize(str(raw))
+        value = self._lookup(field, term)
+        if value is not None:
+            return value
+
+        found = match_local(field, term)
+        if found or self.classify is None:
+            return self._store(field, term, found, "local")
+        if self.defer is not None:
+            # Not memoized: the term stays unknown until the background job answers
+            try:
+                self.defer(field, str(raw))
+            except Exception as e:
+                print(f"Error deferring profile {field}: {e}")
+            return UNKNOWN.get(field, "")
+        try:
+            return self.classify_term(field, raw)
+        except Exception as e:
+            print(f"Error classifying profile {field}: {e}")
+            # Not memoized, so the model is asked again next time
+            return UNKNOWN.get(field, "")
+
+    def classify_term(self, field, raw):
+        """Ask the model for the canonical value of a term and memoize it (errors propagate)"""
+        term = normalize(str(raw))
+        value = self._lookup(field, term)
+        if value is not None:
+            return value
+        return self._store(field, term, self._ask_model(field, raw), "model")
+
+    def _store(self, field, term, found, source):
+        if field == "interesses":
+            value = "+".join(sorted(found[:MAX_INTERESTS]))
+        else:
+            value = found[0] if found else UNKNOWN[field]
+        self._remember(field, term, value, source)
+        return value
+
+    def _ask_model(self, field, raw):
+        options = [value for value in FIELDS[field] if value not in UNKNOWN.values()]
+        answer = normalize(self.classify(field, raw, options))
+        return [value for value in options if value in answer][:MAX_INTERESTS if field == "interesses" else 1]
+
+    def normalize_profile(self, profile):
+        """Canonical values of the bucketed fields of a profile"""
+        return {field: self.canonical(field, profile.get(field)) for field in FIELDS}
+
+
+def bucket_id(canonical):
+    """Short stable id of a canonical profile, e.g. "adm.meio.ini.fin+mkt" """
+    interests = "+".join(CODES[value] for value in canonical["interesses"].split("+") if value) or "na"
+    return ".".join([CODES[canonical["curso"]], CODES[canonical["periodo"]], CODES[canonical["conhecimento"]],
+                     interests])
+
+
+def describe(canonical):
+    """Readable canonical profile for prompts"""
+    labels = {
+        "curso": canonical["curso"].replace("_", "/"),
+        "periodo": canonical["periodo"],
+        "conhecimento em empreendedorismo": canonical["conhecimento"],
+        "interesses": canonical["interesses"].replace("+", ", ").replace("_", " ") or "não informados",
+    }
+    return "\n".join(f"{name}: {value}" for name, value in labels.items())
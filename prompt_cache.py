@@ -0,0 +1,128 @@
+"""Per-student cache of the stable part of the free-interaction prompt.
+
+Across a student's turns the persona, the rendered profile and the older
+part of the conversation don't change. That prefix is rendered once and
+reused until the profile (or summary) changes or enough new turns pile up
+after it. When the SDK supports server-side context caching and the prefix
+is large enough, a cached-content handle is created so only the short,
+changing suffix is sent with each turn; otherwise the full prompt is sent.
+
+The size threshold (PROMPT_PREFIX_REMOTE_MIN_CHARS) defaults to about 1024
+tokens, the smallest context the API will cache. Prefixes hold at most
+PROMPT_HISTORY_TURNS turns, lessons included, so they cross it after a few
+lessons.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class PrefixEntry:
+    """A rendered prompt prefix covering ``history[:checkpoint]``"""
+
+    __slots__ = ("fingerprint", "checkpoint", "anchor", "text", "approx_tokens", "model", "expires_at")
+
+    def __init__(self, fingerprint, checkpoint, anchor, text, model=None, expires_at=None):
+        self.fingerprint = fingerprint
+        self.checkpoint = checkpoint
+        self.anchor = anchor
+        self.text = text
+        self.approx_tokens = len(text) // 4
+        self.model = model
+        self.expires_at = expires_at
+
+
+def _anchor(history, checkpoint):
+    """Last turn covered by a prefix, to notice a history that was rewritten"""
+    return history[checkpoint - 1] if checkpoint else None
+
+
+class PromptPrefixCache:
+    """Bounded LRU of prompt prefixes keyed by student id"""
+
+    def __init__(self, max_entries=5000, max_tail=10, keep_tail=4, remote_min_chars=0,
+                 remote_ttl=3600, create_remote=None):
+        self.max_entries = max_entries
+        self.max_tail = max_tail
+        self.keep_tail = keep_tail
+        self.remote_min_chars = remote_min_chars
+        self.remote_ttl = remote_ttl
+        self.create_remote = create_remote
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(persona, profile, summary=None):
+        """Hash of the inputs that invalidate a prefix when they change"""
+        digest = hashlib.sha1()
+        for part in (persona, repr(sorted(profile.items())), summary or ""):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, student_id, fingerprint, history, render):
+        """Return a PrefixEntry for the student, rebuilding it if stale.
+
+        ``render(checkpoint)`` renders the prefix text for
+        ``history[:checkpoint]``.
+        """
+        with self._lock:
+            entry = self._entries.get(student_id)
+            if entry is not None:
+                self._entries.move_to_end(student_id)
+        now = time.time()
+        if (entry is not None and entry.fingerprint == fingerprint
+                and entry.checkpoint <= len(history)
+                and _anchor(history, entry.checkpoint) == entry.anchor
+                and len(history) - entry.checkpoint <= self.max_tail
+                and (entry.expires_at is None or entry.expires_at > now)):
+            metrics.increment("prompt_prefix_hit")
+            return entry
+
+        metrics.increment("prompt_prefix_miss")
+        checkpoint = max(len(history) - self.keep_tail, 0)
+        text = render(checkpoint)
+        entry = PrefixEntry(fingerprint, checkpoint, _anchor(history, checkpoint), text)
+        if self.create_remote is not None and self.remote_min_chars and len(text) >= self.remote_min_chars:
+            try:
+                entry.model = self.create_remote(text, self.remote_ttl)
+                if entry.model is not None:
+                    # Stop using the handle a little before the server drops it
+                    entry.expires_at = now + self.remote_ttl * 0.9
+                    metrics.increment("prompt_prefix_remote_created")
+            except Exception as e:
+                print(f"Error creating context cache: {e}")
+        with self._lock:
+            self._entries[student_id] = entry
+            self._entries.move_to_end(student_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, student_id=None):
+        """Drop one student's prefix (or all of them)"""
+        with self._lock:
+            if student_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(student_id, None)
+
+    def stats(self):
+        return {"entries": len(self._entries),
+                "hit_rate": metrics.ratio("prompt_prefix_hit", "prompt_prefix_miss")}
+
+
+def prompt_cache_from_env(create_remote=None):
+    """Build the cache configured by PROMPT_PREFIX_* environment variables"""
+    return PromptPrefixCache(
+        max_entries=int(os.environ.get("PROMPT_PREFIX_MAX_ENTRIES", 5000)),
+        max_tail=int(os.environ.get("PROMPT_PREFIX_MAX_TAIL", 10)),
+        keep_tail=int(os.environ.get("PROMPT_PREFIX_KEEP_TAIL", 4)),
+        remote_min_chars=int(os.environ.get("PROMPT_PREFIX_REMOTE_MIN_CHARS", 4096)),
+        remote_ttl=int(os.environ.get("PROMPT_PREFIX_REMOTE_TTL", 3600)),
+        create_remote=create_remote,
+    )
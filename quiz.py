@@ -0,0 +1,158 @@
+"""Quiz sessions backed by a shared question bank.
+
+Generated questions are stored once in the ``quiz_questions`` table, keyed by
+a hash of their content and grouped in pools (one per tenant, module and
+catalogue version). Once a pool holds enough questions, new quizzes are drawn
+from it instead of asking the model again.
+
+A student's quiz in progress is a ``QuizSession``: the module, the ids of its
+questions, the letters answered so far, how long each answer took and the
+number of correct ones. It serializes to a small dict in the student state
+(``state["quiz"]``), so it survives restarts with everything else and costs
+bytes instead of a copy of every question.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from classifier import parse_quiz_answer
+from db import LazyConnection
+
+# Fields of student states saved before quiz sessions
+LEGACY_FIELDS = ("quiz_active", "quiz_answers", "current_quiz")
+
+
+class QuestionBank:
+    """Content-addressed store of quiz questions, grouped in pools"""
+
+    def __init__(self, path=None, max_cached=1024):
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = LazyConnection(path, schema="""
+            CREATE TABLE IF NOT EXISTS quiz_questions (
+                question_id TEXT PRIMARY KEY,
+                pool TEXT NOT NULL,
+                body TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS quiz_questions_pool ON quiz_questions (pool);
+        """)
+
+    def add(self, pool, question):
+        """Store a question once; returns its id"""
+        # The model sometimes writes the answer as "b) texto da opção"
+        answer = str(question["correct_answer"])
+        question = {
+            "question": question["question"],
+            "options": list(question["options"]),
+            "correct_answer": parse_quiz_answer(answer) or answer.strip().lower(),
+        }
+        body = json.dumps(question, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        question_id = hashlib.sha1(f"{pool}\n{body}".encode("utf-8")).hexdigest()[:12]
+        with self._lock:
+            if question_id not in self._cache:
+                self._db.execute("INSERT OR IGNORE INTO quiz_questions (question_id, pool, body, created_at)"
+                                 " VALUES (?, ?, ?, ?)", (question_id, pool, body, time.time()))
+            self._remember(question_id, question)
+        return question_id
+
+    def get(self, question_id):
+        """Question dict for an id, or None if it's unknown"""
+        with self._lock:
+            question = self._cache.get(question_id)
+            if question is not None:
+                self._cache.move_to_end(question_id)
+                return question
+            row = self._db.execute("SELECT body FROM quiz_questions WHERE question_id = ?",
+                                   (question_id,)).fetchone()
+            if row is None:
+                return None
+            question = json.loads(row[0])
+            self._remember(question_id, question)
+            return question
+
+    def _remember(self, question_id, question):
+        self._cache[question_id] = question
+        self._cache.move_to_end(question_id)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def pool_size(self, pool):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM quiz_questions WHERE pool = ?", (pool,)).fetchone()[0]
+
+    def draw(self, pool, count):
+        """Ids of ``count`` random questions of a pool ([] if it has fewer)"""
+        with self._lock:
+            ids = [row[0] for row in self._db.execute("SELECT question_id FROM quiz_questions WHERE pool = ?",
+                                                      (pool,))]
+        return random.sample(ids, count) if len(ids) >= count else []
+
+
+class QuizSession:
+    """One student's quiz in progress"""
+
+    def __init__(self, module, question_ids, answers="", times=None, correct=0, started_at=None, asked_at=None):
+        self.module = module
+        self.question_ids = list(question_ids)
+        self.answers = answers
+        self.times = list(times or [])
+        self.correct = correct
+        self.started_at = started_at if started_at is not None else time.time()
+        self.asked_at = asked_at if asked_at is not None else self.started_at
+
+    @property
+    def position(self):
+        """Index of the question being asked"""
+        return len(self.answers)
+
+    @property
+    def finished(self):
+        return self.position >= len(self.question_ids)
+
+    def current_id(self):
+        return self.question_ids[self.position]
+
+    def answer(self, letter, correct, now=None):
+        """Record an answer to the current question; returns seconds taken"""
+        now = now if now is not None else time.time()
+        seconds = round(now - self.asked_at, 1)
+        self.answers += letter
+        self.times.append(seconds)
+        self.correct += bool(correct)
+        self.asked_at = now
+        return seconds
+
+    def to_state(self):
+        """Compact dict stored in the student state"""
+        return {"m": self.module, "q": self.question_ids, "a": self.answers, "t": self.times,
+                "c": self.correct, "s": round(self.started_at, 1), "w": round(self.asked_at, 1)}
+
+    @classmethod
+    def from_state(cls, data):
+        """Session stored by ``to_state``, or None when there is none"""
+        if not data:
+            return None
+        return cls(data["m"], data["q"], data.get("a", ""), data.get("t"), data.get("c", 0),
+                   data.get("s"), data.get("w"))
+
+
+def upgrade_legacy(state, bank, pool):
+    """Move a quiz saved as full question copies into the bank and a session.
+
+    Drops the old fields from ``state``; returns the session dict, or None
+    when no quiz was running.
+    """
+    legacy = {field: state.pop(field) for field in LEGACY_FIELDS if field in state}
+    questions = legacy.get("current_quiz")
+    if not questions or state.get("context") != "quiz":
+        return None
+    answers = "".join(str(answer) for answer in legacy.get("quiz_answers") or [])
+    ids = [bank.add(pool, question) for question in questions]
+    correct = sum(bank.get(question_id)["correct_answer"] == answer for question_id, answer in zip(ids, answers))
+    # How long the earlier answers took wasn't recorded
+    return QuizSession(state.get("current_module"), ids, answers, [None] * len(answers), correct).to_state()
@@ -0,0 +1,282 @@
+"""Offline BM25 index over the curated course notes.
+
+Each catalogue file has its own notes next to it: ``data/catalogue.json``
+reads ``data/catalogue.notes/<module>.md``, one ``## `` section per submodule
+in catalogue order. ``python retrieval.py build`` chunks them into passages
+and writes ``data/catalogue.idx``: a JSON header (vocabulary and chunk table)
+followed by flat arrays of postings, precomputed BM25 weights and the
+passage text. Workers memory-map that file, so loading it costs one small
+JSON parse and the arrays are shared through the page cache.
+
+The header records the catalogue version the index was built for. A worker
+whose catalogue is reloaded drops its index, and one that finds the index
+missing or built for another version rebuilds it before searching.
+
+At query time the score of a passage is the sum of the stored weights of the
+query terms it contains; only the top-k passages go into a prompt.
+
+Usage: python retrieval.py build [CATALOGUE_PATH]
+"""
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+
+from catalogue import default_catalogue_path, load_catalogue
+from classifier import normalize
+
+MAGIC = b"NOTESIX1"
+K1 = 1.2
+B = 0.75
+
+# Passages are built from paragraphs, merged or split to roughly this many words
+MIN_CHUNK_WORDS = 40
+MAX_CHUNK_WORDS = 120
+
+STOPWORDS = set("""
+a o as os um uma uns umas de da do das dos em na no nas nos por para pra com sem sob sobre entre
+e ou mas que se como quando onde qual quais quem cujo ao aos à às pelo pela pelos pelas isso isto
+esse essa esses essas este esta estes estas aquele aquela ele ela eles elas eu tu voce voces nos
+me te lhe seu sua seus suas meu minha meus minhas ser estar ter haver foi sao era e ha tem mais
+muito muita muitos muitas ja nao sim tambem so ate ainda depois antes ou cada outro outra
+""".split())
+
+
+def tokenize(text):
+    """Lowercase, accent-free terms without stopwords, with plurals folded"""
+    terms = []
+    for word in re.findall(r"\w+", normalize(text)):
+        if len(word) < 2 or word in STOPWORDS or word.isdigit():
+            continue
+        if len(word) > 4 and word.endswith("s"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def notes_paths(catalogue_path):
+    """Return (notes directory, index file) that belong to a catalogue file"""
+    stem = os.path.splitext(os.path.abspath(catalogue_path))[0]
+    return f"{stem}.notes", f"{stem}.idx"
+
+
+def _sections(text):
+    """Split a notes file into the bodies of its ``## `` sections"""
+    parts = re.split(r"^## .*$", text, flags=re.MULTILINE)
+    return [part.strip() for part in parts[1:]]
+
+
+def _chunks(body):
+    """Group a section's paragraphs into passages of MIN..MAX_CHUNK_WORDS words"""
+    chunks, current = [], []
+    for paragraph in re.split(r"\n\s*\n", body):
+        words = paragraph.split()
+        if not words:
+            continue
+        while len(words) > MAX_CHUNK_WORDS:
+            chunks.append(" ".join(words[:MAX_CHUNK_WORDS]))
+            words = words[MAX_CHUNK_WORDS:]
+        current.extend(words)
+        if len(current) >= MIN_CHUNK_WORDS:
+            chunks.append(" ".join(current))
+            current = []
+    if current:
+        if chunks and len(current) < MIN_CHUNK_WORDS // 2:
+            chunks[-1] += " " + " ".join(current)
+        else:
+            chunks.append(" ".join(current))
+    return chunks
+
+
+def build_index(catalogue_path):
+    """Chunk and index the notes of a catalogue; returns (index path, number of passages)"""
+    catalogue = load_catalogue(catalogue_path)
+    modules = catalogue.modules
+    notes_dir, index_path = notes_paths(catalogue_path)
+
+    passages = []
+    for module_name, module in modules.items():
+        path = os.path.join(notes_dir, f"{module_name}.md")
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            sections = _sections(f.read())
+        titles = module["submodulos"]
+        if len(sections) != len(titles):
+            print(f"Warning: {path} has {len(sections)} sections for {len(titles)} submodules")
+        for submodule, body in enumerate(sections[:len(titles)]):
+            for text in _chunks(body):
+                terms = tokenize(f"{titles[submodule]} {module['titulo']} {text}")
+                passages.append((module_name, submodule, text, terms))
+
+    # term -> [(passage, term frequency)]
+    postings = {}
+    for doc, (_, _, _, terms) in enumerate(passages):
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((doc, tf))
+    total = len(passages)
+    avg_length = sum(len(p[3]) for p in passages) / total if total else 0.0
+
+    ids, weights, vocabulary = array("I"), array("f"), {}
+    for term in sorted(postings):
+        entries = postings[term]
+        idf = math.log(1 + (total - len(entries) + 0.5) / (len(entries) + 0.5))
+        vocabulary[term] = [len(ids), len(entries)]
+        for doc, tf in entries:
+            length = len(passages[doc][3])
+            ids.append(doc)
+            weights.append(idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length)))
+
+    texts = [p[2].encode("utf-8") for p in passages]
+    chunk_table, offset = [], 0
+    for (module_name, submodule, _, _), encoded in zip(passages, texts):
+        chunk_table.append([module_name, submodule, offset, len(encoded)])
+        offset += len(encoded)
+
+    header = {"byteorder": sys.byteorder, "catalogue": catalogue.version, "postings": len(ids), "terms": vocabulary, "chunks": chunk_table}
+    encoded_header = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    # Keep the arrays 4-byte aligned for zero-copy memoryview casts
+    encoded_header += b" " * (-(len(MAGIC) + 4 + len(encoded_header)) % 4)
+    # Workers may rebuild the same index at once
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded_header)))
+        f.write(encoded_header)
+        f.write(ids.tobytes())
+        f.write(weights.tobytes())
+        f.write(b"".join(texts))
+    os.replace(tmp_path, index_path)
+    return index_path, total
+
+
+class Passage:
+    """A retrieved chunk of course notes"""
+
+    __slots__ = ("module", "submodule", "text", "score")
+
+    def __init__(self, module, submodule, text, score):
+        self.module = module
+        self.submodule = submodule
+        self.text = text
+        self.score = score
+
+
+class NotesIndex:
+    """Read-only, memory-mapped BM25 index written by ``build_index``"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' is not a notes index")
+        header_length = struct.unpack_from("<I", self._mmap, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        header = json.loads(self._mmap[start:start + header_length])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"'{path}' was built on a machine with different byte order")
+        self.catalogue_version = header.get("catalogue")
+        self.terms = header["terms"]
+        self.chunks = header["chunks"]
+        count = header["postings"]
+        view = memoryview(self._mmap)
+        ids_start = start + header_length
+        weights_start = ids_start + 4 * count
+        self._text_start = weights_start + 4 * count
+        self._ids = view[ids_start:weights_start].cast("I")
+        self._weights = view[weights_start:self._text_start].cast("f")
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def passage(self, doc, score=0.0):
+        module, submodule, offset, length = self.chunks[doc]
+        start = self._text_start + offset
+        return Passage(module, submodule, self._mmap[start:start + length].decode("utf-8"), score)
+
+    def search(self, query, k=3, module=None, submodule=None, prefer_module=None):
+        """Top-k passages for a query, optionally restricted to a module/submodule.
+
+        Passages of ``prefer_module`` get their score boosted by half.
+        """
+        scores = {}
+        for term in set(tokenize(query)):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            start, count = entry
+            for i in range(start, start + count):
+                doc = self._ids[i]
+                chunk = self.chunks[doc]
+                if (module is not None and chunk[0] != module) or (submodule is not None and chunk[1] != submodule):
+                    continue
+                scores[doc] = scores.get(doc, 0.0) + self._weights[i]
+        if prefer_module is not None:
+            for doc in scores:
+                if self.chunks[doc][0] == prefer_module:
+                    scores[doc] *= 1.5
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.passage(doc, score) for doc, score in best]
+
+
+# index path -> (catalogue version, NotesIndex or None)
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _open_index(catalogue, index_path):
+    """Load the index for a catalogue version, rebuilding it when it's missing or stale"""
+    try:
+        index = NotesIndex(index_path)
+        if index.catalogue_version == catalogue.version:
+            return index
+        print(f"Warning: course notes index {index_path} was built for catalogue "
+              f"{index.catalogue_version}, rebuilding it for {catalogue.version}")
+    except FileNotFoundError:
+        print(f"Warning: no course notes index at {index_path}, building it")
+    except (ValueError, KeyError) as e:
+        print(f"Warning: unusable course notes index {index_path} ({e}), rebuilding it")
+    try:
+        build_index(catalogue.path)
+        return NotesIndex(index_path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error building course notes index, retrieval is off for catalogue {catalogue.version}: {e}")
+        return None
+
+
+def get_index(catalogue):
+    """The notes index for a catalogue version, or None when it can't be built"""
+    if catalogue.path is None:
+        return None
+    _, index_path = notes_paths(catalogue.path)
+    entry = _indexes.get(index_path)
+    if entry is None or entry[0] != catalogue.version:
+        with _lock:
+            entry = _indexes.get(index_path)
+            if entry is None or entry[0] != catalogue.version:
+                entry = (catalogue.version, _open_index(catalogue, index_path))
+                _indexes[index_path] = entry
+    return entry[1]
+
+
+def format_passages(passages):
+    """Render retrieved passages for a prompt"""
+    return "\n\n".join(f"- {passage.text}" for passage in passages)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    path, count = build_index(sys.argv[2] if len(sys.argv) > 2 else default_catalogue_path())
+    print(f"Indexed {count} passages into {path}")
@@ -0,0 +1,765 @@
+"""Persistent student state with dirty tracking and write-behind flushing.
+
+Student state is still handled as a plain dict by the message handlers, but
+the dict records which top-level fields changed. Only those fields are
+written back, one row per field, and the conversation history is stored as
+an append-only log of compact entries (see transcript.py) so old turns are
+never rewritten, only compressed in place once they go cold.
+
+Every process keeps the students it served in memory, so a student is
+handled inside ``turn``: it holds the student across processes (a lease in
+``student_turns``), reloads the copy when another process stored a newer
+version, and writes the changes back before letting go. Two workers can't
+serve one student from diverging copies.
+
+Durability is chosen with STATE_DURABILITY:
+
+* ``sync``: turns are flushed with a full fsync before the reply is returned
+* ``batched``: turns are flushed without waiting for fsync, and changes made
+  outside a turn by a background thread at most STATE_FLUSH_INTERVAL
+  seconds later (default)
+* ``memory``: nothing is persisted and turns aren't coordinated (development,
+  single process)
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import transcript
+from db import LazyConnection
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "students.db")
+
+# Fields that only make sense inside the current process
+TRANSIENT_FIELDS = {"prefetch"}
+
+HISTORY_FIELD = "conversation_history"
+
+
+class _TrackedDict(dict):
+    """Nested dict that marks its parent field dirty when modified"""
+
+    def __init__(self, owner, field, data):
+        super().__init__(data)
+        self._owner = owner
+        self._field = field
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._owner.mark_dirty(self._field)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._owner.mark_dirty(self._field)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._owner.mark_dirty(self._field)
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._owner.mark_dirty(self._field)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._owner.mark_dirty(self._field)
+        return super().setdefault(key, default)
+
+    def clear(self):
+        super().clear()
+        self._owner.mark_dirty(self._field)
+
+
+class _TrackedList(list):
+    """Nested list that marks its parent field dirty when modified"""
+
+    def __init__(self, owner, field, data):
+        super().__init__(data)
+        self._owner = owner
+        self._field = field
+
+    def _changed(self):
+        self._owner.mark_dirty(self._field)
+
+
+def _tracking(method_name):
+    def method(self, *args):
+        result = getattr(list, method_name)(self, *args)
+        self._changed()
+        return result
+    method.__name__ = method_name
+    return method
+
+
+for _name in ("append", "extend", "insert", "pop", "remove", "clear", "sort", "reverse",
+              "__setitem__", "__delitem__", "__iadd__"):
+    setattr(_TrackedList, _name, _tracking(_name))
+
+
+class HistoryLog(list):
+    """Conversation history that remembers which entries were already stored.
+
+    Appends are flushed as new log rows, and entries leaving the hot window
+    are compressed and updated in place; any other mutation makes the next
+    flush rewrite the student's log.
+    """
+
+    def __init__(self, owner, data=(), stored=0):
+        super().__init__(transcript.upgrade(entry) for entry in data)
+        self._owner = owner
+        self._stored = stored
+        self._rewrite = False
+        self._cooled = set()
+        # Histories stored before compression are compressed on the next flush
+        for i in range(len(self) - transcript.HOT_TURNS):
+            self._cool(i)
+
+    def append(self, entry):
+        super().append(entry)
+        self._cool(len(self) - transcript.HOT_TURNS - 1)
+        self._owner.mark_dirty(HISTORY_FIELD)
+
+    def extend(self, entries):
+        start = len(self)
+        super().extend(entries)
+        for i in range(start - transcript.HOT_TURNS - 1, len(self) - transcript.HOT_TURNS):
+            self._cool(i)
+        self._owner.mark_dirty(HISTORY_FIELD)
+
+    def _cool(self, i):
+        if i < 0:
+            return
+        entry = self[i]
+        cold = transcript.compress(entry)
+        if cold is not entry:
+            list.__setitem__(self, i, cold)
+            if i < self._stored:
+                self._cooled.add(i)
+
+    def _rewritten(self):
+        self._rewrite = True
+        self._owner.mark_dirty(HISTORY_FIELD)
+
+    def take_pending(self):
+        """Return (rewrite, start, entries to store, {seq: recompressed entry}) and mark them as stored"""
+        rewrite = self._rewrite
+        start = 0 if rewrite else self._stored
+        pending = list(self[start:])
+        cooled = {} if rewrite else {i: self[i] for i in self._cooled if i < start}
+        self._stored = len(self)
+        self._rewrite = False
+        self._cooled = set()
+        return rewrite, start, pending, cooled
+
+
+def _rewriting(method_name):
+    def method(self, *args):
+        result = getattr(list, method_name)(self, *args)
+        self._rewritten()
+        return result
+    method.__name__ = method_name
+    return method
+
+
+for _name in ("insert", "pop", "remove", "clear", "sort", "reverse", "__setitem__", "__delitem__"):
+    setattr(HistoryLog, _name, _rewriting(_name))
+
+
+class StudentState(dict):
+    """Student state dict that tracks which top-level fields changed"""
+
+    def __init__(self, student_id, data=None, stored_history=0, on_dirty=None, version=0):
+        super().__init__()
+        self.student_id = student_id
+        # Stored version this copy was loaded from (or last written as)
+        self.version = version
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._on_dirty = None
+        for key, value in (data or {}).items():
+            dict.__setitem__(self, key, self._wrap(key, value, stored_history))
+        self._on_dirty = on_dirty
+
+    def _wrap(self, key, value, stored_history=0):
+        if key == HISTORY_FIELD and not isinstance(value, HistoryLog):
+            return HistoryLog(self, value, stored=stored_history)
+        if type(value) is dict:
+            return _TrackedDict(self, key, value)
+        if type(value) is list:
+            return _TrackedList(self, key, value)
+        return value
+
+    def mark_dirty(self, key):
+        if self._on_dirty is None or key in TRANSIENT_FIELDS:
+            return
+        with self._lock:
+            first = not self._dirty
+            self._dirty.add(key)
+        if first:
+            self._on_dirty(self)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self._wrap(key, value))
+        if key == HISTORY_FIELD:
+            self[key]._rewritten()
+        else:
+            self.mark_dirty(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.mark_dirty(key)
+
+    def pop(self, key, *default):
+        present = key in self
+        value = dict.pop(self, key, *default)
+        if present:
+            self.mark_dirty(key)
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def take_changes(self):
+        """Return (changed fields, history changes) and reset dirty tracking"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        fields = {}
+        history = None
+        for key in dirty:
+            if key == HISTORY_FIELD:
+                if key in self:
+                    history = self[key].take_pending()
+                continue
+            fields[key] = self.get(key, _DELETED)
+        return fields, history
+
+    def has_changes(self):
+        return bool(self._dirty)
+
+
+_DELETED = object()
+
+
+class StateStore:
+    """SQLite-backed student state with an in-memory working set"""
+
+    def __init__(self, path=DEFAULT_DB_PATH, durability="batched", flush_interval=1.0,
+                 max_pending=500, turn_lease=120.0, turn_wait=30.0):
+        if durability not in ("sync", "batched", "memory"):
+            raise ValueError(f"Unknown state durability mode '{durability}'")
+        self.path = path
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.turn_lease = turn_lease
+        self.turn_wait = turn_wait
+        self._states = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._flusher_pid = None
+        self._held = threading.local()
+        self._db = None
+        if durability != "memory":
+            self._db = LazyConnection(path, schema="""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=%s;
+                CREATE TABLE IF NOT EXISTS student_fields (
+                    student_id TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (student_id, field)
+                );
+                CREATE TABLE IF NOT EXISTS student_history (
+                    student_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    entry BLOB NOT NULL,
+                    PRIMARY KEY (student_id, seq)
+                );
+                CREATE TABLE IF NOT EXISTS student_versions (
+                    student_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS student_turns (
+                    student_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+            """ % ("FULL" if durability == "sync" else "NORMAL"))
+            atexit.register(self.flush)
+
+    # --- Working set ---
+
+    def get(self, student_id):
+        """Return the state for a student (loading it from disk), or None"""
+        state = self._states.get(student_id)
+        if state is not None:
+            return state
+        with self._lock:
+            state = self._states.get(student_id)
+            if state is None:
+                state = self._load(student_id)
+                if state is not None:
+                    self._states[student_id] = state
+        return state
+
+    def get_or_create(self, student_id, factory):
+        """Return the state for a student, creating it with ``factory()`` if new"""
+        state = self.get(student_id)
+        if state is not None:
+            return state
+        with self._lock:
+            state = self._states.get(student_id)
+            if state is not None:
+                return state
+            state = StudentState(student_id, factory(), on_dirty=self._mark_pending)
+            self._states[student_id] = state
+        # A new student is written out in full on the next flush
+        for key in list(state):
+            state.mark_dirty(key)
+        return state
+
+    @contextmanager
+    def turn(self, student_id):
+        """Hold a student for one turn, across processes, on an up-to-date copy.
+
+        Waits up to ``turn_wait`` seconds for another process (or thread) to
+        finish with the student; a holder that died is taken over once its
+        ``turn_lease`` runs out. Changes are flushed when the turn ends.
+        Nested turns for the same student in one thread are free.
+        """
+        held = self._held.__dict__.setdefault("ids", set())
+        if self._db is None or student_id in held:
+            yield
+            return
+        owner = f"{os.getpid()}:{threading.get_ident()}"
+        self._acquire(student_id, owner)
+        held.add(student_id)
+        try:
+            self._refresh(student_id)
+            yield
+        finally:
+            held.discard(student_id)
+            try:
+                self.flush(student_id)
+            finally:
+                with self._db_lock:
+                    self._db.execute("DELETE FROM student_turns WHERE student_id = ? AND owner = ?",
+                                     (student_id, owner))
+
+    def _acquire(self, student_id, owner):
+        deadline = time.time() + self.turn_wait
+        while True:
+            now = time.time()
+            with self._db_lock:
+                taken = self._db.execute(
+                    "INSERT INTO student_turns (student_id, owner, expires_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT (student_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE student_turns.expires_at < ?", (student_id, owner, now + self.turn_lease, now)).rowcount
+            if taken:
+                return
+            if now >= deadline:
+                raise TimeoutError(f"Student {student_id} is still busy in another turn")
+            time.sleep(0.05)
+
+    def _refresh(self, student_id):
+        """Drop this process's copy of a student if another process stored a newer one"""
+        state = self._states.get(student_id)
+        if state is None:
+            return
+        with self._db_lock:
+            row = self._db.execute("SELECT version FROM student_versions WHERE student_id = ?",
+                                   (student_id,)).fetchone()
+        if (row[0] if row else 0) != state.version:
+            self.evict(student_id)
+
+    def __contains__(self, student_id):
+        return self.get(student_id) is not None
+
+    def __len__(self):
+        return len(self.student_ids())
+
+    def student_ids(self):
+        """Return ids of every known student"""
+        ids = set(self._states)
+        if self._db is not None:
+            with self._db_lock:
+                ids.update(row[0] for row in self._db.execute(
+                    "SELECT DISTINCT student_id FROM student_fields"))
+        return sorted(ids)
+
+    def loaded_ids(self):
+        """Return ids of the students loaded in this process"""
+        with self._lock:
+            return list(self._states)
+
+    def discard(self, student_id):
+        """Delete a student's state from memory and disk"""
+        with self._lock:
+            self._states.pop(student_id, None)
+            self._pending.pop(student_id, None)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                self._db.execute("DELETE FROM student_fields WHERE student_id = ?", (student_id,))
+                self._db.execute("DELETE FROM student_history WHERE student_id = ?", (student_id,))
+                self._bump_versions([student_id])
+                self._db.execute("COMMIT")
+
+    def clear(self):
+        """Delete every student's state"""
+        with self._lock:
+            self._states.clear()
+            self._pending.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                self._db.execute("DELETE FROM student_fields")
+                self._db.execute("DELETE FROM student_history")
+                # Versions are kept (and bumped) so other processes drop their copies
+                self._db.execute("UPDATE student_versions SET version = version + 1")
+                self._db.execute("COMMIT")
+
+    # --- Persistence ---
+
+    def _load(self, student_id):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            # One read transaction, so fields, history and version match
+            self._db.execute("BEGIN")
+            try:
+                rows = self._db.execute(
+                    "SELECT field, value FROM student_fields WHERE student_id = ?", (student_id,)).fetchall()
+                history = [row[0] for row in self._db.execute(
+                    "SELECT entry FROM student_history WHERE student_id = ? ORDER BY seq", (student_id,))]
+                version = self._db.execute("SELECT version FROM student_versions WHERE student_id = ?",
+                                           (student_id,)).fetchone()
+            finally:
+                self._db.execute("COMMIT")
+        if not rows:
+            return None
+        data = {field: json.loads(value) for field, value in rows}
+        data[HISTORY_FIELD] = history
+        return StudentState(student_id, data, stored_history=len(history), on_dirty=self._mark_pending,
+                            version=version[0] if version else 0)
+
+    def _bump_versions(self, student_ids):
+        """Mark students as changed on disk (inside a write transaction)"""
+        self._db.executemany(
+            "INSERT INTO student_versions (student_id, version) VALUES (?, 1)"
+            " ON CONFLICT (student_id) DO UPDATE SET version = version + 1",
+            [(student_id,) for student_id in student_ids])
+
+    def _mark_pending(self, state):
+        if self._db is None:
+            return
+        with self._lock:
+            self._pending[state.student_id] = state
+            pending = len(self._pending)
+        if self.durability == "batched":
+            self._ensure_flusher()
+            if pending >= self.max_pending:
+                self._wakeup.set()
+
+    def _ensure_flusher(self):
+        # Threads don't survive a fork: each worker starts its own flusher
+        if self._flusher_pid != os.getpid():
+            with self._lock:
+                if self._flusher_pid != os.getpid():
+                    self._flusher = threading.Thread(target=self._flush_loop, name="state-flusher", daemon=True)
+                    self._flusher.start()
+                    self._flusher_pid = os.getpid()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing student state: {e}")
+
+    def flush(self, student_id=None):
+        """Write pending changes (for one student or everyone) to disk"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            if student_id is None:
+                states = list(self._pending.values())
+                self._pending.clear()
+            else:
+                state = self._pending.pop(student_id, None)
+                states = [state] if state is not None else []
+        if not states:
+            return 0
+
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for state in states:
+                    self._write_changes(state)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return len(states)
+
+    def _write_changes(self, state):
+        fields, history = state.take_changes()
+        for field, value in fields.items():
+            if value is _DELETED:
+                self._db.execute("DELETE FROM student_fields WHERE student_id = ? AND field = ?",
+                                 (state.student_id, field))
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO student_fields (student_id, field, value) VALUES (?, ?, ?)",
+                    (state.student_id, field, json.dumps(value, ensure_ascii=False)))
+        if history is not None:
+            rewrite, start, entries, cooled = history
+            if rewrite:
+                self._db.execute("DELETE FROM student_history WHERE student_id = ?", (state.student_id,))
+            self._db.executemany(
+                "UPDATE student_history SET entry = ? WHERE student_id = ? AND seq = ?",
+                [(entry, state.student_id, seq) for seq, entry in cooled.items()])
+            self._db.executemany(
+                "INSERT INTO student_history (student_id, seq, entry) VALUES (?, ?, ?)",
+                [(state.student_id, start + i, entry) for i, entry in enumerate(entries)])
+        self._bump_versions([state.student_id])
+        state.version = self._db.execute("SELECT version FROM student_versions WHERE student_id = ?",
+                                         (state.student_id,)).fetchone()[0]
+
+    # --- Bulk transfer ---
+
+    def _require_db(self):
+        if self._db is None:
+            raise ValueError("Bulk export/import needs a persistent state store (STATE_DURABILITY is 'memory')")
+
+    def iter_stored(self, chunk_size=500, after="", prefix=""):
+        """Yield (student_id, fields) for every stored student in id order.
+
+        Students are read ``chunk_size`` at a time with keyset pagination
+        (starting after the id ``after`` and limited to ids starting with
+        ``prefix``), so memory stays constant however many students there are.
+        History is not included; load it with ``stored_history``.
+        """
+        after = max(after or "", prefix)
+        if self._db is None:
+            for student_id in sorted(self._states):
+                if student_id > after and student_id.startswith(prefix):
+                    state = self._states[student_id]
+                    yield student_id, {key: value for key, value in state.items()
+                                       if key != HISTORY_FIELD and key not in TRANSIENT_FIELDS}
+            return
+        self.flush()
+        while True:
+            with self._db_lock:
+                ids = [row[0] for row in self._db.execute(
+                    "SELECT DISTINCT student_id FROM student_fields WHERE student_id > ? ORDER BY student_id LIMIT ?",
+                    (after, chunk_size))]
+                ids = [student_id for student_id in ids if student_id.startswith(prefix)]
+                if not ids:
+                    return
+                rows = self._db.execute(
+                    "SELECT student_id, field, value FROM student_fields WHERE student_id IN (%s)"
+                    % ",".join("?" * len(ids)), ids).fetchall()
+            fields = {student_id: {} for student_id in ids}
+            for student_id, field, value in rows:
+                fields[student_id][field] = json.loads(value)
+            for student_id in ids:
+                yield student_id, fields[student_id]
+            after = ids[-1]
+
+    def stored_fields(self, student_id):
+        """Return a student's fields as stored (without loading them into this process), or None"""
+        if self._db is None:
+            state = self._states.get(student_id)
+            if state is None:
+                return None
+            return {key: value for key, value in state.items() if key != HISTORY_FIELD and key not in TRANSIENT_FIELDS}
+        with self._db_lock:
+            rows = self._db.execute("SELECT field, value FROM student_fields WHERE student_id = ?",
+                                    (student_id,)).fetchall()
+        return {field: json.loads(value) for field, value in rows} if rows else None
+
+    def stored_values(self, field):
+        """Return (student_id, value) of one field for every stored student"""
+        if self._db is None:
+            return [(student_id, state[field]) for student_id, state in sorted(self._states.items()) if field in state]
+        self.flush()
+        with self._db_lock:
+            rows = self._db.execute("SELECT student_id, value FROM student_fields WHERE field = ? ORDER BY student_id",
+                                    (field,)).fetchall()
+        return [(student_id, json.loads(value)) for student_id, value in rows]
+
+    def stored_history(self, student_id):
+        """Return a stored student's conversation history"""
+        if self._db is None:
+            state = self._states.get(student_id)
+            return list(state.get(HISTORY_FIELD, [])) if state is not None else []
+        with self._db_lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT entry FROM student_history WHERE student_id = ? ORDER BY seq", (student_id,))]
+
+    def import_states(self, records, replace=True, progress=None, within=None):
+        """Write (student_id, fields, history) records in one transaction.
+
+        Existing students are overwritten, or left alone when ``replace`` is
+        False. ``progress`` is an optional (source, position) pair committed
+        together with the records, so an interrupted import can resume from
+        ``import_position(source)``. ``within(db, written_ids)`` runs inside
+        the same transaction for writes that must commit with the records.
+        Returns the ids that were written.
+        """
+        self._require_db()
+        written = []
+        with self._db_lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS state_imports (
+                    source TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL
+                )
+            """)
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for student_id, fields, history in records:
+                    exists = self._db.execute(
+                        "SELECT 1 FROM student_fields WHERE student_id = ? LIMIT 1", (student_id,)).fetchone()
+                    if exists and not replace:
+                        continue
+                    self._db.execute("DELETE FROM student_fields WHERE student_id = ?", (student_id,))
+                    self._db.execute("DELETE FROM student_history WHERE student_id = ?", (student_id,))
+                    self._db.executemany(
+                        "INSERT INTO student_fields (student_id, field, value) VALUES (?, ?, ?)",
+                        [(student_id, field, json.dumps(value, ensure_ascii=False))
+                         for field, value in fields.items()
+                         if field != HISTORY_FIELD and field not in TRANSIENT_FIELDS])
+                    self._db.executemany(
+                        "INSERT INTO student_history (student_id, seq, entry) VALUES (?, ?, ?)",
+                        [(student_id, seq, entry) for seq, entry in enumerate(history)])
+                    written.append(student_id)
+                self._bump_versions(written)
+                if within is not None:
+                    within(self._db, set(written))
+                if progress is not None:
+                    self._db.execute("INSERT OR REPLACE INTO state_imports (source, position) VALUES (?, ?)",
+                                     progress)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        # Drop stale copies from this process's working set
+        with self._lock:
+            for student_id in written:
+                self._states.pop(student_id, None)
+                self._pending.pop(student_id, None)
+        return written
+
+    def update_stored(self, student_ids, fields):
+        """Overwrite ``fields`` of stored students on disk; returns the ids that exist.
+
+        Hold the students' turns around the call so no worker writes an older
+        copy back; copies loaded by a worker are then handled by ``apply_stored``.
+        """
+        if self._db is None:
+            return [student_id for student_id in student_ids if student_id in self._states]
+        self.flush()
+        updated = []
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for student_id in student_ids:
+                    if not self._db.execute("SELECT 1 FROM student_fields WHERE student_id = ? LIMIT 1",
+                                            (student_id,)).fetchone():
+                        continue
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO student_fields (student_id, field, value) VALUES (?, ?, ?)",
+                        [(student_id, field, json.dumps(value, ensure_ascii=False)) for field, value in fields.items()])
+                    updated.append(student_id)
+                self._bump_versions(updated)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return updated
+
+    def apply_stored(self, student_ids, fields):
+        """Bring this process's copies in line with ``update_stored`` run by any process.
+
+        Copies whose stored version moved on are dropped, so the student's
+        next turn reloads them; nothing stale is marked dirty and written
+        back. Without a database there is one process and no stored copy, so
+        loaded states are patched instead.
+        """
+        if self._db is None:
+            for student_id in student_ids:
+                state = self._states.get(student_id)
+                if state is not None:
+                    state.update(fields)
+            return
+        for student_id in student_ids:
+            self._refresh(student_id)
+
+    def evict(self, student_id=None):
+        """Forget a loaded student (or all of them) and their unflushed changes.
+
+        Unlike ``discard`` nothing is deleted on disk; used when another
+        process already changed the stored copy.
+        """
+        with self._lock:
+            if student_id is None:
+                self._states.clear()
+                self._pending.clear()
+            else:
+                self._states.pop(student_id, None)
+                self._pending.pop(student_id, None)
+
+    def import_position(self, source):
+        """Position committed by the last import from ``source`` (0 if none)"""
+        self._require_db()
+        with self._db_lock:
+            try:
+                row = self._db.execute("SELECT position FROM state_imports WHERE source = ?", (source,)).fetchone()
+            except sqlite3.OperationalError:
+                return 0
+        return row[0] if row else 0
+
+
+def fields_match(fields, module=None, active_since=None, active_before=None):
+    """Filter stored fields by current module and last activity.
+
+    Students with no recorded activity count as inactive.
+    """
+    if module is not None and fields.get("current_module") != module:
+        return False
+    last_active = fields.get("last_active_at") or 0
+    if active_since is not None and last_active < active_since:
+        return False
+    if active_before is not None and last_active >= active_before:
+        return False
+    return True
+
+
+def state_store_from_env():
+    """Build the StateStore configured by STATE_* environment variables"""
+    return StateStore(
+        path=os.environ.get("STATE_DB_PATH", DEFAULT_DB_PATH),
+        durability=os.environ.get("STATE_DURABILITY", "batched"),
+        flush_interval=float(os.environ.get("STATE_FLUSH_INTERVAL", 1.0)),
+        max_pending=int(os.environ.get("STATE_FLUSH_MAX_PENDING", 500)),
+        turn_lease=float(os.environ.get("STATE_TURN_LEASE", 120)),
+        turn_wait=float(os.environ.get("STATE_TURN_WAIT", 30)),
+    )
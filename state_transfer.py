@@ -0,0 +1,168 @@
+"""Streaming export and import of student state.
+
+Usage:
+    python state_transfer.py export FILE [--module M] [--active-since DATE] [--active-before DATE]
+    python state_transfer.py import FILE [--skip-existing] [--restart]
+
+Files are newline-delimited JSON (gzip-compressed when FILE ends in .gz): a
+header line followed by one line per student with their stored fields
+(profile, progress, points...) and conversation history, with lesson texts,
+the cards of a lesson being read and the questions of a quiz in progress
+inlined so the file doesn't depend on the source database (version 1 files, with plain-string histories, are
+still read). Both directions work a chunk
+at a time, so memory stays constant for any number of students.
+
+Imports commit each chunk in one transaction together with the points
+ledger rows that match it and the file position reached; running the same
+import again resumes after the last committed chunk. A chunk is written while
+holding its students' turns (see ``StateStore.turn``), so the deployment can
+keep serving: a student's message waits for the chunk, and their next turn
+reloads the imported state.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import transcript
+from leaderboard import Leaderboard
+from quiz import QuestionBank
+from state_store import HISTORY_FIELD, fields_match, state_store_from_env
+
+FORMAT_NAME = "student-state"
+FORMAT_VERSION = 2
+READABLE_VERSIONS = {1, 2}
+
+
+def _open(path, mode):
+    if path == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def export_states(store, path, module=None, active_since=None, active_before=None, chunk_size=500):
+    """Write matching students to ``path``; returns how many were exported"""
+    exported = 0
+    texts = transcript.LessonTexts(store.path)
+    bank = QuestionBank(store.path)
+    out = _open(path, "w")
+    try:
+        out.write(json.dumps({"format": FORMAT_NAME, "version": FORMAT_VERSION, "exported_at": time.time(),
+                              "filters": {"module": module, "active_since": active_since,
+                                          "active_before": active_before}}) + "\n")
+        for student_id, fields in store.iter_stored(chunk_size):
+            if not fields_match(fields, module, active_since, active_before):
+                continue
+            history = [transcript.to_json(entry, texts) for entry in store.stored_history(student_id)]
+            record = {"student_id": student_id, "fields": fields, "history": history}
+            if fields.get("quiz"):
+                record["quiz_questions"] = [bank.get(question_id) for question_id in fields["quiz"]["q"]]
+            if fields.get("lesson_cards"):
+                record["lesson_cards"] = [texts.get(text_id) for text_id in fields["lesson_cards"]["cards"]]
+            out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            exported += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return exported
+
+
+def import_states(store, path, replace=True, leaderboard=None, chunk_size=500, resume=True):
+    """Load students from ``path``; returns (written, skipped)"""
+    # Reading from stdin can't be resumed
+    source = f"{os.path.abspath(path)}:{os.path.getsize(path)}" if path != "-" else None
+    start = store.import_position(source) if resume and source else 0
+    written = skipped = 0
+    texts = transcript.LessonTexts(store.path)
+    bank = QuestionBank(store.path)
+
+    def commit(chunk, position):
+        nonlocal written, skipped
+
+        def sync_points(db, ids):
+            # Imported points totals go into the ledger in the chunk's own transaction
+            leaderboard.sync_totals(db, [(student_id.split(":", 1)[0], student_id, fields.get("points"))
+                                         for student_id, fields, _ in chunk if student_id in ids], "import")
+
+        with ExitStack() as turns:
+            for student_id, _, _ in chunk:
+                turns.enter_context(store.turn(student_id))
+            ids = set(store.import_states(chunk, replace, progress=(source, position) if source else None,
+                                          within=sync_points if leaderboard is not None else None))
+        written += len(ids)
+        skipped += len(chunk) - len(ids)
+
+    with _open(path, "r") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT_NAME or header.get("version") not in READABLE_VERSIONS:
+            raise ValueError(f"'{path}' is not a {FORMAT_NAME} v{FORMAT_VERSION} export")
+        position = 0
+        chunk = []
+        for line in f:
+            position += 1
+            if position <= start:
+                continue
+            record = json.loads(line)
+            fields = record["fields"]
+            fields.pop(HISTORY_FIELD, None)
+            if fields.get("quiz") and record.get("quiz_questions"):
+                # Banked in a pool of their own: they finish this quiz but aren't drawn for new ones
+                pool = f"{record['student_id'].split(':', 1)[0]}:import"
+                fields["quiz"]["q"] = [bank.add(pool, question) if question else question_id
+                                       for question_id, question in zip(fields["quiz"]["q"], record["quiz_questions"])]
+            if fields.get("lesson_cards") and record.get("lesson_cards"):
+                fields["lesson_cards"]["cards"] = [texts.intern(text) if text else text_id for text_id, text
+                                                   in zip(fields["lesson_cards"]["cards"], record["lesson_cards"])]
+            history = [transcript.from_json(item, texts) for item in record["history"]]
+            cold = len(history) - transcript.HOT_TURNS
+            history = [transcript.compress(entry) if i < cold else entry for i, entry in enumerate(history)]
+            chunk.append((record["student_id"], fields, history))
+            if len(chunk) >= chunk_size:
+                commit(chunk, position)
+                chunk = []
+        if chunk:
+            commit(chunk, position)
+    return written, skipped
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Export or import student state")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write student state to a file")
+    export_parser.add_argument("file", help="output file (.gz to compress, - for stdout)")
+    export_parser.add_argument("--module", help="only students currently in this module")
+    export_parser.add_argument("--active-since", type=_timestamp, help="only students active since this ISO date")
+    export_parser.add_argument("--active-before", type=_timestamp, help="only students not active since this ISO date")
+    import_parser = commands.add_parser("import", help="load student state from a file")
+    import_parser.add_argument("file", help="file written by 'export'")
+    import_parser.add_argument("--skip-existing", action="store_true", help="keep students that already exist")
+    import_parser.add_argument("--restart", action="store_true", help="ignore the progress of a previous run")
+    for command in (export_parser, import_parser):
+        command.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    store = state_store_from_env()
+    if args.command == "export":
+        count = export_states(store, args.file, args.module, args.active_since, args.active_before, args.chunk_size)
+        print(f"Exported {count} students", file=sys.stderr)
+    else:
+        written, skipped = import_states(store, args.file, not args.skip_existing, Leaderboard(store.path),
+                                         args.chunk_size, resume=not args.restart)
+        print(f"Imported {written} students ({skipped} skipped)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Tenant resolution for serving several courses from one process.
+
+Each tenant (a university course) owns one or more WhatsApp numbers and has
+its own catalogue, persona, model and quotas. Tenants are configured in
+``data/tenants.json``; without that file a single default tenant is built
+from the environment so a one-course deployment keeps working unchanged.
+
+The tenant handling the current message is kept in a context variable, so
+helpers deep in the message flow (and prefetch threads started from it) can
+read it without threading it through every call.
+
+Quota counters are kept per minute in the state database (``configure_quotas``),
+so every worker sharing it counts against the same hourly window.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from catalogue import default_catalogue_path, get_catalogue
+from db import LazyConnection
+from llm import get_model, model_name
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DEFAULT_TENANTS_PATH = os.path.join(DATA_DIR, "tenants.json")
+DEFAULT_TENANT_ID = "default"
+
+
+class QuotaExceededError(RuntimeError):
+    """Raised when a tenant goes over one of its quotas"""
+
+
+QUOTA_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tenant_quotas (
+        name TEXT NOT NULL,
+        minute INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (name, minute)
+    );
+"""
+
+# One connection per process for every quota; its transactions are serialized here
+_quota_db = LazyConnection(None, schema=QUOTA_SCHEMA)
+_quota_lock = threading.Lock()
+
+
+def configure_quotas(path):
+    """Keep quota counters in the SQLite database at ``path`` (None: per process, in memory)"""
+    global _quota_db
+    _quota_db = LazyConnection(path, schema=QUOTA_SCHEMA)
+
+
+class Quota:
+    """Sliding one-hour window counter, shared by the processes using one database"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+
+    def allow(self):
+        """Record one event if the limit allows it"""
+        if not self.limit:
+            return True
+        minute = int(time.time() // 60)
+        with _quota_lock:
+            db = _quota_db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                used = db.execute("SELECT COALESCE(SUM(count), 0) FROM tenant_quotas WHERE name = ? AND minute > ?",
+                                  (self.name, minute - 60)).fetchone()[0]
+                allowed = used < self.limit
+                if allowed:
+                    db.execute("INSERT INTO tenant_quotas (name, minute, count) VALUES (?, ?, 1)"
+                               " ON CONFLICT (name, minute) DO UPDATE SET count = count + 1",
+                               (self.name, minute))
+                    if minute % 10 == 0:
+                        db.execute("DELETE FROM tenant_quotas WHERE name = ? AND minute <= ?",
+                                   (self.name, minute - 60))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return allowed
+
+    def used(self):
+        minute = int(time.time() // 60)
+        with _quota_lock:
+            return _quota_db.execute("SELECT COALESCE(SUM(count), 0) FROM tenant_quotas WHERE name = ? AND minute > ?",
+                                     (self.name, minute - 60)).fetchone()[0]
+
+
+class Tenant:
+    """One course deployment sharing the process"""
+
+    def __init__(self, tenant_id, numbers=(), catalogue=None, persona=None,
+                 model=None, quotas=None):
+        self.id = tenant_id
+        self.numbers = [normalize_number(n) for n in numbers if n]
+        self.catalogue_path = os.path.abspath(os.path.join(DATA_DIR, catalogue)) if catalogue else default_catalogue_path()
+        self.persona = persona
+        self.model = model
+        quotas = quotas or {}
+        self.message_quota = Quota(f"{tenant_id}:messages", quotas.get("messages_per_hour"))
+        self.llm_quota = Quota(f"{tenant_id}:llm_calls", quotas.get("llm_calls_per_hour"))
+
+    @property
+    def catalogue(self):
+        return get_catalogue(self.catalogue_path)
+
+    def scoped(self, key):
+        """Namespace a student number or cache key by tenant"""
+        return f"{self.id}:{key}"
+
+    def __repr__(self):
+        return f"Tenant({self.id!r})"
+
+
+def normalize_number(number):
+    """Normalize a Twilio address ("whatsapp:+55 27 ...") for lookups"""
+    number = number.strip().lower()
+    if number.startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    return "".join(ch for ch in number if ch.isdigit() or ch == "+")
+
+
+def _load_persona(value):
+    """Personas may be inline text or a path to a text file under data/"""
+    if value and value.endswith(".txt"):
+        with open(os.path.join(DATA_DIR, value), encoding="utf-8") as f:
+            return f.read()
+    return value
+
+
+def load_tenants(path=None):
+    """Load tenant definitions, falling back to a single tenant from the environment"""
+    path = path or os.environ.get("TENANTS_PATH", DEFAULT_TENANTS_PATH)
+    if not os.path.exists(path):
+        tenant = Tenant(DEFAULT_TENANT_ID, numbers=[os.environ.get("TWILIO_WHATSAPP_NUMBER", "")])
+        return {tenant.id: tenant}, tenant.id
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    tenants = {}
+    for entry in data.get("tenants", []):
+        if "id" not in entry:
+            raise ValueError("Invalid tenants file: every tenant needs an 'id'")
+        tenants[entry["id"]] = Tenant(
+            entry["id"],
+            numbers=entry.get("numbers", []),
+            catalogue=entry.get("catalogue"),
+            persona=_load_persona(entry.get("persona")),
+            model=entry.get("model"),
+            quotas=entry.get("quotas"),
+        )
+    if not tenants:
+        raise ValueError("Invalid tenants file: no tenants defined")
+    default = data.get("default", next(iter(tenants)))
+    if default not in tenants:
+        raise ValueError(f"Invalid tenants file: unknown default tenant '{default}'")
+    return tenants, default
+
+
+# --- Registry ---
+# Loaded on first use so settings from .env are already in the environment
+
+_tenants = None
+_default_tenant = None
+_by_number = {}
+_registry_lock = threading.Lock()
+_current_tenant = contextvars.ContextVar("tenant", default=None)
+
+
+def all_tenants():
+    """Return the configured tenants keyed by id"""
+    global _tenants, _default_tenant, _by_number
+    if _tenants is None:
+        with _registry_lock:
+            if _tenants is None:
+                tenants, default = load_tenants()
+                _by_number = {number: tenant for tenant in tenants.values() for number in tenant.numbers}
+                _default_tenant = default
+                _tenants = tenants
+    return _tenants
+
+
+def default_tenant():
+    """Tenant used for unknown numbers and outside a request"""
+    return all_tenants()[_default_tenant]
+
+
+def resolve_tenant(to_number):
+    """Return the tenant that owns the inbound ``To`` number (or the default)"""
+    all_tenants()
+    if to_number:
+        tenant = _by_number.get(normalize_number(to_number))
+        if tenant is not None:
+            return tenant
+    return default_tenant()
+
+
+def current_tenant():
+    """Tenant handling the current message (the default outside a request)"""
+    return _current_tenant.get() or default_tenant()
+
+
+@contextmanager
+def use_tenant(tenant):
+    """Make ``tenant`` current for the duration of the block"""
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def current_catalogue():
+    """Catalogue of the current tenant"""
+    return current_tenant().catalogue
+
+
+def tenant_model():
+    """Model client routed for the current tenant, enforcing its LLM quota"""
+    tenant = current_tenant()
+    if not tenant.llm_quota.allow():
+        raise QuotaExceededError(f"Tenant '{tenant.id}' exceeded its hourly LLM quota")
+    return get_model(tenant.model or model_name())
+
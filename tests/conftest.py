@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Everything in memory: no state database, analytics log or model credentials
+os.environ.setdefault("STATE_DURABILITY", "memory")
+os.environ.setdefault("ANALYTICS_LOG_PATH", "")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("RETRIEVAL_TOP_K", "0")
+os.environ.setdefault("JOBS_WORKERS", "0")
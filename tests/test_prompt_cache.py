@@ -0,0 +1,52 @@
+import app
+import transcript
+from tenants import default_tenant, use_tenant
+
+LESSON_TEXT = "O empreendedor identifica problemas reais e testa soluções com clientes. " * 18
+
+
+def _student(student_id):
+    state = app.new_student_state(student_id)
+    state.update(form_completed=True, context="free_interaction", current_module="modulo1", current_submodule=0)
+    state["profile"].update(nome="Ana", curso="Administração", periodo="3")
+    for submodule in range(4):
+        text_id = app.lesson_texts.intern(f"{submodule} {LESSON_TEXT}")
+        state["conversation_history"] += [transcript.lesson("modulo1", submodule, text_id),
+                                          transcript.student("Pode me dar um exemplo?"),
+                                          transcript.assistant("Claro, pense em uma cantina na universidade.")]
+    return state
+
+
+def _prompt_sizes(monkeypatch, student_id, handle):
+    sent = []
+
+    def fake_generate_text(prompt, model=None, site="other", module=None):
+        sent.append((len(prompt.encode("utf-8")), model))
+        return "Boa pergunta!"
+
+    monkeypatch.setattr(app, "generate_text", fake_generate_text)
+    monkeypatch.setattr(app, "cached_model", lambda prefix, ttl, name=None: handle)
+    state = _student(student_id)
+    with use_tenant(default_tenant()):
+        for turn in range(5):
+            app.process_free_interaction(f"Dúvida número {turn}", state)
+    return sent
+
+
+def test_cached_prefix_handle_reduces_bytes_sent(monkeypatch):
+    handle = object()
+    full = _prompt_sizes(monkeypatch, "default:+5500", None)
+    cached = _prompt_sizes(monkeypatch, "default:+5501", handle)
+
+    assert all(model is None for _, model in full)
+    assert all(model is handle for _, model in cached)
+    # Only the changing suffix goes out once the prefix lives on the server
+    assert sum(size for size, _ in cached) * 3 < sum(size for size, _ in full)
+
+
+def test_default_threshold_is_reached_by_a_windowed_prefix():
+    state = _student("default:+5502")
+    with use_tenant(default_tenant()):
+        prefix = app.render_prompt_prefix(app.generate_master_prompt(), state["profile"],
+                                          state["conversation_history"])
+    assert len(prefix) >= app.prompt_cache.remote_min_chars
@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import retrieval
+from catalogue import DEFAULT_CATALOGUE_PATH, load_catalogue
+
+
+def _copy_catalogue(tmp_path, stem, notes):
+    path = str(tmp_path / f"{stem}.json")
+    shutil.copy(DEFAULT_CATALOGUE_PATH, path)
+    notes_dir, _ = retrieval.notes_paths(path)
+    os.makedirs(notes_dir)
+    with open(os.path.join(notes_dir, "modulo1.md"), "w", encoding="utf-8") as f:
+        f.write(f"## Submódulo\n\n{notes}\n")
+    return load_catalogue(path)
+
+
+def test_catalogues_in_one_directory_keep_their_own_notes(tmp_path):
+    day = _copy_catalogue(tmp_path, "diurno", "Validação com entrevistas de clientes na cantina.")
+    night = _copy_catalogue(tmp_path, "noturno", "Validação com colegas do trabalho durante o expediente.")
+
+    day_index, night_index = retrieval.get_index(day), retrieval.get_index(night)
+    assert day_index is not night_index
+    assert "cantina" in day_index.search("validação", k=1)[0].text
+    assert "expediente" in night_index.search("validação", k=1)[0].text
+    assert sorted(os.listdir(tmp_path)) == ["diurno.idx", "diurno.json", "diurno.notes",
+                                            "noturno.idx", "noturno.json", "noturno.notes"]
@@ -0,0 +1,19 @@
+from state_store import StateStore
+
+
+def test_broadcast_update_reloads_instead_of_writing_back(tmp_path):
+    path = str(tmp_path / "state.db")
+    worker, admin = StateStore(path, durability="batched"), StateStore(path, durability="sync")
+    student_id = "default:+5501"
+    with worker.turn(student_id):
+        worker.get_or_create(student_id, lambda: {"student_id": student_id, "current_module": "modulo1"})
+
+    fields = {"current_module": "modulo2"}
+    with admin.turn(student_id):
+        assert admin.update_stored([student_id], fields) == [student_id]
+    worker.apply_stored([student_id], fields)
+    worker.flush()
+
+    assert admin.stored_fields(student_id)["current_module"] == "modulo2"
+    with worker.turn(student_id):
+        assert worker.get(student_id)["current_module"] == "modulo2"
@@ -0,0 +1,77 @@
+import pytest
+
+import state_transfer
+import transcript
+from leaderboard import Leaderboard
+from state_store import StateStore
+
+
+def _store(tmp_path, name):
+    return StateStore(str(tmp_path / name), durability="sync")
+
+
+def _add_student(store, student_id, points, **fields):
+    texts = transcript.LessonTexts(store.path)
+    with store.turn(student_id):
+        state = store.get_or_create(student_id, lambda: {"student_id": student_id, "conversation_history": []})
+        state.update(points=points, current_module="modulo1", current_submodule=0, **fields)
+        state["conversation_history"] += [transcript.student("oi"),
+                                          transcript.lesson("modulo1", 0, texts.intern("Aula sobre clientes."))]
+
+
+def _export(tmp_path, students):
+    source = _store(tmp_path, "source.db")
+    for student_id, points in students:
+        _add_student(source, student_id, points)
+    path = str(tmp_path / "students.jsonl")
+    assert state_transfer.export_states(source, path) == len(students)
+    return path
+
+
+def test_import_records_points_in_the_ledger_once(tmp_path):
+    path = _export(tmp_path, [("default:+5501", 30), ("default:+5502", 0), ("default:+5503", 10)])
+    target = _store(tmp_path, "target.db")
+    leaderboard = Leaderboard(target.path)
+
+    assert state_transfer.import_states(target, path, leaderboard=leaderboard, chunk_size=2) == (3, 0)
+    state_transfer.import_states(target, path, leaderboard=leaderboard, resume=False)
+    assert leaderboard.score("default", "default:+5501") == 30
+    assert leaderboard.score("default", "default:+5503") == 10
+    assert leaderboard.rank("default", "default:+5503") == (2, 2)
+
+
+def test_failed_chunk_leaves_neither_students_nor_points(tmp_path, monkeypatch):
+    path = _export(tmp_path, [("default:+5501", 30)])
+    target = _store(tmp_path, "target.db")
+    leaderboard = Leaderboard(target.path)
+
+    def sync_then_fail(db, totals, reason):
+        Leaderboard.sync_totals(db, totals, reason)
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(leaderboard, "sync_totals", sync_then_fail)
+    with pytest.raises(RuntimeError):
+        state_transfer.import_states(target, path, leaderboard=leaderboard)
+    assert target.stored_fields("default:+5501") is None
+    assert leaderboard.score("default", "default:+5501") == 0
+
+    monkeypatch.undo()
+    assert state_transfer.import_states(target, path, leaderboard=leaderboard) == (1, 0)
+    assert leaderboard.score("default", "default:+5501") == 30
+
+
+def test_cards_mode_round_trip_restores_card_texts(tmp_path):
+    source = _store(tmp_path, "source.db")
+    cards = ["Card 1: o problema.", "Card 2: a solução.", "Card 3: o cliente."]
+    deck = {"lesson": ["modulo1", 0], "cards": [transcript.LessonTexts(source.path).intern(card) for card in cards],
+            "next": 1}
+    _add_student(source, "default:+5501", 5, lesson_cards=deck)
+    path = str(tmp_path / "students.jsonl")
+    state_transfer.export_states(source, path)
+
+    target = _store(tmp_path, "target.db")
+    assert state_transfer.import_states(target, path) == (1, 0)
+    imported = target.stored_fields("default:+5501")["lesson_cards"]
+    texts = transcript.LessonTexts(target.path)
+    assert [texts.get(text_id) for text_id in imported["cards"]] == cards
+    assert imported["lesson"] == ["modulo1", 0] and imported["next"] == 1
@@ -0,0 +1,15 @@
+import app
+from tenants import default_tenant, use_tenant
+
+
+def test_note_is_filled_from_the_profile_without_a_model_call(monkeypatch):
+    def no_model_call(*args, **kwargs):
+        raise AssertionError("student notes don't call the model")
+
+    monkeypatch.setattr(app, "generate_text", no_model_call)
+    profile = {"nome": "ana souza", "objetivos": "abrir uma cafeteria.", "experiencia": "vendas no comércio da família"}
+    with use_tenant(default_tenant()):
+        note = app.student_note("modulo1", 0, profile)
+        assert note.startswith("Ana, pense em como")
+        assert "abrir uma cafeteria." in note and "vendas no comércio da família" in note
+        assert app.student_note("modulo1", 0, {"nome": "Ana", "objetivos": None, "experiencia": None}) == ""
@@ -0,0 +1,20 @@
+import variation
+
+
+def test_no_template_repeats_across_cycle_boundaries():
+    for size in range(2, 7):
+        for student in range(200):
+            served = [variation.template_index(f"default:+55{student}", "erro", turn, size)
+                      for turn in range(size * 6)]
+            assert all(a != b for a, b in zip(served, served[1:])), (size, student, served)
+            for start in range(0, len(served), size):
+                assert sorted(served[start:start + size]) == list(range(size))
+
+
+def test_choose_is_reproducible():
+    templates = ["a", "b", "c"]
+    first = {"student_id": "default:+5511"}
+    second = {"student_id": "default:+5511"}
+    picks = [variation.choose(first, "erro", templates) for _ in range(7)]
+    assert picks == [variation.choose(second, "erro", templates) for _ in range(7)]
+    assert first["variation"] == {"erro": 7}
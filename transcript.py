@@ -0,0 +1,204 @@
+"""Compact encoding of the conversation history.
+
+Each history entry is a small ``bytes`` value whose first byte holds the
+role and flags:
+
+* ``STUDENT`` / ``ASSISTANT`` turns carry their text as UTF-8;
+* ``LESSON`` entries carry only ``module``, ``submodule`` and the id of the
+  lesson text, which is stored once in ``lesson_texts`` and shared by every
+  student who got the same lesson. The title, footer and reflection
+  template around it are not kept;
+* turns that fall out of the hot window (HISTORY_HOT_TURNS most recent
+  entries) are zlib-compressed with a preset dictionary of common course
+  vocabulary, which works well on short Portuguese texts.
+
+Entries are only turned back into "Aluno: ..." / "Assistente: ..." lines
+by ``render`` when a prompt or an admin view needs them. Histories stored
+before this encoding (plain strings) are still read.
+"""
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from db import LazyConnection
+
+STUDENT = 0
+ASSISTANT = 1
+LESSON = 2
+
+ROLE_LABELS = {STUDENT: "Aluno", ASSISTANT: "Assistente", LESSON: "Assistente"}
+
+_ROLE_MASK = 0x0F
+_COMPRESSED = 0x10
+
+# Turns that stay uncompressed at the end of the history; keep it above
+# PROMPT_PREFIX_MAX_TAIL so prompt prefix anchors stay in the hot part
+HOT_TURNS = int(os.environ.get("HISTORY_HOT_TURNS", 24))
+
+# Preset dictionary for cold turns. Changing it makes stored turns
+# unreadable, so it is versioned by the flag bit and must stay as is.
+ZDICT = (
+    "Aluno: Assistente: você Você seu sua negócio negócios empreendedor empreendedora "
+    "empreendedorismo cliente clientes mercado produto serviço valor proposta de valor "
+    "modelo de negócio Canvas MVP startup inovação ideia ideias problema solução "
+    "pesquisa validação concorrentes público-alvo persona plano financeiro custos receita "
+    "investimento pitch equipe oportunidade estratégia marketing vendas por exemplo "
+    "Por exemplo, isso é muito importante para que o seu projeto. Que tal pensar em "
+    "Você pode começar com uma pergunta: o que você acha? Ótima pergunta! Parabéns! "
+    "continuar curso módulo conteúdo quiz pontos mentoria universidade UVV "
+).encode("utf-8")
+
+
+# --- Encoding ---
+
+def student(text):
+    """History entry for a student message"""
+    return bytes([STUDENT]) + text.encode("utf-8")
+
+
+def assistant(text):
+    """History entry for an assistant message"""
+    return bytes([ASSISTANT]) + text.encode("utf-8")
+
+
+def lesson(module, submodule, text_id):
+    """History entry referencing a lesson text stored in ``LessonTexts``"""
+    return bytes([LESSON]) + f"{module}\0{submodule}\0{text_id}".encode("utf-8")
+
+
+def upgrade(entry):
+    """Encode a plain-string entry from an older history"""
+    if isinstance(entry, bytes):
+        return entry
+    for role in (STUDENT, ASSISTANT):
+        label = ROLE_LABELS[role] + ": "
+        if entry.startswith(label):
+            return bytes([role]) + entry[len(label):].encode("utf-8")
+    return assistant(entry)
+
+
+def compress(entry):
+    """Cold form of an entry (unchanged when compression doesn't pay off)"""
+    if entry[0] & _COMPRESSED or entry[0] & _ROLE_MASK == LESSON or len(entry) < 64:
+        return entry
+    compressor = zlib.compressobj(9, zdict=ZDICT)
+    packed = compressor.compress(entry[1:]) + compressor.flush()
+    if len(packed) >= len(entry) - 1:
+        return entry
+    return bytes([entry[0] | _COMPRESSED]) + packed
+
+
+def decode(entry):
+    """Return (role, payload): the text of a turn, or (module, submodule, text id) of a lesson"""
+    entry = upgrade(entry)
+    role = entry[0] & _ROLE_MASK
+    body = entry[1:]
+    if entry[0] & _COMPRESSED:
+        decompressor = zlib.decompressobj(zdict=ZDICT)
+        body = decompressor.decompress(body) + decompressor.flush()
+    text = body.decode("utf-8")
+    if role == LESSON:
+        module, submodule, text_id = text.split("\0")
+        return role, (module, int(submodule), text_id)
+    return role, text
+
+
+# --- Rendering ---
+
+def render(entries, texts, catalogue=None):
+    """Render entries as "Aluno: ..." / "Assistente: ..." lines"""
+    lines = []
+    for entry in entries:
+        role, payload = decode(entry)
+        if role == LESSON:
+            module, submodule, text_id = payload
+            lines.append(f"Assistente: *{_lesson_title(catalogue, module, submodule)}*\n\n{texts.get(text_id)}")
+        else:
+            lines.append(f"{ROLE_LABELS[role]}: {payload}")
+    return lines
+
+
+def _lesson_title(catalogue, module, submodule):
+    try:
+        titles = catalogue.modules[module]
+        return f"{titles['titulo']} - {titles['submodulos'][submodule]}"
+    except (AttributeError, KeyError, IndexError):
+        return f"{module} - {submodule + 1}"
+
+
+def to_json(entry, texts):
+    """Portable form of an entry for exports (lesson texts inlined)"""
+    role, payload = decode(entry)
+    if role == LESSON:
+        module, submodule, text_id = payload
+        return [role, module, submodule, texts.get(text_id)]
+    return [role, payload]
+
+
+def from_json(item, texts):
+    """Inverse of ``to_json``; also accepts plain strings from older exports"""
+    if isinstance(item, str):
+        return upgrade(item)
+    if item[0] == LESSON:
+        _, module, submodule, text = item
+        return lesson(module, submodule, texts.intern(text))
+    return bytes([item[0]]) + item[1].encode("utf-8")
+
+
+# --- Lesson texts ---
+
+class LessonTexts:
+    """Content-addressed store of lesson texts referenced by history entries"""
+
+    def __init__(self, path=None, max_cached=256):
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = LazyConnection(path, schema="""
+                CREATE TABLE IF NOT EXISTS lesson_texts (
+                    text_id TEXT PRIMARY KEY,
+                    body BLOB NOT NULL
+                );
+            """)
+        else:
+            # Without a database every text is kept (development only)
+            self.max_cached = None
+
+    def intern(self, text):
+        """Store a lesson text once; returns its id"""
+        text_id = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            if text_id in self._cache:
+                self._cache.move_to_end(text_id)
+                return text_id
+            if self._db is not None:
+                self._db.execute("INSERT OR IGNORE INTO lesson_texts (text_id, body) VALUES (?, ?)",
+                                 (text_id, zlib.compress(text.encode("utf-8"), 9)))
+            self._remember(text_id, text)
+        return text_id
+
+    def get(self, text_id):
+        """Text of a lesson ("" if it's unknown)"""
+        with self._lock:
+            text = self._cache.get(text_id)
+            if text is not None:
+                self._cache.move_to_end(text_id)
+                return text
+            row = None
+            if self._db is not None:
+                row = self._db.execute("SELECT body FROM lesson_texts WHERE text_id = ?", (text_id,)).fetchone()
+            if row is None:
+                return ""
+            text = zlib.decompress(row[0]).decode("utf-8")
+            self._remember(text_id, text)
+            return text
+
+    def _remember(self, text_id, text):
+        self._cache[text_id] = text
+        if self.max_cached is not None:
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
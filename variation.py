@@ -0,0 +1,50 @@
+"""Deterministic, per-student rotation through response templates.
+
+Each student walks through a template list in a shuffled order derived from
+their id, the template key and how many times they have been served that key
+(stored in ``state["variation"]``). Within a cycle no template repeats, the
+first template of a new cycle never repeats the last one of the previous
+cycle, and the same (student, turn) always yields the same template, so
+rendered replies are reproducible and cacheable.
+"""
+import hashlib
+import random
+
+
+def _order(student_id, key, cycle, size):
+    """Shuffled template indexes for one cycle of a student's rotation"""
+    seed = hashlib.sha1(f"{student_id}\0{key}\0{cycle}".encode("utf-8")).digest()
+    order = list(range(size))
+    random.Random(seed).shuffle(order)
+    return order
+
+
+def _cycle_order(student_id, key, cycle, size):
+    """Order actually served in a cycle: it never opens with the template that closed the previous one"""
+    if size == 2:
+        # Two templates can only alternate, so every cycle repeats the first one
+        return _order(student_id, key, 0, size)
+    order = _order(student_id, key, cycle, size)
+    if cycle > 0:
+        # With 3+ templates the swap below never moves a cycle's last template,
+        # so the previous cycle's shuffled order ends with what was served last
+        previous = _order(student_id, key, cycle - 1, size)[-1]
+        if order[0] == previous:
+            order[0], order[1] = order[1], order[0]
+    return order
+
+
+def template_index(student_id, key, turn, size):
+    """Index of the template a student gets on their ``turn``-th use of ``key``"""
+    if size <= 1:
+        return 0
+    cycle, position = divmod(turn, size)
+    return _cycle_order(student_id, key, cycle, size)[position]
+
+
+def choose(state, key, templates):
+    """Pick the next template for a student and advance their rotation"""
+    counters = state.setdefault("variation", {})
+    turn = counters.get(key, 0)
+    counters[key] = turn + 1
+    return templates[template_index(state["student_id"], key, turn, len(templates))]